@@ -11,10 +11,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import logging
 import time
 
 import requests
 
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
 while True:
-    requests.post("http://127.0.0.1:10086/run")
+    # `/run` only queues a listing of the bucket, a listing still waiting is reused.
+    try:
+        result = requests.post("http://127.0.0.1:10086/run").json()
+        if result.get("code") != 20000:
+            logger.warning(f"`/run` failed: {result.get('msg')}.")
+    except (requests.RequestException, ValueError) as error:
+        logger.warning(f"`/run` failed: {error}.")
     time.sleep(1)
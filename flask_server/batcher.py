@@ -0,0 +1,147 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import torch
+
+from metrics import BATCHER_QUEUE
+
+__all__ = ["DynamicBatcher"]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+
+class DynamicBatcher(object):
+    r""" Run the tiles of concurrent requests through the model as one batch.
+
+    Callers block on `__call__` while a worker thread gathers their tiles, for up to `max_wait` seconds after the
+    first one or until `max_batch_size` tiles are waiting. A larger wait fills the batches better and raises the
+    throughput, at the cost of the latency of the requests arriving alone.
+
+    Examples:
+        >>> batcher = DynamicBatcher(bionet().eval(), torch.device("cpu"), max_batch_size=16, max_wait=0.01)
+        >>> sr = batcher(lr)  # lr: N*C*H*W
+    """
+
+    def __init__(self, model: torch.nn.Module, device: torch.device, max_batch_size: int = 16,
+                 max_wait: float = 0.01) -> None:
+        r"""
+        Args:
+            model (torch.nn.Module): Model the tiles go through.
+            device (torch.device): Device of the model.
+            max_batch_size (optional, int): Tiles run in one forward pass. (Default: 16).
+            max_wait (optional, float): Seconds a tile waits for others to join its batch. (Default: 0.01).
+        """
+        self.model = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+
+        self.num_batches = 0
+        self.num_tiles = 0
+        self.num_requests = 0
+
+        self.thread = threading.Thread(target=self.work, name="batcher", daemon=True)
+        self.thread.start()
+
+    def __call__(self, lr: torch.Tensor) -> torch.Tensor:
+        r""" Super-resolution of a batch of tiles, run together with the tiles of the other callers.
+
+        Args:
+            lr (torch.Tensor): Low-resolution tiles (N*C*H*W).
+
+        Returns:
+            Super-resolution tiles (N*C*H*W) on the device of the model.
+        """
+        future = Future()
+        self.queue.put((lr, future))
+        return future.result()
+
+    def gather(self) -> list:
+        r""" Wait for the first request, then for others until the batch is full or `max_wait` has passed."""
+        requests = [self.queue.get()]
+        if requests[0] is None:
+            return None
+        size = len(requests[0][0])
+        deadline = time.perf_counter() + self.max_wait
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # Closed, the requests gathered so far still run.
+                self.queue.put(None)
+                break
+            requests.append(request)
+            size += len(request[0])
+        BATCHER_QUEUE.set(self.queue.qsize())
+        return requests
+
+    def work(self) -> None:
+        while True:
+            requests = self.gather()
+            if requests is None:
+                return
+
+            # Edge tiles may have another shape, tiles of the same shape are batched together.
+            groups = OrderedDict()
+            for lr, future in requests:
+                groups.setdefault(tuple(lr.shape[1:]), []).append((lr, future))
+
+            for group in groups.values():
+                try:
+                    lr = torch.cat([lr for lr, _ in group]).to(self.device)
+                    with torch.no_grad():
+                        sr = torch.cat([self.model(lr[index:index + self.max_batch_size])
+                                        for index in range(0, len(lr), self.max_batch_size)])
+                except Exception as error:
+                    logger.exception(f"Batch of {len(group)} requests failed: {error}")
+                    for _, future in group:
+                        future.set_exception(error)
+                    continue
+
+                # Route every slice of the output back to its caller.
+                offset = 0
+                for request_lr, future in group:
+                    future.set_result(sr[offset:offset + len(request_lr)])
+                    offset += len(request_lr)
+
+                with self.lock:
+                    self.num_batches += (len(lr) + self.max_batch_size - 1) // self.max_batch_size
+                    self.num_tiles += len(lr)
+                    self.num_requests += len(group)
+
+    def close(self) -> None:
+        r""" Stop the worker thread once the requests already queued have run."""
+        self.queue.put(None)
+
+    def stats(self) -> dict:
+        r""" Batches run, and the mean number of tiles and of requests per batch."""
+        with self.lock:
+            return {"batches": self.num_batches,
+                    "tiles": self.num_tiles,
+                    "tiles_per_batch": round(self.num_tiles / max(self.num_batches, 1), 2),
+                    "requests_per_batch": round(self.num_requests / max(self.num_batches, 1), 2)}
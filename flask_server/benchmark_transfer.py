@@ -0,0 +1,101 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from engine import COS
+from local_cos import LocalCosS3Client
+from transfer import TransferManager
+
+
+def benchmark(cos, files: list, download_path: str, workers: int, part_workers: int, multipart_threshold: int,
+              part_size: int) -> dict:
+    transfers = TransferManager(cos, workers=workers, part_workers=part_workers,
+                                multipart_threshold=multipart_threshold, part_size=part_size, backoff=0.01)
+    start = time.perf_counter()
+    for future in [transfers.download(os.path.join(download_path, os.path.basename(cos_path)), cos_path)
+                   for cos_path in files]:
+        future.result()
+    for future in [transfers.upload(open(os.path.join(download_path, os.path.basename(cos_path)), "rb").read(),
+                                    "sr/" + os.path.basename(cos_path))
+                   for cos_path in files]:
+        future.result()
+    stats = transfers.stats()
+    stats["seconds"] = time.perf_counter() - start
+    transfers.close()
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Throughput of the COS transfers against a local bucket.")
+    parser.add_argument("--files", type=int, default=16,
+                        help="Number of objects. (Default: 16).")
+    parser.add_argument("--size", type=float, default=48,
+                        help="Size of an object in MB, a 4x output of a 2048x2048 field is about 48MB. (Default: 48).")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="Seconds added to every request. (Default: 0.05).")
+    parser.add_argument("--bandwidth", type=float, default=50,
+                        help="MB/s of a single connection. (Default: 50).")
+    parser.add_argument("--failure-rate", type=float, default=0.05,
+                        help="Probability of a transient error on a request. (Default: 0.05).")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="Objects transferred at the same time. (Default: 8).")
+    parser.add_argument("--part-size", type=float, default=8,
+                        help="Size of an upload part in MB. (Default: 8).")
+    parser.add_argument("--root", type=str, default=None,
+                        help="Directory of the local bucket, a tmpfs such as `/dev/shm` keeps the disk out of "
+                             "the measurement. (Default: the temporary directory).")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(dir=args.root)
+    try:
+        client = LocalCosS3Client(root, latency=args.latency, failure_rate=args.failure_rate,
+                                  bandwidth=args.bandwidth * (1 << 20))
+        cos = COS(client, bucket="benchmark")
+        size = int(args.size * (1 << 20))
+        files = []
+        for index in range(args.files):
+            files.append(f"lr/{index:04d}.bin")
+            path = client.path(cos.Bucket, files[-1])
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(os.urandom(size))
+
+        part_size = int(args.part_size * (1 << 20))
+        print(f"{args.files} objects of {args.size:.0f}MB, {args.latency * 1000:.0f}ms latency, "
+              f"{args.bandwidth:.0f}MB/s per connection, {args.failure_rate:.0%} transient errors.")
+        print(f"{'Mode':<24}{'Download MB/s':>16}{'Upload MB/s':>16}{'Retries':>10}{'Seconds':>10}")
+        for name, workers, part_workers, multipart_threshold in [("sequential", 1, 1, 1 << 62),
+                                                                 ("pooled", args.workers, 1, 1 << 62),
+                                                                 ("pooled + multipart", args.workers, args.workers,
+                                                                  2 * part_size)]:
+            download_path = tempfile.mkdtemp(dir=root)
+            stats = benchmark(cos, files, download_path, workers, part_workers, multipart_threshold, part_size)
+            for cos_path in files:
+                with open(client.path(cos.Bucket, cos_path), "rb") as f, \
+                        open(client.path(cos.Bucket, "sr/" + os.path.basename(cos_path)), "rb") as g:
+                    assert f.read() == g.read(), f"`{cos_path}` changed during the transfer."
+            shutil.rmtree(download_path)
+            retries = stats["download"]["retries"] + stats["upload"]["retries"]
+            print(f"{name:<24}{stats['download']['MB/s']:>16.1f}{stats['upload']['MB/s']:>16.1f}"
+                  f"{retries:>10d}{stats['seconds']:>10.2f}")
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import hashlib
+import math
+import os
+import threading
+
+import cv2
+import numpy as np
+
+from engine import TileCache
+from metrics import STAGE_SECONDS
+from slide import SlideReader
+
+__all__ = ["DeepZoom"]
+
+
+class DeepZoom(object):
+    r""" DeepZoom pyramid of the super-resolution of a slide, rendered tile by tile as a viewer asks for them.
+
+    Level `levels - 1` is the super-resolution, its tiles run the generator on their region only. The level with the
+    resolution of the slide is read from the slide, the generator would add nothing there and below. Every other
+    level is downsampled from the tiles of the next level. Rendered tiles are kept in `cache`, so a region only goes
+    through the generator the first time it is viewed, and the levels of the overview never do.
+
+    Examples:
+        >>> pyramid = DeepZoom("static/slides/slide.npy", cache=TileCache(spill_dir="static/deepzoom"))
+        >>> pyramid.descriptor(".jpg")
+        >>> tile = pyramid.tile(pyramid.levels - 1, 3, 5, upscale)
+    """
+
+    def __init__(self, filename, tile_size: int = 254, overlap: int = 1, upscale_factor: int = 4,
+                 cache: TileCache = None) -> None:
+        r"""
+        Args:
+            filename (str or np.ndarray): Low-resolution slide, any format of `SlideReader`.
+            tile_size (optional, int): Tile size without the overlap. (Default: 254).
+            overlap (optional, int): Pixels every tile shares with each of its neighbours. (Default: 1).
+            upscale_factor (optional, int): Low to high resolution scaling factor, a power of 2. (Default: 4).
+            cache (optional, TileCache): Rendered tiles of all the levels. (Default: ``None``).
+        """
+        assert upscale_factor & (upscale_factor - 1) == 0, "The upscale factor must be a power of 2."
+        self.reader = SlideReader(filename)
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.upscale_factor = upscale_factor
+        self.cache = cache
+
+        self.width, self.height = (length * upscale_factor for length in self.reader.size)
+        self.levels = int(math.ceil(math.log2(max(self.width, self.height)))) + 1
+        # Deepest level with the resolution of the slide.
+        self.source_level = self.levels - 1 - int(math.log2(upscale_factor))
+
+        # Tiles of another slide, or of the same file rewritten, never share a cache key.
+        identity = hashlib.blake2b(digest_size=16)
+        if isinstance(filename, str):
+            stat = os.stat(filename)
+            identity.update(f"{os.path.abspath(filename)}:{stat.st_mtime_ns}:{stat.st_size}".encode())
+        else:
+            identity.update(filename.tobytes())
+        self.identity = identity.hexdigest()
+
+        self.lock = threading.Lock()
+        self.pending = {}  # Cache key to the event of the tile being rendered.
+
+    def dimensions(self, level: int) -> tuple:
+        r""" Width and height of a level."""
+        scale = 2 ** (self.levels - 1 - level)
+        return int(math.ceil(self.width / scale)), int(math.ceil(self.height / scale))
+
+    def tile_count(self, level: int) -> tuple:
+        r""" Columns and rows of the tiles of a level."""
+        width, height = self.dimensions(level)
+        return int(math.ceil(width / self.tile_size)), int(math.ceil(height / self.tile_size))
+
+    def tile_box(self, level: int, column: int, row: int) -> tuple:
+        r""" Area of a tile (left, upper, right, lower) in the pixels of its level, overlap included."""
+        width, height = self.dimensions(level)
+        left = column * self.tile_size - (self.overlap if column > 0 else 0)
+        upper = row * self.tile_size - (self.overlap if row > 0 else 0)
+        right = min((column + 1) * self.tile_size + self.overlap, width)
+        lower = min((row + 1) * self.tile_size + self.overlap, height)
+        return left, upper, right, lower
+
+    def descriptor(self, format: str = ".jpg") -> str:
+        r""" DZI descriptor of the pyramid.
+
+        Args:
+            format (optional, str): Format of the tiles. (Default: ``.jpg``).
+        """
+        return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+                f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{self.tile_size}" '
+                f'Overlap="{self.overlap}" Format="{format.lstrip(".")}">'
+                f'<Size Width="{self.width}" Height="{self.height}"/></Image>')
+
+    def tile(self, level: int, column: int, row: int, upscale, version: str = "") -> np.ndarray:
+        r""" Render a tile, or take it from the cache.
+
+        Args:
+            level (int): Pyramid level, `levels - 1` is the super-resolution.
+            column (int): Tile column.
+            row (int): Tile row.
+            upscale: Function of a low-resolution box (left, upper, right, lower) returning its super-resolution,
+                RGB (uint8), e.g. by `RegionSR`.
+            version (optional, str): Identity of the model behind `upscale`, e.g. `model_fingerprint`.
+                (Default: ``""``).
+
+        Returns:
+            RGB tile (uint8), shared with the cache, copy it before modifying it.
+        """
+        if not 0 <= level < self.levels:
+            raise ValueError(f"Level {level} is not in [0, {self.levels}).")
+        columns, rows = self.tile_count(level)
+        if not (0 <= column < columns and 0 <= row < rows):
+            raise ValueError(f"Tile ({column}, {row}) is not in the {columns}x{rows} tiles of level {level}.")
+        if self.cache is None:
+            return self.render(level, column, row, upscale, version)
+
+        key = f"{self.identity}:{version}:{level}:{column}:{row}"
+        key = hashlib.blake2b(key.encode(), digest_size=20).hexdigest()
+        image = self.cache.get(key)
+        if image is not None:
+            return image
+
+        # Concurrent requests of a tile wait for a single rendering.
+        with self.lock:
+            event = self.pending.get(key)
+            owner = event is None
+            if owner:
+                event = self.pending[key] = threading.Event()
+        if not owner:
+            event.wait()
+            image = self.cache.get(key)
+            if image is not None:
+                return image
+
+        try:
+            image = self.render(level, column, row, upscale, version)
+            self.cache.put(key, image)
+            return image
+        finally:
+            if owner:
+                with self.lock:
+                    del self.pending[key]
+                event.set()
+
+    def render(self, level: int, column: int, row: int, upscale, version: str) -> np.ndarray:
+        box = self.tile_box(level, column, row)
+        if level == self.levels - 1:
+            return self.render_sr(box, upscale)
+        if level == self.source_level:
+            return self.render_source(box)
+        return self.render_downsampled(level, box, upscale, version)
+
+    def render_sr(self, box: tuple, upscale) -> np.ndarray:
+        r""" Super-resolution of an area of the deepest level, through the low-resolution area around it."""
+        left, upper, right, lower = box
+        factor = self.upscale_factor
+        lr_box = (left // factor, upper // factor, -(-right // factor), -(-lower // factor))
+        sr = upscale(lr_box)
+        offset_x, offset_y = left - lr_box[0] * factor, upper - lr_box[1] * factor
+        return np.ascontiguousarray(sr[offset_y:offset_y + lower - upper, offset_x:offset_x + right - left])
+
+    def render_source(self, box: tuple) -> np.ndarray:
+        r""" Area of the level with the resolution of the slide."""
+        with STAGE_SECONDS.time(stage="load"):
+            return self.reader.read_region(*box)
+
+    def render_downsampled(self, level: int, box: tuple, upscale, version: str) -> np.ndarray:
+        r""" Area of a level downsampled from the tiles of the next level."""
+        left, upper, right, lower = box
+        width, height = self.dimensions(level + 1)
+        left, upper, right, lower = 2 * left, 2 * upper, min(2 * right, width), min(2 * lower, height)
+
+        # Paste the area of every tile of the next level, without its overlap.
+        image = np.empty((lower - upper, right - left, 3), dtype=np.uint8)
+        for row in range(upper // self.tile_size, (lower - 1) // self.tile_size + 1):
+            for column in range(left // self.tile_size, (right - 1) // self.tile_size + 1):
+                tile = self.tile(level + 1, column, row, upscale, version)
+                tile_left, tile_upper = self.tile_box(level + 1, column, row)[:2]
+                x0, y0 = max(column * self.tile_size, left), max(row * self.tile_size, upper)
+                x1, y1 = min((column + 1) * self.tile_size, right), min((row + 1) * self.tile_size, lower)
+                image[y0 - upper:y1 - upper, x0 - left:x1 - left] = \
+                    tile[y0 - tile_upper:y1 - tile_upper, x0 - tile_left:x1 - tile_left]
+
+        with STAGE_SECONDS.time(stage="downsample"):
+            return cv2.resize(image, (box[2] - box[0], box[3] - box[1]), interpolation=cv2.INTER_AREA)
@@ -0,0 +1,99 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import cv2
+import numpy as np
+
+from metrics import STAGE_SECONDS
+
+__all__ = ["Encoder"]
+
+
+class Encoder(object):
+    r""" In-memory encoder of the super-resolution images.
+
+    The image is compressed with `cv2.imencode`, so the bytes go to the uploader without a round trip through the
+    local disk.
+
+    Examples:
+        >>> encoder = Encoder(".png", bit_depth=8, compression=3)
+        >>> stream = encoder.encode(sr)
+    """
+
+    formats = {".png": (8, 16), ".tif": (8, 16), ".tiff": (8, 16), ".jpg": (8,), ".jpeg": (8,), ".webp": (8,),
+               ".bmp": (8,)}
+
+    def __init__(self, format: str = ".png", bit_depth: int = 8, compression: int = 3, quality: int = 95) -> None:
+        r"""
+        Args:
+            format (optional, str): Image format, one of `.png`, `.tif`, `.jpg`, `.webp` or `.bmp`. (Default: ``.png``).
+            bit_depth (optional, int): Bits per channel, 8 or 16 for PNG and TIFF. (Default: 8).
+            compression (optional, int): PNG compression level from 0 (fastest) to 9 (smallest). (Default: 3).
+            quality (optional, int): JPEG and WebP quality from 0 to 100. (Default: 95).
+        """
+        format = format.lower() if format.startswith(".") else f".{format.lower()}"
+        if format not in self.formats:
+            raise ValueError(f"Unsupported format `{format}`, expected one of {list(self.formats)}.")
+        if bit_depth not in self.formats[format]:
+            raise ValueError(f"`{format}` does not support {bit_depth}-bit images.")
+
+        self.format = format
+        self.bit_depth = bit_depth
+        self.dtype = np.uint8 if bit_depth == 8 else np.uint16
+        if format == ".png":
+            self.params = [cv2.IMWRITE_PNG_COMPRESSION, compression]
+        elif format in (".jpg", ".jpeg"):
+            self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+        elif format == ".webp":
+            self.params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+        else:
+            self.params = []
+
+    def convert(self, image: np.ndarray) -> np.ndarray:
+        r""" Convert an image to the bit depth of the encoder.
+
+        Args:
+            image (np.ndarray): Image in OpenCV format (H*W*C, BGR), uint8, uint16 or float in [0, 1].
+
+        Returns:
+            Image of the bit depth of the encoder.
+        """
+        if image.dtype == self.dtype:
+            return image
+        if image.dtype == np.uint16 and self.dtype == np.uint8:
+            return np.uint8((image.astype(np.uint32) + 128) // 257)
+        if image.dtype == np.uint8 and self.dtype == np.uint16:
+            return image.astype(np.uint16) * 257
+        return np.uint8(np.clip(image, 0, 1) * 255 + 0.5) if self.dtype == np.uint8 \
+            else np.uint16(np.clip(image, 0, 1) * 65535 + 0.5)
+
+    def encode(self, image: np.ndarray, file_path: str = None) -> bytes:
+        r""" Encode an image.
+
+        Args:
+            image (np.ndarray): Image in OpenCV format (H*W*C, BGR).
+            file_path (optional, str): Also save the encoded image to this path. (Default: ``None``).
+
+        Returns:
+            Encoded image.
+        """
+        with STAGE_SECONDS.time(stage="encode"):
+            success, buffer = cv2.imencode(self.format, self.convert(image), self.params)
+        if not success:
+            raise RuntimeError(f"Encoding `{self.format}` failed.")
+        stream = buffer.tobytes()
+
+        if file_path is not None:
+            with open(file_path, "wb") as f:
+                f.write(stream)
+        return stream
@@ -11,9 +11,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import hashlib
 import logging
 import os
+import threading
 import warnings
+import weakref
+from collections import OrderedDict
 
 import cv2
 import numpy as np
@@ -22,42 +26,315 @@ from PIL import Image
 from qcloud_cos import CosConfig
 from qcloud_cos import CosS3Client
 from ssrgan.dataset import check_image_file
+from ssrgan.utils import receptive_field_halo
 from ssrgan.utils import select_device
-from torchvision import transforms
 
+from metrics import CACHE
+from metrics import CACHE_BYTES_SAVED
+from metrics import MACS
+from metrics import STAGE_SECONDS
+from metrics import TILES
 from model import bionet
+from router import ComplexityRouter
+from router import macs_per_pixel
+from slide import SlideReader
+from slide import SlideWriter
+from tissue import TissueDetector
+from tiler import Canvas
+from tiler import Tiler
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
 
-# Image resolution. [width, height, width block num, height block num]
-resolution_dict = {
-    "240p": [320, 240, 4, 3],
-    "360p": [480, 360, 8, 6],
-    "720p": [1080, 720, 12, 9],
-    "1080p": [1920, 1080, 2, 2],  # Only support it is.
-    "2k": [2560, 1440, 20, 15],
-    "4k": [4096, 2160, 32, 20],
-    "8k": [7680, 4320, 60, 30]
-}
+# Peak memory of one tile, keyed by model class, tile shape and device.
+tile_memory_cache = {}
+# Seam-free overlap of the super-resolution tiles, keyed by model instance.
+over_length_cache = weakref.WeakKeyDictionary()
+
+
+def select_over_length(model: torch.nn.Module, upscale_factor: int = 4) -> int:
+    r""" Smallest overlap that hides the tile seams of a model.
+
+    Neighbouring tiles overlap by twice the receptive field halo, so every output pixel lies at least
+    one halo away from the border of one of the tiles that cover it.
+
+    Args:
+        model (torch.nn.Module): Super-resolution model with its weights loaded.
+        upscale_factor (optional, int): Low to high resolution scaling factor. (Default: 4).
+
+    Returns:
+        Edge overlap length of the super-resolution tiles.
+    """
+    if model not in over_length_cache:
+        halo = receptive_field_halo(model, device=next(model.parameters()).device)
+        over_length_cache[model] = 2 * halo * upscale_factor
+        logger.info(f"`{model.__class__.__name__}` halo is {halo} pixels, "
+                    f"edge overlap length is {over_length_cache[model]}.")
+    return over_length_cache[model]
+
+
+def tile_memory(model: torch.nn.Module, height: int, width: int, device: torch.device) -> int:
+    r""" Measure the peak memory one low-resolution tile needs in a forward pass.
+
+    On CUDA the peak allocation of a probe forward is measured. On CPU the peak is estimated as three times
+    the largest activation, which covers the input, the output and the live skip connection of the blocks.
+
+    Args:
+        model (torch.nn.Module): Super-resolution model.
+        height (int): Height of the low-resolution tile.
+        width (int): Width of the low-resolution tile.
+        device (torch.device): CPU or GPU.
+
+    Returns:
+        Bytes per tile.
+    """
+    key = (model.__class__.__name__, height, width, str(device))
+    if key in tile_memory_cache:
+        return tile_memory_cache[key]
+
+    lr = torch.zeros(1, 3, height, width, device=device)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        baseline = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        with torch.no_grad():
+            model(lr)
+        torch.cuda.synchronize(device)
+        memory = torch.cuda.max_memory_allocated(device) - baseline
+    else:
+        activations = []
+
+        def hook(module, input, output):
+            if isinstance(output, torch.Tensor):
+                activations.append(output.element_size() * output.nelement())
+
+        handles = [module.register_forward_hook(hook) for module in model.modules()]
+        with torch.no_grad():
+            model(lr)
+        for handle in handles:
+            handle.remove()
+        memory = 3 * max(activations)
+
+    tile_memory_cache[key] = max(int(memory), 1)
+    return tile_memory_cache[key]
+
+
+def select_batch_size(model: torch.nn.Module, height: int, width: int, device: torch.device,
+                      memory_budget: int = None) -> int:
+    r""" Choose how many tiles of one shape are run through the model together.
+
+    Args:
+        model (torch.nn.Module): Super-resolution model.
+        height (int): Height of the low-resolution tile.
+        width (int): Width of the low-resolution tile.
+        device (torch.device): CPU or GPU.
+        memory_budget (optional, int): Bytes available for activations. Half of the free CUDA memory
+            or 1GB on CPU. (Default: ``None``).
+
+    Returns:
+        Batch size, at least 1.
+    """
+    if memory_budget is None:
+        memory_budget = torch.cuda.mem_get_info(device)[0] // 2 if device.type == "cuda" else 1 << 30
+    return max(memory_budget // tile_memory(model, height, width, device), 1)
+
+
+# Fingerprint of the model weights, keyed by model instance.
+fingerprint_cache = weakref.WeakKeyDictionary()
+
+
+def model_fingerprint(model: torch.nn.Module) -> str:
+    r""" Identity of a model, the same architecture with the same weights gives the same fingerprint.
+
+    Args:
+        model (torch.nn.Module): Super-resolution model.
+    """
+    if model not in fingerprint_cache:
+        digest = hashlib.blake2b(repr(model).encode(), digest_size=16)
+        for name, tensor in model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        fingerprint_cache[model] = digest.hexdigest()
+    return fingerprint_cache[model]
+
+
+class TileCache(object):
+    r""" Super-resolution tiles keyed by the content of the low-resolution tile and the model identity.
+
+    The most recently used tiles are kept in memory within `memory_budget`, the evicted ones are spilled
+    to `spill_dir` if it is set, which is bounded by `spill_budget` in the same way. The spill directory belongs to
+    one cache, processes sharing it would remove the files of each other.
+
+    Examples:
+        >>> cache = TileCache(memory_budget=512 << 20, spill_dir="static/cache")
+        >>> SR(filename, model, device, cache=cache).run()
+        >>> cache.stats()
+    """
+
+    def __init__(self, memory_budget: int = 512 << 20, spill_dir: str = None, spill_budget: int = 4 << 30,
+                 name: str = "tiles") -> None:
+        r"""
+        Args:
+            memory_budget (optional, int): Bytes of tiles kept in memory. (Default: 512MB).
+            spill_dir (optional, str): Directory of the on-disk tier, disabled if ``None``. (Default: ``None``).
+            spill_budget (optional, int): Bytes of tiles kept on disk. (Default: 4GB).
+            name (optional, str): Label of the cache in the metrics. (Default: ``tiles``).
+        """
+        self.name = name
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self.spill_budget = spill_budget
+        self.lock = threading.Lock()
+
+        self.entries = OrderedDict()  # Key to tile, least recently used first.
+        self.memory_bytes = 0
+        self.spilled = OrderedDict()  # Key to file size, least recently used first.
+        self.spill_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            # Tiles spilled by an earlier run are reused, oldest first.
+            files = [os.path.join(spill_dir, filename) for filename in os.listdir(spill_dir)
+                     if filename.endswith(".npy")]
+            for file in sorted(files, key=os.path.getmtime):
+                self.spilled[os.path.basename(file)[:-4]] = os.path.getsize(file)
+                self.spill_bytes += self.spilled[os.path.basename(file)[:-4]]
+
+    @staticmethod
+    def key(lr: torch.Tensor, fingerprint: str) -> str:
+        r""" Cache key of a low-resolution tile.
+
+        Args:
+            lr (torch.Tensor): Low-resolution tile (C*H*W).
+            fingerprint (str): Fingerprint of the model, see `model_fingerprint`.
+        """
+        digest = hashlib.blake2b(fingerprint.encode(), digest_size=20)
+        digest.update(str(tuple(lr.shape)).encode())
+        digest.update(lr.contiguous().numpy().tobytes())
+        return digest.hexdigest()
+
+    def spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, f"{key}.npy")
+
+    def get(self, key: str):
+        r""" Look a tile up, a tile found on disk is moved back to memory.
+
+        Returns:
+            Super-resolution tile (H*W*C, float32) or ``None``. The tile is shared, copy it before modifying it.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                value = self.entries[key]
+            elif key in self.spilled:
+                self.spill_bytes -= self.spilled.pop(key)
+                try:
+                    value = np.load(self.spill_path(key))
+                    os.remove(self.spill_path(key))
+                except (OSError, ValueError):
+                    # A file removed or torn behind the back of the cache is a miss.
+                    self.misses += 1
+                    CACHE.inc(cache=self.name, result="miss")
+                    return None
+                self.insert(key, value)
+            else:
+                self.misses += 1
+                CACHE.inc(cache=self.name, result="miss")
+                return None
+
+            self.count(value)
+            return value
+
+    def count_hit(self, value: np.ndarray) -> None:
+        r""" Count a tile reused without going through the cache, e.g. a repeated tile of the same image."""
+        with self.lock:
+            self.count(value)
+
+    def count(self, value: np.ndarray) -> None:
+        self.hits += 1
+        self.bytes_saved += value.nbytes
+        CACHE.inc(cache=self.name, result="hit")
+        CACHE_BYTES_SAVED.inc(value.nbytes, cache=self.name)
+
+    def put(self, key: str, value: np.ndarray) -> None:
+        r""" Add a tile, it must not be modified afterwards.
+
+        Args:
+            key (str): Cache key returned by `key`.
+            value (np.ndarray): Super-resolution tile (H*W*C, float32).
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.insert(key, value)
+
+    def insert(self, key: str, value: np.ndarray) -> None:
+        self.entries[key] = value
+        self.memory_bytes += value.nbytes
+
+        # Evict the least recently used tiles, to disk if there is a spill tier.
+        while self.memory_bytes > self.memory_budget and self.entries:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+            if self.spill_dir is not None:
+                np.save(self.spill_path(evicted_key), evicted)
+                self.spilled[evicted_key] = os.path.getsize(self.spill_path(evicted_key))
+                self.spill_bytes += self.spilled[evicted_key]
+
+        while self.spill_bytes > self.spill_budget and self.spilled:
+            evicted_key, size = self.spilled.popitem(last=False)
+            self.spill_bytes -= size
+            if os.path.exists(self.spill_path(evicted_key)):
+                os.remove(self.spill_path(evicted_key))
+
+    def stats(self) -> dict:
+        r""" Counters of the cache.
+
+        Returns:
+            Hits, misses, bytes saved and the bytes held in memory and on disk.
+        """
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved,
+                    "memory_bytes": self.memory_bytes, "memory_tiles": len(self.entries),
+                    "spill_bytes": self.spill_bytes, "spill_tiles": len(self.spilled)}
+
+
+class Bicubic(torch.nn.Module):
+    r""" Bicubic upsampling, the cheap stand-in for the generator on tiles that do not need it."""
+
+    def __init__(self, upscale_factor: int = 4) -> None:
+        super(Bicubic, self).__init__()
+        self.upscale_factor = upscale_factor
+
+    def forward(self, input: torch.Tensor) -> torch.Tensor:
+        return torch.nn.functional.interpolate(input, scale_factor=self.upscale_factor, mode="bicubic",
+                                               align_corners=False)
+
+    def extra_repr(self) -> str:
+        return f"upscale_factor={self.upscale_factor}"
 
 
 class Inference(object):
-    def __init__(self, args, resolution_ratio: str = "1080p"):
+    def __init__(self, args):
         self.file_path = args.input
         self.model_path = args.model
         self.device_id = args.device
-        self.resolution_ratio = resolution_ratio
-        self.over_length = 128  # Edge overlap length.
-        self.ratio = 0.05  # Fusion calculation weight parameters.
+        self.tile_size = args.tile_size
+        self.whole_slide = args.whole_slide
+        self.box = tuple(int(value) for value in args.box.split(",")) if args.box else None
+        self.tissue_detector = TissueDetector() if args.skip_background else None
+        self.output = args.output
+        self.over_length = args.over_length  # Edge overlap length, derived from the model if not set.
 
         logger.info(f"Inference engine information:\n"
                     f"\tImage path is `{os.getcwd()}/{self.file_path}`\n"
                     f"\tModel path is `{os.getcwd()}/{self.model_path}`\n"
                     f"\tDevice id is `{self.device_id}`\n"
-                    f"\tResolution ratio is `{self.resolution_ratio}`\n"
-                    f"\tEdge overlap length is {int(self.over_length)}\n"
-                    f"\tEdge overlap length is {float(self.ratio)}")
+                    f"\tTile size is {int(self.tile_size)}\n"
+                    f"\tEdge overlap length is {self.over_length or 'auto'}")
 
         # Model of configuration super-resolution algorithm.
         self.device = select_device(self.device_id)
@@ -68,265 +345,661 @@ class Inference(object):
         logger.info(f"Set model to eval mode.")
         self.model.eval()
 
-    def inference(self, model: torch.nn.Module, device: torch.device):
+    def run(self):
+        if self.whole_slide:
+            output = self.output or f"sr_{os.path.basename(self.file_path).split('.')[0]}.npy"
+            WholeSlideSR(self.file_path, output, self.model, self.device, self.tile_size, self.over_length,
+                         tissue_detector=self.tissue_detector).run()
+            return
+
+        if self.box is not None:
+            sr = RegionSR(self.file_path, self.box, self.model, self.device, self.tile_size, self.over_length).run()
+            cv2.imwrite(self.output or f"sr_{os.path.basename(self.file_path).split('.')[0]}_roi.png", sr)
+            return
+
+        sr = SR(self.file_path, self.model, self.device, self.tile_size, self.over_length,
+                tissue_detector=self.tissue_detector).run()
+        cv2.imwrite(self.output or f"sr_{os.path.basename(self.file_path).split('.')[0]}.png", sr)
+
+
+class SR(object):
+    def __init__(self, filename: str, model: torch.nn.Module, device: torch.device, tile_size=512,
+                 over_length: int = None, ratio: float = None, upscale_factor: int = 4,
+                 batch_size: int = None, memory_budget: int = None, tissue_detector: TissueDetector = None,
+                 cache: TileCache = None, batcher=None, router: ComplexityRouter = None):
+        self.filename = filename
+        self.model = model
+        self.device = device
+        # Tissue tiles are sent to the model of their texture score, `model` if there is no router.
+        self.router = router
+        if over_length is None:
+            # The overlap hides the seams of every model a tile may go through.
+            models = [model] + [module for module in (router.models.values() if router else []) if module is not None]
+            over_length = max(select_over_length(module, upscale_factor) for module in models)
+        self.tiler = Tiler(tile_size, over_length, ratio, upscale_factor)
+        self.batch_size = batch_size  # Tiles per forward pass, chosen from `memory_budget` if not set.
+        self.memory_budget = memory_budget
+        # Background tiles are upsampled with bicubic instead of the model.
+        self.tissue_detector = tissue_detector
+        self.bicubic = Bicubic(upscale_factor)
+        self.num_tiles = 0
+        self.num_skipped = 0
+        # Tiles already super-resolved, by this or an earlier request.
+        self.cache = cache
+        # Tiles of the model are batched with the tiles of concurrent requests.
+        self.batcher = batcher
+        if batcher is not None:
+            self.batch_size = batch_size or batcher.max_batch_size
+        self.num_routed = OrderedDict((name, 0) for name in (router.names if router else []))
+        self.macs = 0.
+        self.full_macs = 0.
+
+    @property
+    def skip_ratio(self) -> float:
+        return self.num_skipped / max(self.num_tiles, 1)
+
+    @property
+    def compute_saved(self) -> float:
+        r""" Share of the multiply-accumulates the router saved on the tissue tiles."""
+        return 1 - self.macs / self.full_macs if self.full_macs else 0.
+
+    def inference(self) -> Canvas:
         r""" Super-resolution of low resolution image.
 
-        Args:
-            model (torch.nn.Module): Base class for all neural network modules..
-            device (torch.device): CPU or GPU.
+        The image is processed at its own resolution, split into an N*M grid of overlapping tiles,
+        and every super-resolution tile is blended straight into the canvas.
+
+        Returns:
+            Canvas holding the weighted sum of all super-resolution tiles.
         """
         # Step 1: Read image.
-        image = Image.open(self.file_path)
+        with STAGE_SECONDS.time(stage="load"):
+            image = self.load()
+        height, width = image.shape[:2]
+        # Numpy image format convert to Tensor format.
+        lr_image = self.to_tensor(image)
 
-        # Step 2: Check whether the image resolution meets the standard.
-        width, height = image.image_size
-        correct_width, correct_height, width_blocks, height_blocks = resolution_dict[self.resolution_ratio]
+        # Step 2: Allocate the output canvas of the whole image.
+        canvas = self.tiler.canvas(width, height)
 
-        if image.image_size[0] != correct_width or image.image_size[1] != correct_height:
-            warnings.warn("Current image resolution is not supported! Auto adjust...")
-            image = image.resize((correct_width, correct_height))
-            width, height = image.image_size
-
-        # Step 3: Get low-resolution image area.
-        lr_patch_width_size, lr_patch_height_size = int(width // width_blocks), int(height // height_blocks)
+        # Step 3: Find the tissue on a thumbnail.
+        mask = None
+        if self.tissue_detector is not None:
+            with STAGE_SECONDS.time(stage="tissue"):
+                mask = self.tissue_detector.mask(TissueDetector.thumbnail(image, self.tissue_detector.thumbnail_size))
 
         # Step 4: The low resolution sub regions are processed in turn.
-        for w in range(width_blocks):
-            for h in range(height_blocks):
-                # Step 5: Get the sub block image area of low-resolution image.
-                lr_box = (lr_patch_width_size * w, lr_patch_height_size * h,
-                          lr_patch_width_size * (w + 1), lr_patch_height_size * (h + 1))
-                # Step 6: Crop specified area.
-                region = image.crop(lr_box)
-                # PIL image format convert to Tensor format.
-                lr = transforms.ToTensor()(region).unsqueeze(0).to(device)
-                with torch.no_grad():
-                    sr = model(lr)
-                # Step 7: Save the image area after super-resolution.
-                sr = sr.cpu().squeeze()
-                sr = sr.mul_(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).type(torch.uint8).numpy()
-                sr = Image.fromarray(sr)
-                sr.save(f"tmp_{w}_{h}.png")
-
-    def fusion(self, src: str, dst: str, left_right: bool = True):
-        # Step 1:
-        img1 = cv2.imread(src, cv2.COLOR_BGR2RGB)
-        img2 = cv2.imread(dst, cv2.COLOR_BGR2RGB)
-
-        img1 = (img1 - img1.min()) / img1.ptp()
-        img2 = (img2 - img2.min()) / img2.ptp()
-
-        # H*W*C for OpenCV. W*H for Pillow.
-        height, width, channels = img1.shape
-
-        # Calculate the image edge weight when splicing.
-        weight = 1 / (1 + np.exp(-self.ratio * np.arange(-self.over_length / 2, self.over_length / 2)))
-
-        if left_right:  # Left and right integrated.
-            # Create new white image.
-            image = np.zeros((height, 2 * width - self.over_length, 3))
-
-            # Get the weight of the image edge.
-            edge_weight = np.tile(weight, (height, 1))
-
-            # The RGB channel is processed in turn.
-            for c in range(channels):
-                # Copy the left and right parts of the image to the new image.
-                image[:, :width, c] = img1[:, :, c]
-                image[:, width:, c] = img2[:, self.over_length:, c]
-
-                # The fusion region image of two images is obtained.
-                src_fusion = (1 - edge_weight) * img1[:, width - self.over_length:width, c]
-                dst_fusion = edge_weight * img2[:, :self.over_length, c]
-                image[:, width - self.over_length: width, c] = src_fusion + dst_fusion
-
-        else:  # Down and up integrated.
-            # Create new white image.
-            image = np.zeros((2 * height - self.over_length, width, 3))
-
-            # Get the weight of the image edge.
-            weight = np.reshape(weight, (self.over_length, 1))
-            edge_weight = np.tile(weight, (1, width))
-
-            # The RGB channel is processed in turn.
-            for c in range(channels):
-                # Copy the upper and lower parts of the image to the new image.
-                image[:height:, :, c] = img1[:, :, c]
-                image[height:, :, c] = img2[self.over_length:, :, c]
-
-                # The fusion region image of two images is obtained.
-                src_fusion = (1 - edge_weight) * img1[height - self.over_length:height, :, c]
-                dst_fusion = edge_weight * img2[:self.over_length, :, c]
-                image[height - self.over_length:height, :, c] = src_fusion + dst_fusion
-
-        return np.uint16(image * 65535)
+        self.route(lr_image, self.tiler.tiles(width, height), canvas, mask, width, height)
+        self.report()
 
-    def run(self):
+        return canvas
+
+    def load(self) -> np.ndarray:
+        r""" Low-resolution image, `filename` may also be an image decoded beforehand.
+
+        Returns:
+            RGB image of shape H*W*3 (uint8).
+        """
+        if isinstance(self.filename, np.ndarray):
+            return self.filename
+        return np.asarray(Image.open(self.filename).convert("RGB"))
+
+    @staticmethod
+    def to_tensor(image: np.ndarray) -> torch.Tensor:
+        r""" View of an image as a tensor, without a copy.
+
+        Unlike `transforms.ToTensor`, the image stays uint8, only the tiles are converted to float when batched.
+
+        Args:
+            image (np.ndarray): RGB image of shape H*W*3 (uint8), it may be read-only.
+
+        Returns:
+            Low-resolution image (C*H*W) of uint8.
+        """
+        with warnings.catch_warnings():
+            # The tensor is only read, a read-only buffer from the request is used as is.
+            warnings.simplefilter("ignore", UserWarning)
+            return torch.from_numpy(image).permute(2, 0, 1)
+
+    def route(self, lr_image: torch.Tensor, tiles: list, canvas: Canvas, mask: np.ndarray, width: int, height: int,
+              top: int = 0) -> None:
+        r""" Process tissue tiles with the model and background tiles with bicubic upsampling.
+
+        Args:
+            lr_image (torch.Tensor): Low-resolution image (C*H*W) of uint8.
+            tiles (list): Tiles returned by `Tiler.tiles`.
+            canvas (Canvas): Canvas the tiles are blended into.
+            mask (np.ndarray): Tissue mask of the whole image, every tile is tissue if ``None``.
+            width (int): Width of the low-resolution image.
+            height (int): Height of the low-resolution image.
+            top (optional, int): Low-resolution row of the first row of `lr_image`. (Default: 0).
+        """
+        tissue = [True] * len(tiles) if mask is None else self.tissue_detector.classify(mask, tiles, width, height)
+        background = [tile for tile, is_tissue in zip(tiles, tissue) if not is_tissue]
+
+        tissue = [tile for tile, is_tissue in zip(tiles, tissue) if is_tissue]
+        if self.router is None:
+            self.process(lr_image, tissue, canvas, top)
+        else:
+            self.dispatch(lr_image, tissue, canvas, top)
+        self.process(lr_image, background, canvas, top, self.bicubic)
+
+        self.num_tiles += len(tiles)
+        self.num_skipped += len(background)
+
+    def dispatch(self, lr_image: torch.Tensor, tiles: list, canvas: Canvas, top: int = 0) -> None:
+        r""" Process every tile with the model the router chooses for its texture.
+
+        Args:
+            lr_image (torch.Tensor): Low-resolution image (C*H*W) of uint8.
+            tiles (list): Tiles returned by `Tiler.tiles`.
+            canvas (Canvas): Canvas the tiles are blended into.
+            top (optional, int): Low-resolution row of the first row of `lr_image`. (Default: 0).
+        """
+        with STAGE_SECONDS.time(stage="route"):
+            routes = self.router.classify(lr_image, tiles, top)
+        models = [module or self.bicubic for module in self.router.models.values()]
+        full = macs_per_pixel(models[-1])
+
+        for index, (name, model) in enumerate(zip(self.router.names, models)):
+            routed = [tile for tile, route in zip(tiles, routes) if route == index]
+            if not routed:
+                continue
+            self.process(lr_image, routed, canvas, top, model, name)
+
+            pixels = sum((tile.box[2] - tile.box[0]) * (tile.box[3] - tile.box[1]) for tile in routed)
+            self.num_routed[name] += len(routed)
+            self.macs += pixels * macs_per_pixel(model)
+            self.full_macs += pixels * full
+            MACS.inc(pixels * macs_per_pixel(model), kind="used")
+            MACS.inc(pixels * full, kind="full")
+
+    def report(self) -> None:
+        if self.tissue_detector is not None:
+            logger.info(f"Skipped {self.num_skipped}/{self.num_tiles} background tiles "
+                        f"({self.skip_ratio * 100:.1f}%).")
+        if self.router is not None:
+            routed = ", ".join(f"{name} {count}" for name, count in self.num_routed.items())
+            logger.info(f"Routed tiles: {routed}, saved {self.compute_saved * 100:.1f}% of "
+                        f"{self.full_macs / 1e9:.1f} GMACs.")
+
+    def process(self, lr_image: torch.Tensor, tiles: list, canvas: Canvas, top: int = 0,
+                model: torch.nn.Module = None, route: str = None) -> None:
+        r""" Run tiles through the model in batches and blend them into the canvas.
+
+        Args:
+            lr_image (torch.Tensor): Low-resolution image (C*H*W) of uint8.
+            tiles (list): Tiles returned by `Tiler.tiles`.
+            canvas (Canvas): Canvas the tiles are blended into.
+            top (optional, int): Low-resolution row of the first row of `lr_image`. (Default: 0).
+            model (optional, torch.nn.Module): Model the tiles go through. (Default: `self.model`).
+            route (optional, str): Label of the tiles in the metrics. (Default: ``None``, `bicubic` or `model`).
+        """
+        model = model or self.model
+        forward = self.batcher if self.batcher is not None and model is self.model else model
+        route = route or ("bicubic" if model is self.bicubic else "model")
+        # Bicubic tiles cost less to compute again than to hash and look up, and would push the tiles of the
+        # generators out of the cache.
+        cache = self.cache if model is not self.bicubic else None
+
+        # Cached tiles are blended right away, and tiles with the same content only run once.
+        duplicates = {}
+        if cache is not None:
+            duplicates = self.lookup(lr_image, tiles, canvas, top, model)
+            tiles = [same[0] for same in duplicates.values()]
+            keys = {same[0]: key for key, same in duplicates.items()}
+
+        # Tiles of the same shape are processed in batches.
+        for (tile_height, tile_width), tiles in self.group(tiles).items():
+            batch_size = self.batch_size or select_batch_size(model, tile_height, tile_width, self.device,
+                                                              self.memory_budget)
+            for index in range(0, len(tiles), batch_size):
+                batch = tiles[index:index + batch_size]
+                # Crop specified area.
+                lr = torch.stack([self.crop(lr_image, tile, top) for tile in batch]).float().div_(255)
+                with STAGE_SECONDS.time(stage=route), torch.no_grad():
+                    sr = forward(lr.to(self.device))
+                    sr = sr.clamp_(0, 1).permute(0, 2, 3, 1).cpu().numpy()
+                TILES.inc(len(batch), route=route)
+                # Scatter the image areas after super-resolution back to their grid positions.
+                with STAGE_SECONDS.time(stage="blend"):
+                    for tile, sr_tile in zip(batch, sr):
+                        if cache is not None:
+                            key = keys[tile]
+                            cache.put(key, sr_tile.copy())
+                            for duplicate in duplicates[key][1:]:
+                                cache.count_hit(sr_tile)
+                                TILES.inc(route="cache")
+                                self.tiler.blend(canvas, duplicate, sr_tile.copy())
+                        self.tiler.blend(canvas, tile, sr_tile)
+
+    @staticmethod
+    def crop(lr_image: torch.Tensor, tile, top: int = 0) -> torch.Tensor:
+        r""" Low-resolution area of a tile, `lr_image` starts at row `top`."""
+        left, upper, right, lower = tile.box
+        return lr_image[:, upper - top:lower - top, left:right]
+
+    def lookup(self, lr_image: torch.Tensor, tiles: list, canvas: Canvas, top: int,
+               model: torch.nn.Module) -> OrderedDict:
+        r""" Blend the tiles found in the cache.
+
+        Args:
+            lr_image (torch.Tensor): Low-resolution image (C*H*W) of uint8.
+            tiles (list): Tiles returned by `Tiler.tiles`.
+            canvas (Canvas): Canvas the tiles are blended into.
+            top (int): Low-resolution row of the first row of `lr_image`.
+            model (torch.nn.Module): Model the tiles go through.
+
+        Returns:
+            Cache key to the missing tiles with that content.
+        """
+        fingerprint = model_fingerprint(model)
+        missing = OrderedDict()
+        for tile in tiles:
+            key = TileCache.key(self.crop(lr_image, tile, top), fingerprint)
+            if key in missing:
+                missing[key].append(tile)
+                continue
+            sr = self.cache.get(key)
+            if sr is not None:
+                TILES.inc(route="cache")
+                self.tiler.blend(canvas, tile, sr.copy())
+            else:
+                missing[key] = [tile]
+        return missing
+
+    @staticmethod
+    def group(tiles: list) -> OrderedDict:
+        r""" Group tiles by their low-resolution shape (height, width).
+
+        Args:
+            tiles (list): Tiles returned by `Tiler.tiles`.
+        """
+        groups = OrderedDict()
+        for tile in tiles:
+            left, upper, right, lower = tile.box
+            groups.setdefault((lower - upper, right - left), []).append(tile)
+        return groups
+
+    @staticmethod
+    def fusion(canvas: Canvas, bit_depth: int = 16) -> np.ndarray:
+        r""" Normalize the overlapping areas of the canvas.
+
+        Args:
+            canvas (Canvas): Canvas returned by `inference`.
+            bit_depth (optional, int): Bits per channel of the image, 8 or 16. (Default: 16).
+
+        Returns:
+            Super-resolution image in OpenCV format (H*W*C, BGR, uint8 or uint16).
+        """
+        image = canvas.normalize()
+        if bit_depth == 8:
+            return np.uint8(image[:, :, ::-1] * 255 + 0.5)
+        return np.uint16(image[:, :, ::-1] * 65535)
+
+    def run(self, bit_depth: int = 16):
+        r""" Super-resolution of the image.
+
+        Args:
+            bit_depth (optional, int): Bits per channel of the image, 8 or 16. (Default: 16).
+
+        Returns:
+            Super-resolution image in OpenCV format (H*W*C, BGR).
+        """
         # Super resolution image generation.
-        self.inference(self.model, self.device)
+        canvas = self.inference()
 
         logger.info("Staring fusion image...")
-        # Merge the two upper image above.
-        cv2.imwrite("tmp1.png", self.fusion("tmp_0_0.png", "tmp_1_0.png", left_right=True))
-        # Merge the two downer image above.
-        cv2.imwrite("tmp2.png", self.fusion("tmp_0_1.png", "tmp_1_1.png", left_right=True))
-        # Merge the two upper-downer above.
-        cv2.imwrite(f"sr_{os.path.basename(self.file_path).split('.')[0]}.png",
-                    self.fusion("tmp1.png", "tmp2.png", left_right=False))
+        with STAGE_SECONDS.time(stage="fusion"):
+            return self.fusion(canvas, bit_depth)
 
-        logger.info(f"Cleaning temp image...")
-        files = os.listdir(".")
-        for _, filename in enumerate(files):
-            if filename.find("tmp") >= 0:
-                os.remove(filename)
 
+class ProgressiveSR(SR):
+    r""" Super-resolution that shows a bicubic preview at once and refines it tile by tile.
 
-class SR(object):
-    def __init__(self, filename: str, model: torch.nn.Module, device: torch.device, resolution_ratio: str = "1080p"):
-        self.filename = filename
-        self.model = model
-        self.device = device
-        self.resolution_ratio = resolution_ratio
-        self.over_length = 128  # Edge overlap length.
-        self.ratio = 0.05  # Fusion calculation weight parameters.
+    The first update is the bicubic upscale of the whole image. Every later update is the area of a finished tile,
+    blended with the tiles finished before it, so a client pasting the updates in turn ends with the same image as
+    `SR.run`. The tiles nearest to the centre of the image, or of a viewport, are refined first.
+
+    Examples:
+        >>> for (left, upper), sr in ProgressiveSR(image, model, device, viewport=(0, 0, 256, 256)).updates():
+        ...     view[upper:upper + sr.shape[0], left:left + sr.shape[1]] = sr
+    """
+
+    orders = ("centre", "viewport", "grid")
+
+    def __init__(self, filename: str, model: torch.nn.Module, device: torch.device, tile_size=512,
+                 over_length: int = None, ratio: float = None, upscale_factor: int = 4,
+                 batch_size: int = None, memory_budget: int = None, tissue_detector: TissueDetector = None,
+                 cache: TileCache = None, batcher=None, order: str = "centre", viewport: tuple = None,
+                 tiles_per_update: int = 1):
+        r"""
+        Args:
+            order (optional, str): Order of the tiles, `centre`, `viewport` or row-major `grid`. (Default: `centre`).
+            viewport (optional, tuple): Low-resolution area (left, upper, right, lower) refined first, it implies
+                the `viewport` order. (Default: ``None``).
+            tiles_per_update (optional, int): Tiles run together before an update, more raises the throughput and
+                the time to the first refined tile. (Default: 1).
+        """
+        super(ProgressiveSR, self).__init__(filename, model, device, tile_size, over_length, ratio, upscale_factor,
+                                            batch_size, memory_budget, tissue_detector, cache, batcher)
+        if viewport is not None:
+            order = "viewport"
+        if order not in self.orders:
+            raise ValueError(f"Unknown order `{order}`, expected one of {self.orders}.")
+        if order == "viewport" and viewport is None:
+            raise ValueError("The `viewport` order needs a viewport.")
+        self.order = order
+        self.viewport = viewport
+        self.tiles_per_update = max(int(tiles_per_update), 1)
+
+    def rank(self, tiles: list, width: int, height: int) -> list:
+        r""" Tiles in the order they are refined.
+
+        Args:
+            tiles (list): Tiles returned by `Tiler.tiles`.
+            width (int): Width of the low-resolution image.
+            height (int): Height of the low-resolution image.
+        """
+        if self.order == "grid":
+            return list(tiles)
+
+        left, upper, right, lower = self.viewport if self.order == "viewport" else (0, 0, width, height)
+        x, y = (left + right) / 2, (upper + lower) / 2
+
+        def key(tile):
+            tile_left, tile_upper, tile_right, tile_lower = tile.box
+            # Tiles overlapping the viewport come first, then by the distance of their centres.
+            outside = tile_right <= left or tile_left >= right or tile_lower <= upper or tile_upper >= lower
+            distance = ((tile_left + tile_right) / 2 - x) ** 2 + ((tile_upper + tile_lower) / 2 - y) ** 2
+            return outside, distance
+
+        return sorted(tiles, key=key)
 
-    def inference(self):
-        r""" Super-resolution of low resolution image."""
+    def preview(self, lr_image: torch.Tensor) -> np.ndarray:
+        r""" Bicubic upscale of the whole image.
+
+        Args:
+            lr_image (torch.Tensor): Low-resolution image (C*H*W) of uint8.
+
+        Returns:
+            RGB image of shape H*W*3 (uint8).
+        """
+        with STAGE_SECONDS.time(stage="preview"), torch.no_grad():
+            sr = self.bicubic(lr_image.unsqueeze(0).float().div_(255)).clamp_(0, 1)
+            return np.uint8(sr[0].permute(1, 2, 0).numpy() * 255 + 0.5)
+
+    def updates(self):
+        r""" Progressive super-resolution of the image.
+
+        Returns:
+            Generator of `((left, upper), image)`, the super-resolution position and the RGB image (uint8) of every
+            update, the bicubic preview of the whole image first.
+        """
         # Step 1: Read image.
-        image = Image.open(self.filename)
+        with STAGE_SECONDS.time(stage="load"):
+            image = self.load()
+        height, width = image.shape[:2]
+        lr_image = self.to_tensor(image)
+
+        # Step 2: Show the bicubic preview before any tile is refined.
+        yield (0, 0), self.preview(lr_image)
+
+        # Step 3: Allocate the output canvas and find the tissue, as in `SR.inference`.
+        canvas = self.tiler.canvas(width, height)
+        mask = None
+        if self.tissue_detector is not None:
+            with STAGE_SECONDS.time(stage="tissue"):
+                mask = self.tissue_detector.mask(TissueDetector.thumbnail(image, self.tissue_detector.thumbnail_size))
+
+        # Step 4: Refine the tiles in turn, every update holds the blend of the tiles finished so far.
+        tiles = self.rank(self.tiler.tiles(width, height), width, height)
+        for index in range(0, len(tiles), self.tiles_per_update):
+            batch = tiles[index:index + self.tiles_per_update]
+            self.route(lr_image, batch, canvas, mask, width, height)
+            for tile in batch:
+                left, upper, right, lower = self.tiler.sr_box(tile)
+                sr = canvas.region(upper, left, lower - upper, right - left)
+                yield (left, upper), np.uint8(sr * 255 + 0.5)
+        self.report()
+
+    def run(self, bit_depth: int = 8):
+        r""" Super-resolution of the image, the updates pasted in turn.
 
-        # Step 2: Check whether the image resolution meets the standard.
-        width, height = image.image_size
-        correct_width, correct_height, width_blocks, height_blocks = resolution_dict[self.resolution_ratio]
+        Args:
+            bit_depth (optional, int): Bits per channel of the image, only 8 is supported. (Default: 8).
 
-        if image.image_size[0] != correct_width or image.image_size[1] != correct_height:
-            warnings.warn("Current image resolution is not supported! Auto adjust...")
-            image = image.resize((correct_width, correct_height))
-            width, height = image.image_size
+        Returns:
+            Super-resolution image in OpenCV format (H*W*C, BGR, uint8).
+        """
+        if bit_depth != 8:
+            raise ValueError("Progressive updates are 8 bits per channel.")
+        updates = self.updates()
+        _, image = next(updates)
+        for (left, upper), sr in updates:
+            image[upper:upper + sr.shape[0], left:left + sr.shape[1]] = sr
+        return np.ascontiguousarray(image[:, :, ::-1])
+
+
+class RegionSR(SR):
+    r""" Super-resolution of a region of interest, without processing the rest of the image.
+
+    The tiles follow the grid of the whole image, so the region is read with the tiles that cover it, which include
+    the receptive field halo of its border, and the result is the same area of the whole-image result. Overlapping
+    regions share their tiles, with a `cache` they are only super-resolved once.
+
+    Examples:
+        >>> sr = RegionSR("slide.npy", (1024, 2048, 1280, 2304), model, device, cache=cache).run()
+    """
+
+    def __init__(self, filename, box: tuple, model: torch.nn.Module, device: torch.device, tile_size=256,
+                 over_length: int = None, ratio: float = None, upscale_factor: int = 4,
+                 batch_size: int = None, memory_budget: int = None, cache: TileCache = None, batcher=None):
+        r"""
+        Args:
+            filename (str, np.ndarray or SlideReader): Low-resolution image, any format of `SlideReader`, `.npy` and
+                uncompressed `.tif` are memory-mapped so only the region is read.
+            box (tuple): Low-resolution region (left, upper, right, lower), clipped to the image.
+        """
+        super(RegionSR, self).__init__(filename, model, device, tile_size, over_length, ratio, upscale_factor,
+                                       batch_size, memory_budget, cache=cache, batcher=batcher)
+        self.box = tuple(int(value) for value in box)
 
-        # Step 3: Get low-resolution image area.
-        lr_patch_width_size, lr_patch_height_size = int(width // width_blocks), int(height // height_blocks)
+    def inference(self) -> tuple:
+        r""" Super-resolution of the tiles covering the region.
 
-        # Step 4: The low resolution sub regions are processed in turn.
-        for w in range(width_blocks):
-            for h in range(height_blocks):
-                # Step 5: Get the sub block image area of low-resolution image.
-                lr_box = (lr_patch_width_size * w, lr_patch_height_size * h,
-                          lr_patch_width_size * (w + 1), lr_patch_height_size * (h + 1))
-                # Step 6: Crop specified area.
-                region = image.crop(lr_box)
-                # PIL image format convert to Tensor format.
-                lr = transforms.ToTensor()(region).unsqueeze(0).to(self.device)
-                with torch.no_grad():
-                    sr = self.model(lr)
-                # Step 7: Save the image area after super-resolution.
-                sr = sr.cpu().squeeze()
-                sr = sr.mul_(255).add_(0.5).clamp_(0, 255).permute(1, 2, 0).type(torch.uint8).numpy()
-                sr = Image.fromarray(sr)
-                sr.save(f"tmp_{w}_{h}.png")
-
-    def fusion(self, src: str, dst: str, left_right: bool = True):
-        # Step 1:
-        img1 = cv2.imread(src, cv2.COLOR_BGR2RGB)
-        img2 = cv2.imread(dst, cv2.COLOR_BGR2RGB)
-
-        img1 = (img1 - img1.min()) / img1.ptp()
-        img2 = (img2 - img2.min()) / img2.ptp()
-
-        # H*W*C for OpenCV. W*H for Pillow.
-        height, width, channels = img1.shape
-
-        # Calculate the image edge weight when splicing.
-        weight = 1 / (1 + np.exp(-self.ratio * np.arange(-self.over_length / 2, self.over_length / 2)))
-
-        if left_right:  # Left and right integrated.
-            # Create new white image.
-            image = np.zeros((height, 2 * width - self.over_length, 3))
-
-            # Get the weight of the image edge.
-            edge_weight = np.tile(weight, (height, 1))
-
-            # The RGB channel is processed in turn.
-            for c in range(channels):
-                # Copy the left and right parts of the image to the new image.
-                image[:, :width, c] = img1[:, :, c]
-                image[:, width:, c] = img2[:, self.over_length:, c]
-
-                # The fusion region image of two images is obtained.
-                src_fusion = (1 - edge_weight) * img1[:, width - self.over_length:width, c]
-                dst_fusion = edge_weight * img2[:, :self.over_length, c]
-                image[:, width - self.over_length: width, c] = src_fusion + dst_fusion
-
-        else:  # Down and up integrated.
-            # Create new white image.
-            image = np.zeros((2 * height - self.over_length, width, 3))
-
-            # Get the weight of the image edge.
-            weight = np.reshape(weight, (self.over_length, 1))
-            edge_weight = np.tile(weight, (1, width))
-
-            # The RGB channel is processed in turn.
-            for c in range(channels):
-                # Copy the upper and lower parts of the image to the new image.
-                image[:height:, :, c] = img1[:, :, c]
-                image[height:, :, c] = img2[self.over_length:, :, c]
-
-                # The fusion region image of two images is obtained.
-                src_fusion = (1 - edge_weight) * img1[height - self.over_length:height, :, c]
-                dst_fusion = edge_weight * img2[:self.over_length, :, c]
-                image[height - self.over_length:height, :, c] = src_fusion + dst_fusion
-
-        os.remove(src)
-        os.remove(dst)
-
-        return np.uint16(image * 65535)
+        Returns:
+            Canvas of the tiles and its low-resolution area (left, upper, right, lower).
+        """
+        # Step 1: Open the image without decoding it, and clip the region.
+        reader = self.filename if isinstance(self.filename, SlideReader) else SlideReader(self.filename)
+        width, height = reader.size
+        left, upper, right, lower = self.box
+        left, upper, right, lower = max(left, 0), max(upper, 0), min(right, width), min(lower, height)
+        if left >= right or upper >= lower:
+            raise ValueError(f"Region {self.box} is outside of the {width}x{height} image.")
+        self.box = (left, upper, right, lower)
+
+        # Step 2: The tiles of the whole image grid that overlap the region.
+        tiles = [tile for tile in self.tiler.tiles(width, height)
+                 if tile.box[0] < right and tile.box[2] > left and tile.box[1] < lower and tile.box[3] > upper]
+        area = (min(tile.box[0] for tile in tiles), min(tile.box[1] for tile in tiles),
+                max(tile.box[2] for tile in tiles), max(tile.box[3] for tile in tiles))
+
+        # Step 3: Read the area of those tiles only.
+        with STAGE_SECONDS.time(stage="load"):
+            lr_image = self.to_tensor(reader.read_region(*area))
+
+        # Step 4: Process the tiles at their position in the area, their edges stay those of the whole grid.
+        tiles = [tile._replace(box=(tile.box[0] - area[0], tile.box[1] - area[1],
+                                    tile.box[2] - area[0], tile.box[3] - area[1])) for tile in tiles]
+        canvas = self.tiler.canvas(area[2] - area[0], area[3] - area[1])
+        self.route(lr_image, tiles, canvas, None, area[2] - area[0], area[3] - area[1])
+        return canvas, area
+
+    def run(self, bit_depth: int = 16):
+        r""" Super-resolution of the region.
 
-    def run(self):
-        # Super resolution image generation.
-        self.inference()
+        Args:
+            bit_depth (optional, int): Bits per channel of the image, 8 or 16. (Default: 16).
 
-        logger.info("Staring fusion image...")
-        # Merge the two upper image above.
-        cv2.imwrite("tmp1.png", self.fusion("tmp_0_0.png", "tmp_1_0.png", left_right=True))
-        # Merge the two downer image above.
-        cv2.imwrite("tmp2.png", self.fusion("tmp_0_1.png", "tmp_1_1.png", left_right=True))
-        # Merge the two upper-downer above.
+        Returns:
+            Super-resolution image of the region in OpenCV format (H*W*C, BGR).
+        """
+        canvas, area = self.inference()
+        with STAGE_SECONDS.time(stage="fusion"):
+            image = self.fusion(canvas, bit_depth)
+
+        upscale_factor = self.tiler.upscale_factor
+        left, upper, right, lower = [(value - offset) * upscale_factor
+                                     for value, offset in zip(self.box, area[:2] * 2)]
+        return np.ascontiguousarray(image[upper:lower, left:right])
+
+
+class WholeSlideSR(SR):
+    r""" Streaming super-resolution of slides that do not fit in memory.
 
-        return self.fusion("tmp1.png", "tmp2.png", left_right=False)
+    The slide is read one grid row at a time, and the finished output rows are written to a disk-backed
+    array, so the resident memory is bounded by the band height instead of the slide size.
+    """
+
+    def __init__(self, filename: str, output: str, model: torch.nn.Module, device: torch.device, tile_size=256,
+                 over_length: int = None, ratio: float = None, upscale_factor: int = 4,
+                 batch_size: int = None, memory_budget: int = None, tissue_detector: TissueDetector = None,
+                 cache: TileCache = None):
+        r"""
+        Args:
+            filename (str): Low-resolution slide, `.npy`, `.tif` or any PIL format.
+            output (str): Super-resolution slide, `.npy` or tiled `.tif`.
+        """
+        super(WholeSlideSR, self).__init__(filename, model, device, tile_size, over_length, ratio, upscale_factor,
+                                           batch_size, memory_budget, tissue_detector, cache)
+        self.output = output
+
+    def inference(self) -> str:
+        r""" Super-resolution of a whole slide, band by band.
+
+        Returns:
+            Super-resolution slide file name.
+        """
+        upscale_factor = self.tiler.upscale_factor
+
+        # Step 1: Open the slide without decoding it.
+        reader = SlideReader(self.filename)
+        width, height = reader.size
+        writer = SlideWriter(self.output, width * upscale_factor, height * upscale_factor)
+
+        # Step 2: Find the tissue on a thumbnail read band by band.
+        mask = None
+        if self.tissue_detector is not None:
+            mask = self.tissue_detector.mask(reader.thumbnail(self.tissue_detector.thumbnail_size))
+
+        # Step 3: Allocate the output band of one grid row.
+        canvas = self.tiler.band_canvas(width, height)
+        rows = OrderedDict()
+        for tile in self.tiler.tiles(width, height):
+            rows.setdefault(tile.row, []).append(tile)
+        tops = [tiles[0].box[1] for tiles in rows.values()] + [height]
+
+        # Step 4: Read one band, process its tiles and write the rows no later band touches.
+        for index, tiles in enumerate(rows.values()):
+            upper, lower = tiles[0].box[1], tiles[0].box[3]
+            with STAGE_SECONDS.time(stage="load"):
+                lr_image = self.to_tensor(reader.read(upper, lower))
+            self.route(lr_image, tiles, canvas, mask, width, height, upper)
+            self.tiler.add_row(canvas, tiles[0])
+
+            finished = (tops[index + 1] - upper) * upscale_factor
+            top = canvas.top
+            sr = canvas.flush(finished)
+            with STAGE_SECONDS.time(stage="write"):
+                writer.write(top, np.uint8(sr * 255 + 0.5))
+            logger.info(f"Finished {top + finished}/{height * upscale_factor} rows.")
+
+        self.report()
+        return writer.close()
+
+    def run(self):
+        return self.inference()
 
 
 class COS(object):
-    def __init__(self):
+    def __init__(self, client=None, bucket: str = None):
+        r"""
+        Args:
+            client (optional): COS client, e.g. `LocalCosS3Client` to run offline. (Default: ``None``, Tencent COS).
+            bucket (str, optional): Bucket storage name. (Default: ``None``, `self.Bucket`).
+        """
         self.Region = "Your Region"
         self.SecretId = "Your SecretId"
         self.SecretKey = "Your SecretKey"
         self.Scheme = "https"
-        self.Bucket = "Your Bucket"
+        self.Bucket = "Your Bucket" if bucket is None else bucket
 
-        self.config = CosConfig(Region=self.Region,
-                                SecretId=self.SecretId,
-                                SecretKey=self.SecretKey,
-                                Scheme=self.Scheme)
-        self.client = CosS3Client(self.config)
+        if client is None:
+            self.config = CosConfig(Region=self.Region,
+                                    SecretId=self.SecretId,
+                                    SecretKey=self.SecretKey,
+                                    Scheme=self.Scheme)
+            client = CosS3Client(self.config)
+        self.client = client
 
-    def get_all_urls(self):
-        client = self.client  # init client API.
-        Bucket = self.Bucket
-        url_lists = []  # Save all url address.
-        marker = ""  # start index from 0.
+    def list_objects(self, marker: str = ""):
+        r""" Iterate over the pages of image objects of the bucket after `marker`.
+
+        Args:
+            marker (str, optional): Listing starts after this key. (Default: ``""``).
 
+        Returns:
+            Generator of `(objects, marker)`, `objects` are the `(Key, ETag)` of a page and `marker` the key the next
+            listing resumes after.
+        """
         while True:
-            response = client.list_objects(Bucket=Bucket, Marker=marker)
-            # Get corresponding image files.
-            for index in range(len(response["Contents"])):
-                Key = response["Contents"][index]["Key"]
-                # Filtering long url and non image url.
-                if len(Key) <= 50 and check_image_file(Key):
-                    url_lists.append(Key)
+            with STAGE_SECONDS.time(stage="cos_list"):
+                response = self.client.list_objects(Bucket=self.Bucket, Marker=marker)
+            contents = response.get("Contents", [])
+            # Filtering long url and non image url.
+            objects = [(content["Key"], content["ETag"]) for content in contents
+                       if len(content["Key"]) <= 50 and check_image_file(content["Key"])]
+            if contents:
+                marker = response.get("NextMarker", contents[-1]["Key"])
+            yield objects, marker
 
             if response["IsTruncated"] == "false":
                 break
-            marker = response["NextMarker"]
+
+    def get_all_urls(self):
+        url_lists = [Key for objects, _ in self.list_objects() for Key, _ in objects]  # Save all url address.
+
+        # Sort by the latest time.
+        url_lists.sort(reverse=True)
+
+        return url_lists
+
+    def list_new_objects(self, index, full: bool = False):
+        r""" List the objects added since the last listing.
+
+        The listing resumes after the watermark stored in the index, so its cost is proportional to the new objects
+        rather than to the bucket. A full listing also finds re-uploaded objects and the new keys sorting before the
+        watermark, e.g. under another prefix, its time is recorded in the index.
+
+        Args:
+            index (ObjectIndex): Persistent index of the listed objects.
+            full (bool, optional): List the whole bucket instead of resuming. (Default: ``False``).
+
+        Returns:
+            New or changed url addresses, the latest first.
+        """
+        url_lists = []
+        watermark = index.marker(self.Bucket)
+        for objects, next_marker in self.list_objects("" if full else watermark):
+            url_lists += [Key for Key, ETag in objects if index.observe(Key, ETag)]
+            # Advance the watermark page by page, an interrupted listing resumes where it stopped.
+            if next_marker > watermark:
+                watermark = next_marker
+                index.set_marker(self.Bucket, watermark)
+        if full:
+            index.set_listed(self.Bucket)
 
         # Sort by the latest time.
         url_lists.sort(reverse=True)
@@ -342,11 +1015,26 @@ class COS(object):
             cos_path (string): COS url address.
         """
         client = self.client  # init client API.
-        response = client.get_object(
-            Bucket=self.Bucket,
-            Key=cos_path,
-        )
-        response["Body"].get_stream_to_file(file_path)
+        with STAGE_SECONDS.time(stage="cos_download"):
+            response = client.get_object(
+                Bucket=self.Bucket,
+                Key=cos_path,
+            )
+            response["Body"].get_stream_to_file(file_path)
+
+    def read_header(self, cos_path, size: int = 64 << 10):
+        r""" Read the first bytes of an object, enough for the image header of the common formats.
+
+        Args:
+            cos_path (string): COS url address.
+            size (int, optional): Bytes to read. (Default: 64KB).
+
+        Returns:
+            The first `size` bytes of the object, fewer for a smaller object.
+        """
+        with STAGE_SECONDS.time(stage="cos_header"):
+            response = self.client.get_object(Bucket=self.Bucket, Key=cos_path, Range=f"bytes=0-{size - 1}")
+            return response["Body"].get_raw_stream().read(size)
 
     def upload_file(self, stream, cos_path):
         """Upload file to COS URL.
@@ -355,10 +1043,14 @@ class COS(object):
         Args:
             stream (bytes): The uploaded file content is of file stream or byte stream type.
             cos_path (string): COS url address.
+
+        Returns:
+            Response of COS, with the `ETag` of the uploaded object.
         """
         client = self.client  # init client API.
-        client.put_object(
-            Bucket=self.Bucket,  # Bucket storage name.
-            Body=stream,
-            Key=cos_path  # Block upload path name.
-        )
+        with STAGE_SECONDS.time(stage="cos_upload"):
+            return client.put_object(
+                Bucket=self.Bucket,  # Bucket storage name.
+                Body=stream,
+                Key=cos_path  # Block upload path name.
+            )
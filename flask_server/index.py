@@ -0,0 +1,141 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import sqlite3
+import threading
+import time
+
+__all__ = ["ObjectIndex"]
+
+
+class ObjectIndex(object):
+    r""" Persistent index of the COS objects seen by the server.
+
+    It keeps the ETag and state of every key, and the listing watermark of every bucket, so a listing resumes
+    after the last key instead of scanning the whole bucket again. The time of the last full listing of every bucket
+    is kept too, a full listing now and then finds the keys sorting before the watermark.
+    A failed object is retried after a delay doubling with every attempt, after `max_attempts` it is dead and only
+    a new upload, with another ETag, queues it again.
+
+    Examples:
+        >>> index = ObjectIndex("static/index.db")
+        >>> index.observe("lr/1.png", "\"d41d8cd9\"")
+        True
+        >>> index.mark_processed("lr/1.png", "\"0cc175b9\"")
+    """
+
+    def __init__(self, database: str, max_attempts: int = 5, backoff: float = 60.) -> None:
+        r"""
+        Args:
+            database (str): SQLite file of the index.
+            max_attempts (optional, int): Failures after which an object is dead. (Default: 5).
+            backoff (optional, float): Seconds before the first retry of a failed object. (Default: 60.).
+        """
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS objects ("
+                                    "key TEXT PRIMARY KEY, etag TEXT, status TEXT, updated REAL, "
+                                    "attempts INTEGER DEFAULT 0, next_attempt REAL DEFAULT 0)")
+            # Indexes of an earlier version have no retries.
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(objects)")]
+            if "attempts" not in columns:
+                self.connection.execute("ALTER TABLE objects ADD COLUMN attempts INTEGER DEFAULT 0")
+                self.connection.execute("ALTER TABLE objects ADD COLUMN next_attempt REAL DEFAULT 0")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS watermarks (bucket TEXT PRIMARY KEY, marker TEXT)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS listings (bucket TEXT PRIMARY KEY, listed REAL)")
+
+    def marker(self, bucket: str) -> str:
+        r""" Last key listed in a bucket, empty before the first listing."""
+        with self.lock:
+            row = self.connection.execute("SELECT marker FROM watermarks WHERE bucket = ?", (bucket,)).fetchone()
+        return row[0] if row else ""
+
+    def set_marker(self, bucket: str, marker: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO watermarks (bucket, marker) VALUES (?, ?)",
+                                    (bucket, marker))
+
+    def listed(self, bucket: str) -> float:
+        r""" Time of the last full listing of a bucket, 0 before the first one."""
+        with self.lock:
+            row = self.connection.execute("SELECT listed FROM listings WHERE bucket = ?", (bucket,)).fetchone()
+        return row[0] if row else 0.
+
+    def set_listed(self, bucket: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO listings (bucket, listed) VALUES (?, ?)",
+                                    (bucket, time.time()))
+
+    def observe(self, key: str, etag: str) -> bool:
+        r""" Record a listed object.
+
+        Args:
+            key (str): COS url address.
+            etag (str): ETag of the object.
+
+        Returns:
+            ``True`` if the object is new or changed since it was seen, it then needs processing. A failed object
+            of the same ETag waits for its retry in `pending`.
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT etag, status FROM objects WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] == etag:
+                return False
+            self.connection.execute("INSERT OR REPLACE INTO objects (key, etag, status, updated) "
+                                    "VALUES (?, ?, 'queued', ?)", (key, etag, time.time()))
+        return True
+
+    def is_processed(self, key: str) -> bool:
+        with self.lock:
+            row = self.connection.execute("SELECT status FROM objects WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] == "processed"
+
+    def mark_processed(self, key: str, etag: str) -> None:
+        r""" Record a processed object.
+
+        Args:
+            key (str): COS url address.
+            etag (str): ETag of the object after processing, the uploaded result replaces the input.
+        """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO objects (key, etag, status, updated) "
+                                    "VALUES (?, ?, 'processed', ?)", (key, etag, time.time()))
+
+    def mark_failed(self, key: str) -> None:
+        r""" Record a failed object, it is returned by `pending` once its retry is due, or dead after
+        `max_attempts` failures."""
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT attempts FROM objects WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return
+            attempts = (row[0] or 0) + 1
+            status = "dead" if attempts >= self.max_attempts else "failed"
+            self.connection.execute("UPDATE objects SET status = ?, attempts = ?, next_attempt = ?, updated = ? "
+                                    "WHERE key = ?",
+                                    (status, attempts, now + self.backoff * 2 ** (attempts - 1), now, key))
+
+    def pending(self) -> list:
+        r""" Keys listed but not processed, those interrupted by a restart and the failed ones due for a retry."""
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT key FROM objects WHERE status = 'queued' "
+                                                              "OR status = 'failed' AND next_attempt <= ?",
+                                                              (time.time(),))]
+
+    def dead(self) -> int:
+        r""" Number of objects given up after `max_attempts` failures."""
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM objects WHERE status = 'dead'").fetchone()[0]
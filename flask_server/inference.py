@@ -25,6 +25,20 @@ if __name__ == "__main__":
                         help="Required. Super resolution image file name to be processed.")
     parser.add_argument("-m", "--model", type=str, default="resources/srgan.pth",
                         help="Optional. Super resolution weights path. (Default: ``resources/srgan.pth``).")
+    parser.add_argument("-t", "--tile-size", type=int, default=512,
+                        help="Optional. Low resolution tile size, any image size is split into a grid of it. "
+                             "(Default: 512).")
+    parser.add_argument("-o", "--over-length", type=int, default=None,
+                        help="Optional. Edge overlap length of the super resolution tiles. "
+                             "Derived from the model receptive field if not set.")
+    parser.add_argument("--whole-slide", dest="whole_slide", action="store_true",
+                        help="Optional. Stream the slide band by band into a disk-backed `.npy` or tiled `.tif`.")
+    parser.add_argument("--box", type=str, default=None,
+                        help="Optional. Only super resolve the low resolution region `left,upper,right,lower`.")
+    parser.add_argument("--skip-background", dest="skip_background", action="store_true",
+                        help="Optional. Upsample background tiles with bicubic and keep the model for tissue.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Optional. Super resolution image file name. (Default: ``sr_<input>.png``).")
     parser.add_argument("-d", "--device", type=str, default="0",
                         help="device id i.e. `0` or `0,1` or `cpu`. (default: ``0``).")
     args = parser.parse_args()
@@ -0,0 +1,286 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+__all__ = ["JobQueue"]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+
+class JobQueue(object):
+    r""" Persistent queue of super-resolution jobs processed by one background thread.
+
+    Jobs are stored in SQLite, so queued and interrupted jobs are resumed after a restart. Several processes may
+    submit jobs and read their status, only one of them starts the queue.
+    A job submitted while an identical one is still waiting is merged into it.
+    Jobs run one at a time. The queued job with the smallest `priority` starts first, ties by submission. A running job
+    is not interrupted: its handler may check `waiting` between two files and, once the files it started are finished,
+    call `preempt` to run the jobs submitted since then with a smaller priority before going on. Without that, the
+    priorities only order the jobs waiting to start.
+    The objects to process are listed on a second background thread by `lister`, on request of `request_listing`,
+    so neither the requests nor the running job wait for the listing of the bucket.
+
+    Examples:
+        >>> def handler(job_id, cos_paths):
+        ...     for cos_path in cos_paths:
+        ...         jobs.advance(job_id)
+        >>> jobs = JobQueue("static/jobs.db", handler)
+        >>> jobs.start()
+        >>> job_id = jobs.submit(["lr/1.png", "lr/2.png"])
+        >>> jobs.status(job_id)
+    """
+
+    def __init__(self, database: str, handler, lister=None, poll_interval: float = 1.0) -> None:
+        r"""
+        Args:
+            database (str): SQLite file of the queue.
+            handler (callable): Called with the job id and its COS paths, reports progress with `advance`.
+            lister (optional, callable): Called with the priority class of a listing request, lists the bucket and
+                returns the ids of the jobs it submitted by priority class. (Default: ``None``).
+            poll_interval (optional, float): Seconds between two looks at an empty queue. (Default: 1.0).
+        """
+        self.handler = handler
+        self.lister = lister
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.listing_wakeup = threading.Event()
+        self.thread = None
+        self.listing_thread = None
+
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                                    "id TEXT PRIMARY KEY, status TEXT, cos_paths TEXT, total INTEGER, "
+                                    "done INTEGER, failed INTEGER, error TEXT, "
+                                    "created REAL, started REAL, finished REAL, "
+                                    "priority REAL DEFAULT 0, priority_class TEXT)")
+            # Queues of an earlier version have no priorities.
+            columns = [row["name"] for row in self.connection.execute("PRAGMA table_info(jobs)")]
+            if "priority" not in columns:
+                self.connection.execute("ALTER TABLE jobs ADD COLUMN priority REAL DEFAULT 0")
+                self.connection.execute("ALTER TABLE jobs ADD COLUMN priority_class TEXT")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS listings ("
+                                    "id TEXT PRIMARY KEY, status TEXT, priority_class TEXT, jobs TEXT, error TEXT, "
+                                    "created REAL, finished REAL)")
+
+    def start(self) -> None:
+        r""" Run the jobs on a background thread, in a single process of the server only."""
+        with self.lock, self.connection:
+            # Jobs interrupted by a restart run again from the start, processed files are filtered.
+            self.connection.execute("UPDATE jobs SET status = 'queued', done = 0, failed = 0 "
+                                    "WHERE status = 'running'")
+            self.connection.execute("UPDATE listings SET status = 'queued' WHERE status = 'running'")
+        self.thread = threading.Thread(target=self.work, name="jobs", daemon=True)
+        self.thread.start()
+        if self.lister is not None:
+            self.listing_thread = threading.Thread(target=self.list_work, name="listing", daemon=True)
+            self.listing_thread.start()
+
+    def submit(self, cos_paths: list, priority: float = 0., priority_class: str = None) -> str:
+        r""" Queue a job.
+
+        Args:
+            cos_paths (list): COS url addresses to process.
+            priority (optional, float): Sort key of the job, the smallest runs first. (Default: 0.).
+            priority_class (optional, str): Name of the priority class, passed on to the handler. (Default: ``None``).
+
+        Returns:
+            Job id, the id of the waiting job if the same paths are already queued.
+        """
+        cos_paths = json.dumps(list(cos_paths))
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT id FROM jobs WHERE status = 'queued' AND cos_paths = ?",
+                                          (cos_paths,)).fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE jobs SET priority = MIN(priority, ?) WHERE id = ?",
+                                        (priority, row["id"]))
+                return row["id"]
+
+            job_id = uuid.uuid4().hex
+            self.connection.execute("INSERT INTO jobs (id, status, cos_paths, total, done, failed, created, "
+                                    "priority, priority_class) VALUES (?, 'queued', ?, ?, 0, 0, ?, ?, ?)",
+                                    (job_id, cos_paths, len(json.loads(cos_paths)), time.time(), priority,
+                                     priority_class))
+        self.wakeup.set()
+        return job_id
+
+    def request_listing(self, priority_class: str = None) -> str:
+        r""" Ask for a listing of the bucket, run by `lister` on the listing thread.
+
+        Args:
+            priority_class (optional, str): Priority class of all the listed objects, passed on to `lister`.
+                (Default: ``None``).
+
+        Returns:
+            Listing id, the id of the waiting listing of the same priority class if there is one.
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT id FROM listings WHERE status = 'queued' AND priority_class IS ?",
+                                          (priority_class,)).fetchone()
+            if row is not None:
+                return row["id"]
+            listing_id = uuid.uuid4().hex
+            self.connection.execute("INSERT INTO listings (id, status, priority_class, created) "
+                                    "VALUES (?, 'queued', ?, ?)", (listing_id, priority_class, time.time()))
+        self.listing_wakeup.set()
+        return listing_id
+
+    def listing(self, listing_id: str):
+        r""" Progress of a listing.
+
+        Returns:
+            Status, the submitted jobs by priority class once finished, ``None`` for an unknown listing.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM listings WHERE id = ?", (listing_id,)).fetchone()
+        if row is None:
+            return None
+        status = {key: row[key] for key in row.keys()}
+        status["jobs"] = json.loads(row["jobs"]) if row["jobs"] else {}
+        return status
+
+    def list_work(self) -> None:
+        while True:
+            with self.lock, self.connection:
+                row = self.connection.execute("SELECT id, priority_class FROM listings WHERE status = 'queued' "
+                                              "ORDER BY created LIMIT 1").fetchone()
+                if row is not None:
+                    self.connection.execute("UPDATE listings SET status = 'running' WHERE id = ?", (row["id"],))
+            if row is None:
+                self.listing_wakeup.wait(self.poll_interval)
+                self.listing_wakeup.clear()
+                continue
+
+            status, job_ids, error = "finished", {}, None
+            try:
+                job_ids = self.lister(row["priority_class"])
+            except Exception as exception:
+                logger.exception(f"Listing `{row['id']}` failed: {exception}")
+                status, error = "failed", str(exception)
+            with self.lock, self.connection:
+                self.connection.execute("UPDATE listings SET status = ?, jobs = ?, error = ?, finished = ? "
+                                        "WHERE id = ?", (status, json.dumps(job_ids), error, time.time(), row["id"]))
+
+    def advance(self, job_id: str, failed: bool = False) -> None:
+        r""" Count one processed file of a job.
+
+        Args:
+            job_id (str): Job id.
+            failed (optional, bool): The file could not be processed. (Default: ``False``).
+        """
+        column = "failed" if failed else "done"
+        with self.lock, self.connection:
+            self.connection.execute(f"UPDATE jobs SET {column} = {column} + 1 WHERE id = ?", (job_id,))
+
+    def status(self, job_id: str):
+        r""" Progress of a job.
+
+        Returns:
+            Status, file counts and timestamps of the job, ``None`` for an unknown job.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            position = None
+            if row["status"] == "queued":
+                position = self.connection.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' "
+                                                   "AND (priority < ? OR priority = ? AND created < ?)",
+                                                   (row["priority"], row["priority"], row["created"])).fetchone()[0]
+
+        status = {key: row[key] for key in row.keys() if key != "cos_paths"}
+        status["position"] = position
+        status["progress"] = (row["done"] + row["failed"]) / max(row["total"], 1)
+        return status
+
+    def depth(self) -> dict:
+        r""" Size of the queue.
+
+        Returns:
+            Number of queued jobs, the files they hold and the running job.
+        """
+        with self.lock:
+            queued, files = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(total), 0) FROM jobs "
+                                                    "WHERE status = 'queued'").fetchone()
+            running = self.connection.execute("SELECT id FROM jobs WHERE status = 'running'").fetchone()
+        return {"queued_jobs": queued, "queued_files": files, "running": running["id"] if running else None}
+
+    def active_paths(self) -> set:
+        r""" COS url addresses of the queued and running jobs."""
+        with self.lock:
+            rows = self.connection.execute("SELECT cos_paths FROM jobs WHERE status IN ('queued', 'running')")
+            return {cos_path for row in rows for cos_path in json.loads(row["cos_paths"])}
+
+    def next(self, before: float = None):
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT id, cos_paths FROM jobs WHERE status = 'queued' AND priority < ? "
+                                          "ORDER BY priority, created LIMIT 1",
+                                          (float("inf") if before is None else before,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                                    (time.time(), row["id"]))
+        return row["id"], json.loads(row["cos_paths"])
+
+    def waiting(self, priority: float) -> bool:
+        r""" Whether a queued job has a smaller priority than `priority`, and should preempt the running job."""
+        with self.lock:
+            row = self.connection.execute("SELECT 1 FROM jobs WHERE status = 'queued' AND priority < ? LIMIT 1",
+                                          (priority,)).fetchone()
+        return row is not None
+
+    def preempt(self, priority: float) -> None:
+        r""" Run the queued jobs with a smaller priority than `priority` before going on, on the calling thread.
+
+        The handler must have finished the files it started before, otherwise they compete with the preempting jobs.
+
+        Args:
+            priority (float): Priority of the running job.
+        """
+        while True:
+            job = self.next(priority)
+            if job is None:
+                return
+            self.run(*job)
+
+    def work(self) -> None:
+        while True:
+            job = self.next()
+            if job is None:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+                continue
+            self.run(*job)
+
+    def run(self, job_id: str, cos_paths: list) -> None:
+        logger.info(f"Start job `{job_id}` of {len(cos_paths)} files.")
+        status, error = "finished", None
+        try:
+            self.handler(job_id, cos_paths)
+        except Exception as exception:
+            logger.exception(f"Job `{job_id}` failed: {exception}")
+            status, error = "failed", str(exception)
+
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+                                    (status, error, time.time(), job_id))
+        logger.info(f"Job `{job_id}` {status}.")
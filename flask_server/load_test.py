@@ -0,0 +1,329 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import requests
+
+from protocol import pack
+
+
+def parse_pairs(text: str, cast=float) -> list:
+    r""" Parse `a:b,c:d` into `[(a, b), (c, d)]`."""
+    pairs = []
+    for item in text.split(","):
+        key, value = item.split(":")
+        pairs.append((cast(key), float(value)))
+    return pairs
+
+
+def percentiles(latencies: list) -> dict:
+    if not latencies:
+        return {}
+    latencies = np.asarray(latencies)
+    return {"mean": round(float(latencies.mean()), 4),
+            "p50": round(float(np.percentile(latencies, 50)), 4),
+            "p90": round(float(np.percentile(latencies, 90)), 4),
+            "p95": round(float(np.percentile(latencies, 95)), 4),
+            "p99": round(float(np.percentile(latencies, 99)), 4),
+            "max": round(float(latencies.max()), 4)}
+
+
+def make_image(size: int, rng: np.random.RandomState) -> np.ndarray:
+    r""" Smooth random RGB image, closer to a field of view than noise and distinct for every call."""
+    small = rng.randint(0, 256, (max(size // 16, 2), max(size // 16, 2), 3)).astype(np.uint8)
+    image = cv2.resize(small, (size, size), interpolation=cv2.INTER_CUBIC)
+    return np.clip(image.astype(np.int16) + rng.randint(-8, 9, image.shape), 0, 255).astype(np.uint8)
+
+
+class LoadTest(object):
+    r""" Load generator of the super-resolution server.
+
+    `/sr` and `/sr/raw` requests are sent either by a fixed number of closed-loop clients, or at the rates of a
+    schedule. With a schedule, latencies count from the time a request was due, so a slow server cannot hide its
+    queueing by slowing the generator down.
+    """
+
+    def __init__(self, url: str, mode: str, sizes: list, pool: int = 16, unique: bool = False,
+                 timeout: float = 120., seed: int = 0) -> None:
+        r"""
+        Args:
+            url (str): Address of the server, e.g. `http://127.0.0.1:10086`.
+            mode (str): `sr` for encoded images, `raw` for raw arrays.
+            sizes (list): `(size, weight)` of the square images sent.
+            pool (optional, int): Images prepared per size, repeats hit the tile cache of the server. (Default: 16).
+            unique (optional, bool): Make a new image for every request instead. (Default: ``False``).
+            timeout (optional, float): Seconds before a request counts as failed. (Default: 120).
+            seed (optional, int): Seed of the images and of the size mix. (Default: 0).
+        """
+        self.url = url.rstrip("/")
+        self.mode = mode
+        self.sizes = [size for size, _ in sizes]
+        self.weights = [weight for _, weight in sizes]
+        self.unique = unique
+        self.timeout = timeout
+        self.rng = np.random.RandomState(seed)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.results = []
+        self.pools = {size: [self.encode(make_image(size, self.rng)) for _ in range(pool)] for size in self.sizes}
+
+    def encode(self, image: np.ndarray) -> bytes:
+        if self.mode == "raw":
+            return pack(image)
+        return cv2.imencode(".png", image)[1].tobytes()
+
+    def payload(self):
+        with self.lock:
+            size = self.random.choices(self.sizes, self.weights)[0]
+            if self.unique:
+                return size, self.encode(make_image(size, self.rng))
+            return size, self.random.choice(self.pools[size])
+
+    def request(self, due: float = None) -> None:
+        size, body = self.payload()
+        path = "/sr/raw" if self.mode == "raw" else "/sr"
+        start = time.perf_counter() if due is None else due
+        result = {"size": size, "bytes_in": len(body), "bytes_out": 0, "status": None}
+        try:
+            response = requests.post(self.url + path, data=body, timeout=self.timeout)
+            result["status"] = str(response.status_code)
+            result["bytes_out"] = len(response.content)
+        except requests.Timeout:
+            result["status"] = "timeout"
+        except requests.RequestException as error:
+            result["status"] = type(error).__name__
+        result["latency"] = time.perf_counter() - start
+        with self.lock:
+            self.results.append(result)
+
+    def closed_loop(self, concurrency: int, duration: float) -> None:
+        deadline = time.perf_counter() + duration
+
+        def client() -> None:
+            while time.perf_counter() < deadline:
+                self.request()
+
+        threads = [threading.Thread(target=client, daemon=True) for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def open_loop(self, schedule: list, concurrency: int) -> None:
+        r""" Send requests at the rates of `schedule`, a list of `(requests per second, seconds)`."""
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            start = time.perf_counter()
+            for rate, seconds in schedule:
+                end = start + seconds
+                due = start
+                while due < end:
+                    delay = due - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    pool.submit(self.request, due)
+                    due += 1. / rate
+                start = end
+
+    def report(self, duration: float) -> dict:
+        results = self.results
+        succeeded = [result for result in results if result["status"] == "200"]
+        errors = {}
+        for result in results:
+            if result["status"] != "200":
+                errors[result["status"]] = errors.get(result["status"], 0) + 1
+
+        sizes = {}
+        for size in self.sizes:
+            latencies = [result["latency"] for result in succeeded if result["size"] == size]
+            sizes[str(size)] = {"requests": sum(result["size"] == size for result in results),
+                                "latency": percentiles(latencies)}
+
+        megapixels = sum(result["size"] ** 2 for result in succeeded) / 1e6
+        return {"requests": len(results),
+                "succeeded": len(succeeded),
+                "failed": len(results) - len(succeeded),
+                "error_rate": round((len(results) - len(succeeded)) / max(len(results), 1), 4),
+                "errors": errors,
+                "duration": round(duration, 3),
+                "throughput": {
+                    "requests_per_second": round(len(succeeded) / duration, 3),
+                    "megapixels_per_second": round(megapixels / duration, 3),
+                    "mb_sent_per_second": round(sum(r["bytes_in"] for r in results) / (1 << 20) / duration, 3),
+                    "mb_received_per_second": round(sum(r["bytes_out"] for r in results) / (1 << 20) / duration, 3)},
+                "latency": percentiles([result["latency"] for result in succeeded]),
+                "sizes": sizes}
+
+
+def run_cos(url: str, root: str, bucket: str, sizes: list, files: int, timeout: float, seed: int) -> dict:
+    r""" Upload `files` images to the local bucket, queue them with `/run` and time every file until it is done."""
+    rng = np.random.RandomState(seed)
+    choices = random.Random(seed)
+    prefix = f"load/{int(time.time())}"
+    for index in range(files):
+        size = choices.choices([size for size, _ in sizes], [weight for _, weight in sizes])[0]
+        path = os.path.join(root, bucket, *prefix.split("/"), f"{index:05d}.png")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        cv2.imwrite(path, make_image(size, rng))
+
+    start = time.perf_counter()
+    listing_id = requests.post(url + "/run", timeout=timeout).json()["listing_id"]
+    job_id = None
+    # The bucket is listed in the background, its listing gives the job of the new files.
+    while job_id is None and time.perf_counter() - start < timeout:
+        listing = requests.get(f"{url}/listings/{listing_id}", timeout=timeout).json()["listing"]
+        if listing["status"] in ("finished", "failed"):
+            job_id = next(iter(listing["jobs"].values()), None)
+            break
+        time.sleep(0.05)
+    finished, done = [], 0
+    job = {}
+    # Files finish one by one, polling the progress of the job times every one of them.
+    while job_id is not None and time.perf_counter() - start < timeout:
+        job = requests.get(f"{url}/jobs/{job_id}", timeout=timeout).json()["job"]
+        progress = job["done"] + job["failed"]
+        finished += [time.perf_counter() - start] * (progress - done)
+        done = progress
+        if job["status"] in ("finished", "failed"):
+            break
+        time.sleep(0.05)
+    duration = time.perf_counter() - start
+    return {"requests": files,
+            "succeeded": job.get("done", 0),
+            "failed": files - job.get("done", 0),
+            "error_rate": round((files - job.get("done", 0)) / max(files, 1), 4),
+            "duration": round(duration, 3),
+            "throughput": {"files_per_second": round(job.get("done", 0) / duration, 3)},
+            "latency": percentiles(finished)}
+
+
+def spawn_server(root: str, bucket: str, port: int, extra: list) -> subprocess.Popen:
+    r""" Start the server on a local bucket, in a working directory of its own."""
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    environment = dict(os.environ)
+    environment["PYTHONPATH"] = os.pathsep.join([os.path.dirname(os.path.dirname(server)),
+                                                 os.path.dirname(server), environment.get("PYTHONPATH", "")])
+    process = subprocess.Popen([sys.executable, server, "--local-cos", os.path.join(root, "cos"),
+                                "--bucket", bucket, "--port", str(port)] + extra,
+                               cwd=root, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(600):
+        try:
+            requests.get(url + "/status", timeout=1)
+            return process
+        except requests.RequestException:
+            if process.poll() is not None:
+                raise RuntimeError("Server exited during startup.")
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("Server did not start within 60s.")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test of the super-resolution server, reported as JSON.")
+    parser.add_argument("--url", type=str, default=None,
+                        help="Address of a running server. (Default: start one on a local bucket).")
+    parser.add_argument("--mode", type=str, default="sr", choices=["sr", "raw", "cos"],
+                        help="`sr`: encoded images to `/sr`, `raw`: raw arrays to `/sr/raw`, "
+                             "`cos`: images in the bucket processed through `/run`. (Default: sr).")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Clients of the closed loop, or requests in flight at most with `--rate`. (Default: 8).")
+    parser.add_argument("--duration", type=float, default=30,
+                        help="Seconds of the closed loop. (Default: 30).")
+    parser.add_argument("--rate", type=str, default=None,
+                        help="Schedule `rate:seconds,...` in requests per second, e.g. `2:10,5:10` ramps up. "
+                             "(Default: closed loop).")
+    parser.add_argument("--sizes", type=str, default="128:0.5,256:0.4,512:0.1",
+                        help="Mix `size:weight,...` of the square images. (Default: 128:0.5,256:0.4,512:0.1).")
+    parser.add_argument("--pool", type=int, default=16,
+                        help="Images prepared per size. (Default: 16).")
+    parser.add_argument("--unique", action="store_true",
+                        help="Make a new image for every request, so the tile cache never hits.")
+    parser.add_argument("--files", type=int, default=32,
+                        help="Images processed in `cos` mode. (Default: 32).")
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="Seconds before a request counts as failed. (Default: 120).")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the images and of the size mix. (Default: 0).")
+    parser.add_argument("--port", type=int, default=10087,
+                        help="Port of the server started by the load test. (Default: 10087).")
+    parser.add_argument("--server-args", type=str, default="",
+                        help="Arguments of the server started by the load test, e.g. `--workers 4`.")
+    parser.add_argument("--root", type=str, default=None,
+                        help="Working directory of the started server and local bucket. (Default: temporary).")
+    parser.add_argument("--label", type=str, default="",
+                        help="Name of the run in the report, e.g. a release.")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Report file. (Default: standard output).")
+    args = parser.parse_args()
+
+    sizes = parse_pairs(args.sizes, int)
+    bucket = "load"
+    root = args.root or tempfile.mkdtemp()
+    os.makedirs(os.path.join(root, "cos", bucket), exist_ok=True)
+    process = None
+    url = args.url
+    try:
+        if url is None:
+            process = spawn_server(root, bucket, args.port, args.server_args.split())
+            url = f"http://127.0.0.1:{args.port}"
+
+        if args.mode == "cos":
+            report = run_cos(url, os.path.join(root, "cos"), bucket, sizes, args.files, args.timeout, args.seed)
+        else:
+            load_test = LoadTest(url, args.mode, sizes, args.pool, args.unique, args.timeout, args.seed)
+            start = time.perf_counter()
+            if args.rate is None:
+                load_test.closed_loop(args.concurrency, args.duration)
+            else:
+                load_test.open_loop(parse_pairs(args.rate), args.concurrency)
+            report = load_test.report(time.perf_counter() - start)
+
+        try:
+            # Residency and batcher counters of every model of the server.
+            report["server"] = requests.get(url + "/status", timeout=args.timeout).json().get("models")
+        except requests.RequestException:
+            pass
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if args.root is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {"label": args.label,
+              "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "config": {key: value for key, value in vars(args).items() if key not in ("output", "root")},
+              **report}
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import hashlib
+import io
+import os
+import random
+import shutil
+import threading
+import time
+import uuid
+
+from qcloud_cos.cos_exception import CosClientError
+from qcloud_cos.cos_exception import CosServiceError
+
+__all__ = ["LocalStreamBody", "LocalCosS3Client"]
+
+
+class LocalStreamBody(object):
+    r""" Stand-in for `qcloud_cos.streambody.StreamBody` reading a local file, or a byte range of it."""
+
+    def __init__(self, path: str, start: int = 0, length: int = None) -> None:
+        self.path = path
+        self.start = start
+        self.length = length
+
+    def get_raw_stream(self):
+        if self.start == 0 and self.length is None:
+            return open(self.path, "rb")
+        return io.BytesIO(self.read())
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as f:
+            f.seek(self.start)
+            return f.read() if self.length is None else f.read(self.length)
+
+    def get_stream_to_file(self, file_name: str) -> None:
+        if self.start == 0 and self.length is None:
+            shutil.copyfile(self.path, file_name)
+            return
+        with open(file_name, "wb") as f:
+            f.write(self.read())
+
+
+class LocalCosS3Client(object):
+    r""" Directory-backed stand-in for `CosS3Client`, for running the server and its tools offline.
+
+    Every bucket is a sub-directory of `root` and every key a file below it. Listing follows COS:
+    keys in lexicographic order, resumed after `Marker`. A round trip latency and transient failures can be
+    injected to benchmark the transfers.
+
+    Examples:
+        >>> cos = COS(LocalCosS3Client("static/cos"), bucket="slides")
+    """
+
+    def __init__(self, root: str, latency: float = 0., failure_rate: float = 0., bandwidth: float = None) -> None:
+        r"""
+        Args:
+            root (str): Directory holding the buckets.
+            latency (float, optional): Seconds added to every request. (Default: 0.).
+            failure_rate (float, optional): Probability of a transient error on a request. (Default: 0.).
+            bandwidth (float, optional): Bytes per second of a single connection. (Default: ``None``, unlimited).
+        """
+        self.root = root
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def request(self, size: int = 0) -> None:
+        r""" Account for one request moving `size` bytes, with the injected latency and failures."""
+        with self.lock:
+            self.requests += 1
+        delay = self.latency + (size / self.bandwidth if self.bandwidth else 0.)
+        if delay > 0:
+            time.sleep(delay)
+        if random.random() < self.failure_rate:
+            if random.random() < 0.5:
+                raise CosClientError("Injected connection timeout.")
+            raise CosServiceError("PUT", {"code": "InternalError", "message": "Injected server error.",
+                                          "resource": "", "requestid": "", "traceid": ""}, 503)
+
+    def path(self, Bucket: str, Key: str) -> str:
+        return os.path.join(self.root, Bucket, *Key.split("/"))
+
+    def etag(self, Bucket: str, Key: str) -> str:
+        r""" ETag stored by the upload, or the MD5 of a file copied into the bucket."""
+        etag_path = os.path.join(self.root, ".etags", Bucket, *Key.split("/"))
+        if os.path.exists(etag_path) and os.path.getmtime(etag_path) >= os.path.getmtime(self.path(Bucket, Key)):
+            with open(etag_path) as f:
+                return f.read()
+        with open(self.path(Bucket, Key), "rb") as f:
+            return f"\"{hashlib.md5(f.read()).hexdigest()}\""
+
+    def list_objects(self, Bucket: str, Prefix: str = "", Marker: str = "", MaxKeys: int = 1000, **kwargs) -> dict:
+        self.request()
+        bucket = os.path.join(self.root, Bucket)
+        keys = []
+        for directory, _, filenames in os.walk(bucket):
+            for filename in filenames:
+                if filename.endswith(".part"):
+                    continue
+                key = os.path.relpath(os.path.join(directory, filename), bucket).replace(os.sep, "/")
+                if key.startswith(Prefix) and key > Marker:
+                    keys.append(key)
+        keys.sort()
+
+        contents = []
+        for key in keys[:MaxKeys]:
+            path = self.path(Bucket, key)
+            contents.append({"Key": key,
+                             "ETag": self.etag(Bucket, key),
+                             "Size": str(os.path.getsize(path)),
+                             "LastModified": time.strftime("%Y-%m-%dT%H:%M:%S.000Z",
+                                                           time.gmtime(os.path.getmtime(path)))})
+
+        response = {"Name": Bucket, "Prefix": Prefix, "Marker": Marker, "MaxKeys": str(MaxKeys),
+                    "IsTruncated": "true" if len(keys) > MaxKeys else "false"}
+        if contents:
+            response["Contents"] = contents
+        if len(keys) > MaxKeys:
+            response["NextMarker"] = contents[-1]["Key"]
+        return response
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None, **kwargs) -> dict:
+        path = self.path(Bucket, Key)
+        if not os.path.exists(path):
+            raise CosServiceError("GET", {"code": "NoSuchKey", "message": "The specified key does not exist.",
+                                          "resource": Key, "requestid": "", "traceid": ""}, 404)
+        size = os.path.getsize(path)
+        start, length = 0, None
+        if Range is not None:
+            # `bytes=first-last`, both inclusive, `last` may be left out.
+            first, last = Range.split("=", 1)[1].split("-", 1)
+            start = min(int(first), size)
+            end = min(int(last) + 1, size) if last else size
+            length = max(end - start, 0)
+        self.request(size if length is None else length)
+        return {"Body": LocalStreamBody(path, start, length),
+                "ETag": self.etag(Bucket, Key),
+                "Content-Length": str(size if length is None else length)}
+
+    def put_object(self, Bucket: str, Body, Key: str, **kwargs) -> dict:
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.request(len(data))
+        return {"ETag": self.write(Bucket, Key, [data], hashlib.md5(data).hexdigest())}
+
+    def write(self, Bucket: str, Key: str, chunks: list, etag: str) -> str:
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Objects appear atomically, like on COS.
+        with open(path + ".part", "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(path + ".part", path)
+
+        etag_path = os.path.join(self.root, ".etags", Bucket, *Key.split("/"))
+        os.makedirs(os.path.dirname(etag_path), exist_ok=True)
+        with open(etag_path, "w") as f:
+            f.write(f"\"{etag}\"")
+        return f"\"{etag}\""
+
+    def upload_path(self, UploadId: str) -> str:
+        return os.path.join(self.root, ".uploads", UploadId)
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self.request()
+        UploadId = uuid.uuid4().hex
+        os.makedirs(self.upload_path(UploadId))
+        return {"Bucket": Bucket, "Key": Key, "UploadId": UploadId}
+
+    def upload_part(self, Bucket: str, Key: str, Body, PartNumber: int, UploadId: str, **kwargs) -> dict:
+        data = Body if isinstance(Body, bytes) else Body.read()
+        self.request(len(data))
+        with open(os.path.join(self.upload_path(UploadId), str(PartNumber)), "wb") as f:
+            f.write(data)
+        return {"ETag": f"\"{hashlib.md5(data).hexdigest()}\""}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict = None,
+                                  **kwargs) -> dict:
+        self.request()
+        parts = sorted(MultipartUpload["Part"], key=lambda part: int(part["PartNumber"]))
+        chunks = []
+        for part in parts:
+            with open(os.path.join(self.upload_path(UploadId), str(part["PartNumber"])), "rb") as f:
+                chunks.append(f.read())
+        # ETag of a multipart object is the MD5 of the part MD5s, suffixed by the part count.
+        digest = hashlib.md5(b"".join(bytes.fromhex(part["ETag"].strip("\"")) for part in parts)).hexdigest()
+        etag = self.write(Bucket, Key, chunks, f"{digest}-{len(parts)}")
+        shutil.rmtree(self.upload_path(UploadId))
+        return {"Bucket": Bucket, "Key": Key, "ETag": etag}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str, **kwargs) -> dict:
+        shutil.rmtree(self.upload_path(UploadId), ignore_errors=True)
+        return {}
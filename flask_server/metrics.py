@@ -0,0 +1,324 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import bisect
+import functools
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+__all__ = [
+    "Counter", "Gauge", "Histogram", "Registry",
+    "REGISTRY", "STAGE_SECONDS", "REQUEST_SECONDS", "REQUESTS", "BYTES", "TILES", "QUEUE_DEPTH", "BATCHER_QUEUE",
+    "QUEUE_DELAY", "DEADLINES_MISSED", "MACS", "CACHE", "CACHE_BYTES_SAVED", "timed"
+]
+
+# Latency buckets in seconds, from a cached tile to a whole field of view.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 25., 60., 120.)
+# Waiting time buckets in seconds, from an idle queue to a backlog of slides.
+DELAY_BUCKETS = (0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30., 60., 120., 300., 600., 1800., 3600., 7200.)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple, extra: tuple = ()) -> str:
+    pairs = [f"{name}=\"{escape(value)}\"" for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter(object):
+    r""" Monotonic count, e.g. of requests or bytes, one value per combination of labels."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()) -> None:
+        r"""
+        Args:
+            name (str): Metric name.
+            documentation (str): Help text of the metric.
+            labels (optional, tuple): Label names. (Default: ``()``).
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def inc(self, value: float = 1., **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.) + value
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {json.dumps(key): value for key, value in self.values.items()}
+
+    @staticmethod
+    def merge(snapshots: list) -> dict:
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot.items():
+                values[key] = values.get(key, 0.) + value
+        return values
+
+    def render(self, values: dict) -> list:
+        return [f"{self.name}{format_labels(self.labels, json.loads(key))} {value:g}"
+                for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    r""" Value that goes up and down, e.g. a queue depth.
+
+    Values of all worker processes are summed, unless `local`: a value read from a shared store, such as the job
+    queue, is only reported by the process serving the scrape.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), local: bool = False) -> None:
+        super(Gauge, self).__init__(name, documentation, labels)
+        self.local = local
+
+    def set(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram(Counter):
+    r""" Distribution of observations, e.g. latencies, in cumulative buckets.
+
+    p50/p95/p99 are estimated from the buckets, like `histogram_quantile` of Prometheus, so they can be summed
+    across processes.
+    """
+
+    type = "histogram"
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> None:
+        r"""
+        Args:
+            name (str): Metric name.
+            documentation (str): Help text of the metric.
+            labels (optional, tuple): Label names. (Default: ``()``).
+            buckets (optional, tuple): Upper bounds of the buckets, increasing. (Default: `LATENCY_BUCKETS`).
+        """
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            # Counts of every bucket and of +Inf, then the sum of the observations.
+            values = self.values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.])
+            values[index] += 1
+            values[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    @staticmethod
+    def merge(snapshots: list) -> dict:
+        values = {}
+        for snapshot in snapshots:
+            for key, value in snapshot.items():
+                values[key] = [a + b for a, b in zip(values[key], value)] if key in values else list(value)
+        return values
+
+    def quantile(self, q: float, counts: list) -> float:
+        r""" Estimate a quantile from the bucket counts, interpolating inside the bucket it falls in."""
+        total = sum(counts)
+        if total == 0:
+            return float("nan")
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if cumulative + count >= rank and count > 0:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index > 0 else 0.
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-1]
+
+    def render(self, values: dict) -> list:
+        lines = []
+        for key, value in sorted(values.items()):
+            label_values = json.loads(key)
+            counts, total = value[:-1], value[-1]
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                labels = format_labels(self.labels, label_values, (("le", bound),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {total:g}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {cumulative}")
+        return lines
+
+    def render_quantiles(self, values: dict) -> list:
+        lines = [f"# HELP {self.name}_quantile Quantiles of {self.name} estimated from its buckets.",
+                 f"# TYPE {self.name}_quantile gauge"]
+        for key, value in sorted(values.items()):
+            for q in self.quantiles:
+                labels = format_labels(self.labels, json.loads(key), (("quantile", q),))
+                lines.append(f"{self.name}_quantile{labels} {self.quantile(q, value[:-1]):g}")
+        return lines
+
+
+class Registry(object):
+    r""" Metrics of the server, rendered in the Prometheus text format.
+
+    Every worker process dumps its metrics to `directory` in the background, the worker serving a scrape adds up
+    the dumps of the others and its own live values.
+
+    Examples:
+        >>> REGISTRY.start("static/metrics", worker=0)
+        >>> with STAGE_SECONDS.time(stage="download"):
+        ...     download()
+        >>> REGISTRY.render()
+    """
+
+    def __init__(self) -> None:
+        self.metrics = []
+        self.directory = None
+        self.worker = 0
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def snapshot(self) -> dict:
+        return {metric.name: metric.snapshot() for metric in self.metrics if not getattr(metric, "local", False)}
+
+    def dump(self) -> None:
+        path = os.path.join(self.directory, f"{self.worker}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(path + ".tmp", path)
+
+    def start(self, directory: str, worker: int = 0, interval: float = 5.) -> None:
+        r""" Dump the metrics of this process every `interval` seconds.
+
+        Args:
+            directory (str): Directory shared by the worker processes.
+            worker (optional, int): Index of the worker process. (Default: 0).
+            interval (optional, float): Seconds between two dumps. (Default: 5.).
+        """
+        self.directory = directory
+        self.worker = worker
+        os.makedirs(directory, exist_ok=True)
+
+        def work() -> None:
+            while True:
+                self.dump()
+                time.sleep(interval)
+
+        threading.Thread(target=work, name="metrics", daemon=True).start()
+
+    def others(self) -> list:
+        r""" Last dumps of the other worker processes."""
+        if self.directory is None:
+            return []
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            if os.path.basename(path) == f"{self.worker}.json":
+                continue
+            try:
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def values(self, metric, others: list = None) -> dict:
+        r""" Values of a metric added up over the worker processes.
+
+        Args:
+            metric (Counter): Registered metric.
+            others (optional, list): Dumps of the other workers. (Default: ``None``, read them).
+        """
+        snapshots = [metric.snapshot()]
+        if not getattr(metric, "local", False):
+            others = self.others() if others is None else others
+            snapshots += [snapshot.get(metric.name, {}) for snapshot in others]
+        return metric.merge(snapshots)
+
+    def render(self) -> str:
+        others = self.others()
+        lines = []
+        for metric in self.metrics:
+            values = self.values(metric, others)
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines += metric.render(values)
+            if isinstance(metric, Histogram):
+                lines += metric.render_quantiles(values)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.register(Histogram("sr_stage_seconds", "Seconds spent in every processing stage.",
+                                            ("stage",)))
+REQUEST_SECONDS = REGISTRY.register(Histogram("sr_request_seconds", "Seconds to serve a request.",
+                                              ("endpoint",)))
+REQUESTS = REGISTRY.register(Counter("sr_requests_total", "Requests served.", ("endpoint", "code")))
+BYTES = REGISTRY.register(Counter("sr_bytes_total", "Bytes received and sent, by COS transfers and requests.",
+                                  ("direction", "source")))
+TILES = REGISTRY.register(Counter("sr_tiles_total", "Tiles processed, by the model, bicubic or the cache.",
+                                  ("route",)))
+QUEUE_DEPTH = REGISTRY.register(Gauge("sr_queue_depth", "Jobs and files waiting in the job queue, and running jobs.",
+                                      ("queue",), local=True))
+BATCHER_QUEUE = REGISTRY.register(Gauge("sr_batcher_queue", "Requests waiting for the dynamic batcher."))
+QUEUE_DELAY = REGISTRY.register(Histogram("sr_queue_delay_seconds",
+                                          "Seconds from the submission of a file to the start of its super-resolution, "
+                                          "by priority class.", ("priority",), buckets=DELAY_BUCKETS))
+DEADLINES_MISSED = REGISTRY.register(Counter("sr_deadlines_missed_total",
+                                             "Files whose super-resolution started after their deadline, "
+                                             "by priority class.", ("priority",)))
+
+MACS = REGISTRY.register(Counter("sr_macs_total",
+                                 "Multiply-accumulates of the routed tiles, `used` by their models and `full` if they "
+                                 "had all gone through the most expensive one.", ("kind",)))
+CACHE = REGISTRY.register(Counter("sr_tile_cache_total", "Lookups of the tile caches, by cache and result.",
+                                  ("cache", "result")))
+CACHE_BYTES_SAVED = REGISTRY.register(Counter("sr_tile_cache_bytes_saved_total",
+                                              "Bytes of tiles reused from the tile caches instead of computed again.",
+                                              ("cache",)))
+
+
+def timed(stage: str):
+    r""" Decorator recording the duration of every call in `sr_stage_seconds`."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with STAGE_SECONDS.time(stage=stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
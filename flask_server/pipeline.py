@@ -0,0 +1,137 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import logging
+import queue
+import threading
+
+__all__ = ["Stage", "Pipeline"]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+# Marks the end of the items, every stage forwards it once all of its workers are done.
+STOP = object()
+
+
+class Stage(object):
+    r""" One step of a pipeline, run by a pool of worker threads.
+
+    The function receives an item and returns the item for the next stage, or ``None`` to drop it.
+    """
+
+    def __init__(self, name: str, function, workers: int = 1, queue_size: int = 4) -> None:
+        r"""
+        Args:
+            name (str): Name of the stage, used in the logs.
+            function (callable): Work done on every item.
+            workers (optional, int): Number of worker threads. (Default: 1).
+            queue_size (optional, int): Items waiting in front of the stage before the previous one blocks.
+                (Default: 4).
+        """
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.next = None
+        self.on_error = None
+        self.threads = []
+        self.running = workers
+        self.lock = threading.Lock()
+
+        self.processed = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            thread = threading.Thread(target=self.work, name=f"{self.name}-{index}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is STOP:
+                # Let the other workers of this stage see the end too, the last one forwards it.
+                self.queue.put(STOP)
+                with self.lock:
+                    self.running -= 1
+                    last = self.running == 0
+                if last and self.next is not None:
+                    self.next.queue.put(STOP)
+                return
+
+            try:
+                item = self.function(item)
+            except Exception as error:
+                logger.exception(f"Stage `{self.name}` failed: {error}")
+                with self.lock:
+                    self.failed += 1
+                if self.on_error is not None:
+                    self.on_error(item, error)
+                continue
+
+            with self.lock:
+                self.processed += 1
+            if item is not None and self.next is not None:
+                self.next.queue.put(item)
+
+
+class Pipeline(object):
+    r""" Stages connected by bounded queues, so the slow stage always has work waiting and
+    the fast ones can not run ahead without bound.
+
+    Examples:
+        >>> pipeline = Pipeline([Stage("download", download, workers=4),
+        ...                      Stage("inference", inference)])
+        >>> pipeline.start()
+        >>> for url in urls:
+        ...     pipeline.put(url)
+        >>> pipeline.join()
+    """
+
+    def __init__(self, stages: list, on_error=None) -> None:
+        r"""
+        Args:
+            stages (list): Stages in the order the items go through them.
+            on_error (optional, callable): Called with the item and the exception when a stage fails on an item.
+                (Default: ``None``).
+        """
+        self.stages = stages
+        for stage, next_stage in zip(stages[:-1], stages[1:]):
+            stage.next = next_stage
+        for stage in stages:
+            stage.on_error = on_error
+
+    def start(self) -> None:
+        for stage in self.stages:
+            stage.start()
+
+    def put(self, item) -> None:
+        r""" Feed an item to the first stage, blocks while its queue is full."""
+        self.stages[0].queue.put(item)
+
+    def join(self) -> dict:
+        r""" Wait until every item went through the pipeline.
+
+        Returns:
+            Processed and failed items per stage.
+        """
+        self.put(STOP)
+        for stage in self.stages:
+            for thread in stage.threads:
+                thread.join()
+
+        stats = {stage.name: {"processed": stage.processed, "failed": stage.failed} for stage in self.stages}
+        logger.info(f"Pipeline finished {stats}.")
+        return stats
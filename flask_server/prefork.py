@@ -0,0 +1,89 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import logging
+import os
+import signal
+import socket
+import sys
+
+__all__ = ["bind", "prefork"]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+
+def bind(host: str, port: int, backlog: int = 1024) -> socket.socket:
+    r""" Listening socket shared by the worker processes, the kernel hands every connection to one of them.
+
+    Args:
+        host (str): Address of the server.
+        port (int): Port of the server.
+        backlog (optional, int): Connections waiting to be accepted. (Default: 1024).
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+def prefork(workers: int) -> int:
+    r""" Fork the worker processes and supervise them.
+
+    Everything loaded before the call, e.g. the model weights, is shared by the workers instead of being loaded
+    again. The parent restarts the workers that exit, and stops them all on SIGINT or SIGTERM.
+
+    Args:
+        workers (int): Number of worker processes.
+
+    Returns:
+        Index of the worker, in the worker process. The parent does not return.
+    """
+    children = {}
+    stopping = False
+
+    def stop(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    def spawn(index: int) -> bool:
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            return True
+        children[pid] = index
+        logger.info(f"Started worker {index} (pid {pid}).")
+        return False
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(workers):
+        if spawn(index):
+            return index
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        index = children.pop(pid, None)
+        if index is None or stopping:
+            continue
+        logger.warning(f"Worker {index} (pid {pid}) exited with status {status}, restarting it.")
+        if spawn(index):
+            return index
+    sys.exit(0)
@@ -0,0 +1,118 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import struct
+
+import numpy as np
+
+__all__ = ["MAGIC", "FRAME_MAGIC", "pack", "unpack", "pack_frame", "read_frames"]
+
+# Raw array message: magic, dtype code, number of dimensions, then one uint32 per dimension and the C-order data.
+MAGIC = b"SRT1"
+HEADER = struct.Struct("<4sBB2x")
+DTYPES = {1: np.dtype(np.uint8), 2: np.dtype(np.uint16), 3: np.dtype(np.float32)}
+CODES = {dtype: code for code, dtype in DTYPES.items()}
+# Progressive stream: frames of magic, position (left, upper) and message length, each followed by a raw array message.
+FRAME_MAGIC = b"SRF1"
+FRAME = struct.Struct("<4sIII")
+
+
+def pack(array: np.ndarray) -> bytes:
+    r""" Raw message of an array, e.g. an H*W*C uint8 image.
+
+    Args:
+        array (np.ndarray): Array of uint8, uint16 or float32.
+
+    Returns:
+        Header followed by the array data.
+    """
+    if array.dtype not in CODES:
+        raise ValueError(f"Unsupported dtype `{array.dtype}`, expected one of {list(CODES)}.")
+    header = HEADER.pack(MAGIC, CODES[array.dtype], array.ndim) + struct.pack(f"<{array.ndim}I", *array.shape)
+    return header + array.tobytes()
+
+
+def unpack(data) -> np.ndarray:
+    r""" Array of a raw message, a read-only view of `data` without a copy.
+
+    Args:
+        data (bytes-like): Message built by `pack`.
+
+    Returns:
+        Array sharing the memory of `data`, `ValueError` for a malformed message.
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("Message is shorter than its header.")
+    magic, code, ndim = HEADER.unpack_from(data)
+    if magic != MAGIC or code not in DTYPES:
+        raise ValueError("Message is not a raw array.")
+    offset = HEADER.size + 4 * ndim
+    if len(data) < offset:
+        raise ValueError(f"Message is shorter than the {ndim} dimensions of its header.")
+    shape = struct.unpack_from(f"<{ndim}I", data, HEADER.size)
+    if 0 in shape:
+        raise ValueError(f"Message has an empty shape {shape}.")
+    count = int(np.prod(shape))
+    if len(data) - offset != count * DTYPES[code].itemsize:
+        raise ValueError(f"Message holds {len(data) - offset} bytes, shape {shape} needs "
+                         f"{count * DTYPES[code].itemsize}.")
+    return np.frombuffer(data, DTYPES[code], count, offset).reshape(shape)
+
+
+def pack_frame(left: int, upper: int, array: np.ndarray) -> bytes:
+    r""" Frame of a progressive stream, an image pasted at a position of the output.
+
+    Args:
+        left (int): Column of the output the image starts at.
+        upper (int): Row of the output the image starts at.
+        array (np.ndarray): Image of the area, see `pack`.
+
+    Returns:
+        Frame header followed by the raw array message.
+    """
+    message = pack(array)
+    return FRAME.pack(FRAME_MAGIC, left, upper, len(message)) + message
+
+
+def read_exactly(stream, size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def read_frames(stream):
+    r""" Frames of a progressive stream, as they arrive.
+
+    Args:
+        stream: File-like object of the stream, e.g. the raw body of a streamed HTTP response.
+
+    Returns:
+        Generator of `((left, upper), array)`.
+    """
+    while True:
+        header = read_exactly(stream, FRAME.size)
+        if not header:
+            return
+        if len(header) < FRAME.size:
+            raise ValueError("Stream ends inside a frame header.")
+        magic, left, upper, length = FRAME.unpack(header)
+        if magic != FRAME_MAGIC:
+            raise ValueError("Stream is not a progressive stream.")
+        message = read_exactly(stream, length)
+        if len(message) < length:
+            raise ValueError(f"Stream ends after {len(message)} of the {length} bytes of a frame.")
+        yield (left, upper), unpack(message)
@@ -0,0 +1,305 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import glob
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+from batcher import DynamicBatcher
+from engine import model_fingerprint
+from engine import select_over_length
+from model import bionet
+from ssrgan.utils import optimize_for_inference
+
+__all__ = ["ModelEntry", "ModelRegistry"]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+
+class ModelEntry(object):
+    r""" One resident checkpoint, with the requests using it and its dynamic batcher."""
+
+    def __init__(self, name: str, model: torch.nn.Module, path: str = None, version: tuple = None) -> None:
+        self.name = name
+        self.model = model
+        self.path = path
+        self.version = version  # Modification time and size of the checkpoint it was loaded from.
+        self.size = sum(tensor.numel() * tensor.element_size()
+                        for tensor in list(model.parameters()) + list(model.buffers()))
+        self.users = 0
+        self.retired = False
+        self.batcher = None
+        self.device = None
+
+    def close(self) -> None:
+        if self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+
+
+class ModelRegistry(object):
+    r""" Checkpoints of `model_dir` served by name, loaded on first use.
+
+    The most recently used models stay resident within `memory_budget`, the least recently used idle ones are
+    evicted. A checkpoint rewritten on disk is loaded again and swapped in: requests running on the old weights
+    finish on them, the next ones get the new weights.
+
+    Examples:
+        >>> registry = ModelRegistry("weights", torch.device("cpu"))
+        >>> registry.start()
+        >>> with registry.acquire("he_40x") as entry:
+        ...     sr = SR(image, entry.model, device, batcher=entry.batcher).run()
+    """
+
+    def __init__(self, model_dir: str = None, device: torch.device = torch.device("cpu"), factory=bionet,
+                 memory_budget: int = 1 << 30, poll_interval: float = 2., batcher_options: dict = None,
+                 factories: dict = None, optimize: bool = False) -> None:
+        r"""
+        Args:
+            model_dir (optional, str): Directory of the `<name>.pth` checkpoints. (Default: ``None``, see `add`).
+            device (optional, torch.device): Device the models run on. (Default: CPU).
+            factory (optional, callable): Builds the model a checkpoint is loaded into. (Default: `bionet`).
+            memory_budget (optional, int): Bytes of weights kept resident. (Default: 1GB).
+            poll_interval (optional, float): Seconds between two looks for new checkpoints. (Default: 2).
+            batcher_options (optional, dict): Arguments of the `DynamicBatcher` of every model, no batcher if
+                ``None``. (Default: ``None``).
+            factories (optional, dict): Builders of the checkpoints whose name starts with a prefix, e.g.
+                `{"dsgan": dsgan}`, the longest prefix wins over `factory`. (Default: ``None``).
+            optimize (optional, bool): Fold the linear operations of every model into its convolutions, see
+                `optimize_for_inference`. (Default: ``False``).
+        """
+        self.model_dir = model_dir
+        self.device = device
+        self.factory = factory
+        self.factories = dict(factories or {})
+        self.optimize = optimize
+        self.memory_budget = memory_budget
+        self.poll_interval = poll_interval
+        self.batcher_options = batcher_options
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.entries = OrderedDict()
+        self.pinned = set()
+
+        self.num_loads = 0
+        self.num_evictions = 0
+        self.num_reloads = 0
+
+    def path(self, name: str) -> str:
+        r""" Checkpoint of a model, `KeyError` if there is none."""
+        if self.model_dir is not None and name == os.path.basename(name) and not name.startswith("."):
+            path = os.path.join(self.model_dir, f"{name}.pth")
+            if os.path.isfile(path):
+                return path
+        raise KeyError(name)
+
+    @staticmethod
+    def version(path: str) -> tuple:
+        status = os.stat(path)
+        return status.st_mtime_ns, status.st_size
+
+    def names(self) -> list:
+        r""" Models that can be served, resident or not."""
+        names = set(self.entries)
+        if self.model_dir is not None:
+            paths = glob.glob(os.path.join(self.model_dir, "*.pth"))
+            names |= {os.path.basename(path)[:-len(".pth")] for path in paths}
+        return sorted(names)
+
+    def add(self, name: str, model: torch.nn.Module) -> ModelEntry:
+        r""" Serve a model built in memory, it is never evicted.
+
+        Args:
+            name (str): Name of the model.
+            model (torch.nn.Module): Model in eval mode.
+        """
+        if self.optimize:
+            model = optimize_for_inference(model, inplace=True, check=True)
+        entry = self.prepare(ModelEntry(name, model))
+        with self.lock:
+            self.entries[name] = entry
+            self.pinned.add(name)
+        return entry
+
+    def build(self, name: str) -> torch.nn.Module:
+        r""" Model of the architecture of a checkpoint, without weights."""
+        prefixes = [prefix for prefix in self.factories if name.startswith(prefix)]
+        return self.factories[max(prefixes, key=len)]() if prefixes else self.factory()
+
+    def load(self, name: str, path: str = None) -> ModelEntry:
+        r""" Build a model and load a checkpoint into it, on the CPU.
+
+        Args:
+            name (str): Name of the model.
+            path (optional, str): Checkpoint. (Default: the checkpoint of `name`).
+        """
+        path = path or self.path(name)
+        version = self.version(path)
+        model = self.build(name)
+        model.load_state_dict(torch.load(path, map_location="cpu"))
+        model.eval()
+        if self.optimize:
+            # The outputs are compared with the loaded weights before the model serves requests.
+            model = optimize_for_inference(model, inplace=True, check=True)
+        logger.info(f"Loaded model `{name}` from `{path}`.")
+        return self.prepare(ModelEntry(name, model, path, version))
+
+    @staticmethod
+    def prepare(entry: ModelEntry) -> ModelEntry:
+        # Measured once per weights, before the model serves requests.
+        select_over_length(entry.model)
+        model_fingerprint(entry.model)
+        return entry
+
+    def preload(self, name: str) -> ModelEntry:
+        r""" Load a model ahead of the requests, e.g. before the worker processes are forked."""
+        return self.get(name)
+
+    def share_memory(self) -> None:
+        r""" Move the weights of the resident models to shared memory, forked processes then reuse their pages."""
+        with self.lock:
+            for entry in self.entries.values():
+                entry.model.share_memory()
+
+    def get(self, name: str) -> ModelEntry:
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                return self.entries[name]
+            loading = self.loading.setdefault(name, threading.Lock())
+
+        # Concurrent requests of the same model wait for a single load.
+        with loading:
+            with self.lock:
+                if name in self.entries:
+                    return self.entries[name]
+            entry = self.load(name)
+            with self.lock:
+                self.entries[name] = entry
+                self.loading.pop(name, None)
+                self.num_loads += 1
+            return entry
+
+    @contextmanager
+    def acquire(self, name: str):
+        r""" Use a model, it stays resident and keeps its weights until the block exits.
+
+        Args:
+            name (str): Name of the model.
+
+        Returns:
+            `ModelEntry` of the model, `KeyError` if there is no such model.
+        """
+        while True:
+            entry = self.get(name)
+            with self.lock:
+                # A reload may have retired the entry in between, take the new one.
+                if entry.retired:
+                    continue
+                entry.users += 1
+                if entry.device != self.device:
+                    entry.model.to(self.device)
+                    entry.device = self.device
+                if entry.batcher is None and self.batcher_options is not None:
+                    entry.batcher = DynamicBatcher(entry.model, self.device, **self.batcher_options)
+                self.evict()
+            break
+
+        try:
+            yield entry
+        finally:
+            self.release(entry)
+
+    def release(self, entry: ModelEntry) -> None:
+        with self.lock:
+            entry.users -= 1
+            if entry.retired and entry.users == 0:
+                entry.close()
+
+    def retire(self, entry: ModelEntry) -> None:
+        r""" Take an entry out of service, it is closed once its last request has finished. Needs `lock`."""
+        entry.retired = True
+        if entry.users == 0:
+            entry.close()
+
+    def evict(self) -> None:
+        r""" Evict the least recently used idle models until the resident weights fit the budget. Needs `lock`."""
+        resident = sum(entry.size for entry in self.entries.values())
+        for name in list(self.entries):
+            if resident <= self.memory_budget:
+                break
+            entry = self.entries[name]
+            if name in self.pinned or entry.users > 0:
+                continue
+            del self.entries[name]
+            self.retire(entry)
+            resident -= entry.size
+            self.num_evictions += 1
+            logger.info(f"Evicted model `{name}` ({entry.size / (1 << 20):.1f}MB).")
+
+    def reload(self) -> None:
+        r""" Swap in the resident models whose checkpoint has changed on disk."""
+        with self.lock:
+            candidates = [entry for entry in self.entries.values() if entry.path is not None]
+        for entry in candidates:
+            try:
+                version = self.version(entry.path)
+            except OSError:
+                continue
+            if version == entry.version:
+                continue
+            # A checkpoint still being copied changes between two looks, it is loaded once it is stable.
+            time.sleep(min(self.poll_interval, 0.5))
+            try:
+                if self.version(entry.path) != version:
+                    continue
+                new_entry = self.load(entry.name, entry.path)
+            except Exception as error:
+                logger.warning(f"Reloading model `{entry.name}` failed, keeping the resident weights: {error}")
+                entry.version = version
+                continue
+
+            with self.lock:
+                if self.entries.get(entry.name) is entry:
+                    self.entries[entry.name] = new_entry
+                    self.retire(entry)
+                    self.num_reloads += 1
+            logger.info(f"Swapped in new weights of model `{entry.name}`.")
+
+    def start(self) -> None:
+        r""" Look for new checkpoints in the background."""
+
+        def work() -> None:
+            while True:
+                time.sleep(self.poll_interval)
+                self.reload()
+
+        threading.Thread(target=work, name="registry", daemon=True).start()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"resident": {name: {"mb": round(entry.size / (1 << 20), 2),
+                                        "users": entry.users,
+                                        "batcher": entry.batcher.stats() if entry.batcher is not None else None}
+                                 for name, entry in self.entries.items()},
+                    "budget_mb": round(self.memory_budget / (1 << 20), 2),
+                    "loads": self.num_loads,
+                    "evictions": self.num_evictions,
+                    "reloads": self.num_reloads}
@@ -0,0 +1,214 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import json
+import logging
+import statistics
+import threading
+import time
+import warnings
+
+from PIL import ImageFile
+
+from metrics import DEADLINES_MISSED
+from metrics import QUEUE_DELAY
+from metrics import REGISTRY
+from tiler import Tiler
+
+__all__ = ["Scheduler"]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+
+class Scheduler(object):
+    r""" Order the files of the super-resolution jobs by priority class, then by cost or by deadline.
+
+    Every priority class has a deadline, the seconds its files may wait from their submission to the start of their
+    super-resolution. The class of an object is given by the longest matching key prefix of `rules`.
+
+    The cost of a file is the number of low-resolution pixels its tiles send through the model. It is found from the
+    image dimensions in the header of the object, so the files are ordered before they are downloaded. Policies:
+
+    - ``fifo``: the order of the listing within a class.
+    - ``sjf``: shortest job first within a class, thumbnails do not wait behind slides. Images of the same size follow
+      each other, their tiles have the same shape and batch together.
+    - ``edf``: earliest deadline first over all classes, a file of a lower class is not starved once it is late.
+
+    Examples:
+        >>> scheduler = Scheduler({"urgent": 30, "default": 300}, {"urgent/": "urgent"}, policy="sjf")
+        >>> files = [scheduler.plan({"cos_path": cos_path}, header, time.time()) for cos_path, header in headers]
+        >>> for file in scheduler.order(files):
+        ...     scheduler.start(file)
+    """
+
+    policies = ("fifo", "sjf", "edf")
+
+    def __init__(self, classes: dict = None, rules: dict = None, policy: str = "sjf", default: str = None,
+                 tiler: Tiler = None) -> None:
+        r"""
+        Args:
+            classes (optional, dict): Deadline in seconds of every priority class, the most urgent class first.
+                (Default: ``None``, a single `default` class of 300 seconds).
+            rules (optional, dict): Priority class of the keys starting with every prefix. (Default: ``None``).
+            policy (optional, str): Order within the classes, `fifo`, `sjf` or `edf`. (Default: `sjf`).
+            default (optional, str): Class of the keys no rule matches. (Default: ``None``, `default` if there is such
+                a class, otherwise the last one).
+            tiler (optional, Tiler): Tile grid the cost is counted on. (Default: ``None``, 512 pixel tiles).
+        """
+        if policy not in self.policies:
+            raise ValueError(f"Unknown policy `{policy}`, expected one of {self.policies}.")
+        self.classes = dict(classes) if classes else {"default": 300.}
+        self.rules = dict(rules or {})
+        self.policy = policy
+        if default is None:
+            default = "default" if "default" in self.classes else list(self.classes)[-1]
+        self.default = default
+        for name in list(self.rules.values()) + [default]:
+            if name not in self.classes:
+                raise ValueError(f"Unknown priority class `{name}`, expected one of {list(self.classes)}.")
+        self.tiler = Tiler() if tiler is None else tiler
+
+        self.lock = threading.Lock()
+        # Moving average of the inference speed, reported by `stats`.
+        self.seconds_per_pixel = None
+
+    def rank(self, name: str) -> int:
+        return list(self.classes).index(name)
+
+    def classify(self, cos_path: str) -> str:
+        r""" Priority class of an object, by the longest prefix of `rules` its key starts with."""
+        prefixes = [prefix for prefix in self.rules if cos_path.startswith(prefix)]
+        return self.rules[max(prefixes, key=len)] if prefixes else self.default
+
+    def split(self, cos_paths: list, name: str = None) -> dict:
+        r""" Group objects by priority class.
+
+        Args:
+            cos_paths (list): COS url addresses.
+            name (optional, str): Class of all of them. (Default: ``None``, by `rules`).
+
+        Returns:
+            COS url addresses of every class, the most urgent class first.
+        """
+        groups = {}
+        for cos_path in cos_paths:
+            groups.setdefault(name or self.classify(cos_path), []).append(cos_path)
+        return {name: groups[name] for name in self.classes if name in groups}
+
+    def job_priority(self, name: str, submitted: float = None) -> float:
+        r""" Sort key of a job of a class in the job queue, the smaller the sooner."""
+        if self.policy == "edf":
+            return (time.time() if submitted is None else submitted) + self.classes[name]
+        return float(self.rank(name))
+
+    @staticmethod
+    def dimensions(header: bytes):
+        r""" Width and height of an image from its first bytes, ``None`` if the header is not among them."""
+        parser = ImageFile.Parser()
+        try:
+            with warnings.catch_warnings():
+                # Formats with the header at the end, e.g. some TIFF, warn about the missing bytes.
+                warnings.simplefilter("ignore")
+                parser.feed(header)
+        except (OSError, SyntaxError, ValueError):
+            return None
+        return parser.image.size if parser.image is not None else None
+
+    def cost(self, width: int, height: int) -> int:
+        r""" Low-resolution pixels of all the tiles of an image, overlaps included."""
+        return sum((tile.box[2] - tile.box[0]) * (tile.box[3] - tile.box[1])
+                   for tile in self.tiler.tiles(width, height))
+
+    def plan(self, job: dict, header: bytes, submitted: float, name: str = None) -> dict:
+        r""" Add the priority class, cost and deadline to the job of a file.
+
+        Args:
+            job (dict): Job of a file, with its `cos_path`.
+            header (bytes): First bytes of the object, ``None`` if they could not be read.
+            submitted (float): Time the file was submitted.
+            name (optional, str): Priority class. (Default: ``None``, by `rules`).
+
+        Returns:
+            The job.
+        """
+        name = name or self.classify(job["cos_path"])
+        size = self.dimensions(header) if header is not None else None
+        job.update({"priority": name,
+                    "cost": self.cost(*size) if size is not None else None,
+                    "submitted": submitted,
+                    "deadline": submitted + self.classes[name]})
+        return job
+
+    def order(self, jobs: list) -> list:
+        r""" Jobs of files in the order they should be processed.
+
+        Files with an unknown cost are counted at the median cost of the others.
+        """
+        costs = [job["cost"] for job in jobs if job["cost"] is not None]
+        median = statistics.median(costs) if costs else 0
+        for job in jobs:
+            if job["cost"] is None:
+                job["cost"] = median
+
+        def key(item):
+            index, job = item
+            if self.policy == "edf":
+                return job["deadline"], job["cost"], index
+            if self.policy == "sjf":
+                return self.rank(job["priority"]), job["cost"], index
+            return self.rank(job["priority"]), job["submitted"], index
+
+        return [job for _, job in sorted(enumerate(jobs), key=key)]
+
+    def start(self, job: dict) -> float:
+        r""" Record the queueing delay of a file whose super-resolution starts.
+
+        Returns:
+            Seconds the file waited.
+        """
+        now = time.time()
+        delay = max(now - job["submitted"], 0.)
+        QUEUE_DELAY.observe(delay, priority=job["priority"])
+        if now > job["deadline"]:
+            DEADLINES_MISSED.inc(priority=job["priority"])
+        return delay
+
+    def observe(self, job: dict, seconds: float) -> None:
+        r""" Update the inference speed with the time a file took."""
+        if not job["cost"]:
+            return
+        with self.lock:
+            rate = seconds / job["cost"]
+            self.seconds_per_pixel = rate if self.seconds_per_pixel is None else \
+                0.8 * self.seconds_per_pixel + 0.2 * rate
+
+    def stats(self) -> dict:
+        r""" Policy, and the deadline, queueing delay percentiles and missed deadlines of every class, over all the
+        worker processes.
+        """
+        delays = REGISTRY.values(QUEUE_DELAY)
+        missed = REGISTRY.values(DEADLINES_MISSED)
+        classes = {}
+        for name, deadline in self.classes.items():
+            key = json.dumps(QUEUE_DELAY.key({"priority": name}))
+            counts = delays.get(key, [0] * (len(QUEUE_DELAY.buckets) + 2))[:-1]
+            files = sum(counts)
+            classes[name] = {"deadline": deadline,
+                             "files": files,
+                             "missed": missed.get(key, 0),
+                             "p50": round(QUEUE_DELAY.quantile(0.5, counts), 3) if files else None,
+                             "p95": round(QUEUE_DELAY.quantile(0.95, counts), 3) if files else None}
+        with self.lock:
+            speed = None if self.seconds_per_pixel is None else round(self.seconds_per_pixel * 1e6, 4)
+        return {"policy": self.policy, "seconds_per_megapixel": speed, "classes": classes}
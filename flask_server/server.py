@@ -11,18 +11,67 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 # ==============================================================================
+import argparse
+import json
 import os
+import shutil
+import time
+from collections import OrderedDict
+from contextlib import ExitStack
+from contextlib import contextmanager
 
 import cv2
+import numpy as np
 import torch
 from flask import Flask
+from flask import g
+from flask import Response
 from flask import jsonify
 from flask import request
+from gevent import get_hub
 from gevent import pywsgi
+from gevent import socket
+from qcloud_cos.cos_exception import CosClientError
+from qcloud_cos.cos_exception import CosServiceError
 
+from deepzoom import DeepZoom
 from engine import COS
+from engine import ProgressiveSR
+from engine import RegionSR
 from engine import SR
+from engine import TileCache
+from engine import model_fingerprint
+from encoder import Encoder
+from index import ObjectIndex
+from jobs import JobQueue
+from local_cos import LocalCosS3Client
+from metrics import BYTES
+from metrics import CACHE
+from metrics import CACHE_BYTES_SAVED
+from metrics import MACS
+from metrics import QUEUE_DEPTH
+from metrics import REGISTRY
+from metrics import REQUESTS
+from metrics import REQUEST_SECONDS
+from metrics import STAGE_SECONDS
+from metrics import timed
 from model import bionet
+from pipeline import Pipeline
+from pipeline import Stage
+from prefork import bind
+from prefork import prefork
+from protocol import MAGIC
+from protocol import pack
+from protocol import pack_frame
+from protocol import unpack
+from registry import ModelRegistry
+from router import ComplexityRouter
+from router import parse_routes
+from scheduler import Scheduler
+from tissue import TissueDetector
+from transfer import TransferManager
+from ssrgan.models import dsgan
+from ssrgan.models import rfb_esrgan
 from ssrgan.utils import create_folder
 from ssrgan.utils import select_device
 
@@ -30,59 +79,600 @@ from ssrgan.utils import select_device
 app = Flask(__name__)
 
 
+@timed("job_download")
+def download(job: dict):
+    # Step 1: Skip the objects processed since they were listed.
+    if index.is_processed(job["cos_path"]):
+        print(f"Filter `{job['filename']}`.")
+        jobs.advance(job["job_id"])
+        return None
+
+    # Step 2: Download image to `static/lr`.
+    print(f"Download `{job['filename']}`.")
+    transfers.download(job["lr_file_path"], job["cos_path"]).result()
+    return job
+
+
+@timed("job_decode")
+def decode(job: dict):
+    with STAGE_SECONDS.time(stage="decode"):
+        job["image"] = cv2.cvtColor(cv2.imread(job["lr_file_path"]), cv2.COLOR_BGR2RGB)
+    return job
+
+
+@contextmanager
+def acquire_router():
+    r""" Router of `--route` over the resident models, ``None`` without `--route`."""
+    if routes is None:
+        yield None
+        return
+    names, thresholds = routes
+    with ExitStack() as stack:
+        models = OrderedDict((name, None if name == "bicubic" else stack.enter_context(registry.acquire(name)).model)
+                             for name in names)
+        yield ComplexityRouter(models, thresholds)
+
+
+@timed("job_inference")
+def inference(job: dict):
+    # Step 3: Start super-resolution.
+    delay = scheduler.start(job)
+    print(f"Process `{job['filename']}` of class `{job['priority']}` after {delay:.1f}s.")
+    start = time.perf_counter()
+    with registry.acquire(args.model) as entry, acquire_router() as router:
+        job["sr"] = SR(job.pop("image"), entry.model, device, tissue_detector=tissue_detector, cache=cache,
+                       batcher=entry.batcher, router=router).run(args.bit_depth)
+    scheduler.observe(job, time.perf_counter() - start)
+    torch.cuda.empty_cache()  # Clear CUDA cache.
+    return job
+
+
+def get_encoder(format: str, bit_depth: int = None) -> Encoder:
+    bit_depth = bit_depth or args.bit_depth
+    if (format, bit_depth) not in encoders:
+        encoders[format, bit_depth] = Encoder(format, bit_depth, args.compression, args.quality)
+    return encoders[format, bit_depth]
+
+
+@timed("job_encode")
+def encode(job: dict):
+    # Step 4: Encode the super-resolution image into bytes, the local copy is optional.
+    sr_file_path = job["sr_file_path"] if args.save_sr else None
+    # The result keeps the format of the object it replaces, unless `--format` is given.
+    encoder = get_encoder(args.format or os.path.splitext(job["filename"])[1])
+    job["sr_image_bytes"] = encoder.encode(job.pop("sr"), sr_file_path)
+    return job
+
+
+@timed("job_upload")
+def upload(job: dict):
+    # Step 5: Upload image to COS.
+    print(f"Upload `{job['filename']}`.")
+    response = transfers.upload(job.pop("sr_image_bytes"), job["cos_path"]).result()
+    # The result replaces the input, its ETag keeps the next listing from queueing it again.
+    index.mark_processed(job["cos_path"], response["ETag"])
+    jobs.advance(job["job_id"])
+    return job
+
+
+def failed(job: dict, error: Exception):
+    print(f"Failed `{job['filename']}`: {error}.")
+    index.mark_failed(job["cos_path"])
+    jobs.advance(job["job_id"], failed=True)
+
+
+def plan(job_id: str, cos_paths: list) -> list:
+    r""" Jobs of the files of a job, in the order of the scheduler."""
+    status = jobs.status(job_id)
+    # The dimensions of every image are read from the header of the object, before it is downloaded.
+    headers = [transfers.read_header(cos_path) for cos_path in cos_paths]
+    files = []
+    for cos_path, header in zip(cos_paths, headers):
+        try:
+            header = header.result()
+        except (CosClientError, CosServiceError):
+            # Counted at the median cost, the download reports the error.
+            header = None
+        filename = os.path.basename(cos_path)
+        files.append(scheduler.plan({"job_id": job_id,
+                                     "cos_path": cos_path,
+                                     "filename": filename,
+                                     "lr_file_path": os.path.join(lr_path, filename),
+                                     "sr_file_path": os.path.join(sr_path, filename)},
+                                    header, status["created"], status["priority_class"]))
+    return scheduler.order(files)
+
+
+def start_pipeline() -> Pipeline:
+    # Download, decode, encode and upload run on thread pools, so the model always has images queued.
+    pipeline = Pipeline([Stage("download", download, workers=4),
+                         Stage("decode", decode, workers=2),
+                         Stage("inference", inference, workers=1, queue_size=2),
+                         Stage("encode", encode, workers=2),
+                         Stage("upload", upload, workers=4)],
+                        on_error=failed)
+    pipeline.start()
+    return pipeline
+
+
+def process(job_id: str, cos_paths: list):
+    pipeline = start_pipeline()
+    priority = jobs.status(job_id)["priority"]
+    for job in plan(job_id, cos_paths):
+        if jobs.waiting(priority):
+            # Urgent jobs submitted meanwhile run first. The files in flight are finished before, so the urgent
+            # job has the device to itself, then this job resumes with the files left.
+            pipeline.join()
+            jobs.preempt(priority)
+            pipeline = start_pipeline()
+        pipeline.put(job)
+
+    pipeline.join()
+    print(f"Tile cache {cache.stats()}.")
+    print(f"Transfers {transfers.stats()}.")
+
+
+def list_objects(name: str = None) -> dict:
+    r""" List the bucket and queue its new objects, on the listing thread of the job queue.
+
+    Returns:
+        Ids of the submitted jobs by priority class.
+    """
+    # The objects uploaded since the last listing are queued. A full listing every `--full-listing-interval`
+    # also finds the new keys sorting before the watermark, e.g. of another prefix.
+    full = time.time() - index.listed(cos.Bucket) >= args.full_listing_interval
+    url_lists = cos.list_new_objects(index, full)
+    # Failed objects due for a retry and those of interrupted jobs run again, unless a job still holds them.
+    skip = jobs.active_paths() | set(url_lists)
+    url_lists += [cos_path for cos_path in index.pending() if cos_path not in skip]
+
+    # Every priority class is a job of its own, which runs before the jobs of the less urgent classes.
+    # A job still waiting for the same files is reused.
+    job_ids = {}
+    for priority_class, cos_paths in scheduler.split(url_lists, name).items():
+        job_ids[priority_class] = jobs.submit(cos_paths, scheduler.job_priority(priority_class), priority_class)
+    return job_ids
+
+
 @app.route("/run", methods=["POST"])
 def run():
     if request.method == "POST":
-        for index in range(len(url_lists)):
-            cos_path = url_lists[index]
-            filename = os.path.basename(cos_path)
-            lr_file_path = os.path.join(os.path.join(lr_path, filename))
-            sr_file_path = os.path.join(os.path.join(sr_path, filename))
-
-            # Step 1: If the file exists, it is considered that it has been processed by default.
-            if not os.path.exists(lr_file_path):
-                # Step 2: Download image to `static/lr`.
-                print(f"Download `{filename}`.")
-                cos.download_file(lr_file_path, cos_path)
-
-                # Step 3: Start super-resolution.
-                print(f"Process `{filename}`.")
-                sr = SR(lr_file_path, model, device).run()
-                cv2.imwrite(sr_file_path, sr)
-
-                # Step 4: Read the super-resolution image into bytes.
-                sr_image_bytes = open(sr_file_path, "rb").read()
-
-                # Step 5: Upload image to COS.
-                print(f"Upload `{filename}`.")
-                cos.upload_file(sr_image_bytes, cos_path)
-            else:
-                print(f"Filter `{filename}`.")
-            torch.cuda.empty_cache()  # Clear CUDA cache.
-        return jsonify({"code": 20000, "msg": "SR complete!"})
+        # The priority class of all the new objects, given by `?priority=`, otherwise by their keys.
+        name = request.args.get("priority")
+        if name is not None and name not in scheduler.classes:
+            return jsonify({"code": 40000, "msg": f"Unknown priority class `{name}`, "
+                                                  f"expected one of {list(scheduler.classes)}."}), 400
+
+        # The bucket is listed in the background, `/listings/<listing_id>` gives the jobs it queued.
+        listing_id = jobs.request_listing(name)
+        return jsonify({"code": 20000, "msg": "Listing queued!", "listing_id": listing_id, **jobs.depth()})
+
+
+@app.route("/listings/<listing_id>", methods=["GET"])
+def listing_status(listing_id: str):
+    status = jobs.listing(listing_id)
+    if status is None:
+        return jsonify({"code": 40400, "msg": f"Listing `{listing_id}` not found!"}), 404
+    return jsonify({"code": 20000, "msg": "OK", "listing": status})
+
+
+def super_resolve(image: np.ndarray, name: str, encoder: Encoder = None) -> bytes:
+    bit_depth = 8 if encoder is None else encoder.bit_depth
+    with registry.acquire(name) as entry:
+        sr = SR(image, entry.model, device, cache=cache, batcher=entry.batcher).run(bit_depth)
+    if encoder is None:
+        # Raw RGB array for `/sr/raw`.
+        return pack(sr[:, :, ::-1])
+    return encoder.encode(sr)
+
+
+def model_name():
+    r""" Model of a request, given by `?model=`, ``None`` if there is no such model."""
+    name = request.args.get("model", args.model)
+    return name if name in registry.names() else None
+
+
+@app.route("/sr", methods=["POST"])
+def sr_image():
+    # The image is the `image` file of a form, or the body of the request.
+    data = request.files["image"].read() if "image" in request.files else request.get_data()
+    with STAGE_SECONDS.time(stage="decode"):
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return jsonify({"code": 40000, "msg": "Request body is not an image!"}), 400
+    try:
+        encoder = get_encoder(request.args.get("format", ".png"))
+    except ValueError as error:
+        return jsonify({"code": 40000, "msg": str(error)}), 400
+    name = model_name()
+    if name is None:
+        return jsonify({"code": 40400, "msg": f"Model `{request.args.get('model')}` not found!"}), 404
+
+    # Inference runs on a native thread, so the tiles of concurrent requests meet in the batcher.
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    stream = get_hub().threadpool.apply(super_resolve, (image, name, encoder))
+    return Response(stream, mimetype=f"image/{encoder.format.lstrip('.').replace('jpg', 'jpeg')}")
+
+
+@app.route("/sr/raw", methods=["POST"])
+def sr_raw():
+    # The body is a raw H*W*3 uint8 RGB image built by `protocol.pack`, it is used without decoding or copying.
+    try:
+        image = unpack(request.get_data())
+    except ValueError as error:
+        return jsonify({"code": 40000, "msg": str(error)}), 400
+    if image.dtype != np.uint8 or image.ndim != 3 or image.shape[2] != 3:
+        return jsonify({"code": 40000, "msg": f"Expected a H*W*3 uint8 image, got {image.shape} {image.dtype}."}), 400
+
+    name = model_name()
+    if name is None:
+        return jsonify({"code": 40400, "msg": f"Model `{request.args.get('model')}` not found!"}), 404
+
+    stream = get_hub().threadpool.apply(super_resolve, (image, name))
+    return Response(stream, mimetype="application/octet-stream")
+
+
+def progressive_frames(image: np.ndarray, name: str, order: str, viewport: tuple):
+    # Every update is computed on a native thread, the frames are sent as soon as they are ready.
+    with registry.acquire(name) as entry:
+        updates = ProgressiveSR(image, entry.model, device, cache=cache, batcher=entry.batcher, order=order,
+                                viewport=viewport).updates()
+        threadpool = get_hub().threadpool
+        while True:
+            update = threadpool.apply(next, (updates, None))
+            if update is None:
+                break
+            (left, upper), sr = update
+            yield pack_frame(left, upper, sr)
+
+
+@app.route("/sr/progressive", methods=["POST"])
+def sr_progressive():
+    # The body is a raw H*W*3 uint8 RGB image, as for `/sr/raw`. The response is a stream of `protocol` frames,
+    # the bicubic preview of the whole image, then the refined tiles, those of `?viewport=` or the centre first.
+    try:
+        image = unpack(request.get_data())
+    except ValueError as error:
+        return jsonify({"code": 40000, "msg": str(error)}), 400
+    if image.dtype != np.uint8 or image.ndim != 3 or image.shape[2] != 3:
+        return jsonify({"code": 40000, "msg": f"Expected a H*W*3 uint8 image, got {image.shape} {image.dtype}."}), 400
+
+    order = request.args.get("order", "centre")
+    viewport = request.args.get("viewport")
+    try:
+        # `left,upper,right,lower` in low-resolution pixels.
+        viewport = tuple(int(value) for value in viewport.split(",")) if viewport else None
+        if viewport is not None and len(viewport) != 4:
+            raise ValueError
+    except ValueError:
+        return jsonify({"code": 40000, "msg": "Expected `?viewport=left,upper,right,lower`."}), 400
+    if viewport is None and order not in ProgressiveSR.orders or order == "viewport" and viewport is None:
+        return jsonify({"code": 40000, "msg": f"Expected `?order=` in {list(ProgressiveSR.orders)}, "
+                                              f"`viewport` with `?viewport=`."}), 400
+
+    name = model_name()
+    if name is None:
+        return jsonify({"code": 40400, "msg": f"Model `{request.args.get('model')}` not found!"}), 404
+
+    return Response(progressive_frames(image, name, order, viewport), mimetype="application/octet-stream")
+
+
+def super_resolve_region(source, box: tuple, name: str, encoder: Encoder) -> bytes:
+    with registry.acquire(name) as entry:
+        sr = RegionSR(source, box, entry.model, device, args.roi_tile_size, cache=cache,
+                      batcher=entry.batcher).run(encoder.bit_depth)
+    return encoder.encode(sr)
+
+
+@app.route("/sr/roi", methods=["POST"])
+def sr_roi():
+    # The region `?box=left,upper,right,lower` in low-resolution pixels, of the slide `?slide=` of `static/slides`,
+    # or of the image in the body, raw as for `/sr/raw` or encoded as for `/sr`.
+    try:
+        box = tuple(int(value) for value in request.args.get("box", "").split(","))
+        if len(box) != 4:
+            raise ValueError
+    except ValueError:
+        return jsonify({"code": 40000, "msg": "Expected `?box=left,upper,right,lower`."}), 400
+
+    slide = request.args.get("slide")
+    if slide is not None:
+        # Memory-mapped slides are only read around the region.
+        source = os.path.join(slides_path, os.path.basename(slide))
+        if not os.path.isfile(source):
+            return jsonify({"code": 40400, "msg": f"Slide `{slide}` not found!"}), 404
+    else:
+        data = request.files["image"].read() if "image" in request.files else request.get_data()
+        if data[:len(MAGIC)] == MAGIC:
+            try:
+                source = unpack(data)
+            except ValueError as error:
+                return jsonify({"code": 40000, "msg": str(error)}), 400
+        else:
+            with STAGE_SECONDS.time(stage="decode"):
+                source = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if source is None:
+                return jsonify({"code": 40000, "msg": "Request body is not an image!"}), 400
+            source = cv2.cvtColor(source, cv2.COLOR_BGR2RGB)
+        if source.dtype != np.uint8 or source.ndim != 3 or source.shape[2] != 3:
+            return jsonify({"code": 40000, "msg": f"Expected a H*W*3 uint8 image, "
+                                                  f"got {source.shape} {source.dtype}."}), 400
+
+    try:
+        encoder = get_encoder(request.args.get("format", ".png"))
+    except ValueError as error:
+        return jsonify({"code": 40000, "msg": str(error)}), 400
+    name = model_name()
+    if name is None:
+        return jsonify({"code": 40400, "msg": f"Model `{request.args.get('model')}` not found!"}), 404
+
+    try:
+        stream = get_hub().threadpool.apply(super_resolve_region, (source, box, name, encoder))
+    except ValueError as error:
+        return jsonify({"code": 40000, "msg": str(error)}), 400
+    return Response(stream, mimetype=f"image/{encoder.format.lstrip('.').replace('jpg', 'jpeg')}")
+
+
+def get_pyramid(name: str):
+    r""" Pyramid of a slide of `static/slides`, ``None`` if there is no such slide."""
+    path = os.path.join(slides_path, os.path.basename(name))
+    if not os.path.isfile(path):
+        return None
+    # A rewritten slide gets a new pyramid, its tiles have other cache keys.
+    version = (os.path.getmtime(path), os.path.getsize(path))
+    if name not in pyramids or pyramids[name][0] != version:
+        pyramids[name] = version, DeepZoom(path, args.deepzoom_tile_size, cache=pyramid_cache)
+    return pyramids[name][1]
+
+
+def render_tile(pyramid: DeepZoom, level: int, column: int, row: int, name: str, encoder: Encoder) -> bytes:
+    with registry.acquire(name) as entry:
+        def upscale(box: tuple) -> np.ndarray:
+            return RegionSR(pyramid.reader, box, entry.model, device, args.roi_tile_size, cache=cache,
+                            batcher=entry.batcher).run(8)[:, :, ::-1]
+
+        tile = pyramid.tile(level, column, row, upscale, model_fingerprint(entry.model))
+    return encoder.encode(cv2.cvtColor(tile, cv2.COLOR_RGB2BGR))
+
+
+@app.route("/deepzoom/<slide>.dzi", methods=["GET"])
+def deepzoom_descriptor(slide: str):
+    # DZI of the super-resolution of a slide of `static/slides`, e.g. for OpenSeadragon.
+    pyramid = get_pyramid(slide)
+    if pyramid is None:
+        return jsonify({"code": 40400, "msg": f"Slide `{slide}` not found!"}), 404
+    return Response(pyramid.descriptor(request.args.get("format", ".jpg")), mimetype="application/xml")
+
+
+@app.route("/deepzoom/<slide>_files/<int:level>/<int:column>_<int:row>.<format>", methods=["GET"])
+def deepzoom_tile(slide: str, level: int, column: int, row: int, format: str):
+    # Only the tiles of the deepest level run the generator, the others are downsampled from cached tiles.
+    pyramid = get_pyramid(slide)
+    if pyramid is None:
+        return jsonify({"code": 40400, "msg": f"Slide `{slide}` not found!"}), 404
+    try:
+        encoder = get_encoder(format, 8)
+    except ValueError as error:
+        return jsonify({"code": 40000, "msg": str(error)}), 400
+    name = model_name()
+    if name is None:
+        return jsonify({"code": 40400, "msg": f"Model `{request.args.get('model')}` not found!"}), 404
+
+    try:
+        stream = get_hub().threadpool.apply(render_tile, (pyramid, level, column, row, name, encoder))
+    except ValueError as error:
+        return jsonify({"code": 40400, "msg": str(error)}), 404
+    return Response(stream, mimetype=f"image/{encoder.format.lstrip('.').replace('jpg', 'jpeg')}")
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id: str):
+    status = jobs.status(job_id)
+    if status is None:
+        return jsonify({"code": 40400, "msg": f"Job `{job_id}` not found!"}), 404
+    return jsonify({"code": 20000, "msg": "OK", "job": status})
+
+
+@app.route("/status", methods=["GET"])
+def queue_status():
+    # Multiply-accumulates of the routed tiles over all the workers, and the share the router saved.
+    macs = REGISTRY.values(MACS)
+    used, full = (macs.get(json.dumps(MACS.key({"kind": kind})), 0.) for kind in ("used", "full"))
+    router = {"routes": args.route, "gmacs": round(used / 1e9, 2),
+              "compute_saved": round(1 - used / full, 4) if full else None}
+    # Hits, misses and bytes saved of the tile caches over all the workers.
+    lookups, saved = REGISTRY.values(CACHE), REGISTRY.values(CACHE_BYTES_SAVED)
+    caches = {name: {"hits": int(lookups.get(json.dumps(CACHE.key({"cache": name, "result": "hit"})), 0)),
+                     "misses": int(lookups.get(json.dumps(CACHE.key({"cache": name, "result": "miss"})), 0)),
+                     "bytes_saved": int(saved.get(json.dumps(CACHE_BYTES_SAVED.key({"cache": name})), 0))}
+              for name in ("tiles", "deepzoom")}
+    model_stats = registry.stats()
+    # `batcher` is the batcher of the default model, as before the registry, for the readers of that field.
+    batcher = model_stats["resident"].get(args.model, {}).get("batcher")
+    return jsonify({"code": 20000, "msg": "OK", **jobs.depth(), "models": model_stats, "batcher": batcher,
+                    "scheduler": scheduler.stats(), "router": router, "caches": caches,
+                    "dead_objects": index.dead()})
+
+
+@app.route("/models", methods=["GET"])
+def models():
+    return jsonify({"code": 20000, "msg": "OK", "models": registry.names(), "default": args.model})
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    depth = jobs.depth()
+    QUEUE_DEPTH.set(depth["queued_jobs"], queue="jobs")
+    QUEUE_DEPTH.set(depth["queued_files"], queue="files")
+    QUEUE_DEPTH.set(int(depth["running"] is not None), queue="running")
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.before_request
+def start_timer():
+    g.start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response: Response) -> Response:
+    # Routes rather than paths, so job ids do not become labels.
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unknown"
+    REQUEST_SECONDS.observe(time.perf_counter() - g.start, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, code=response.status_code)
+    BYTES.inc(request.content_length or 0, direction="in", source="http")
+    BYTES.inc(response.calculate_content_length() or 0, direction="out", source="http")
+    return response
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Super-resolution server of the COS bucket.")
+    parser.add_argument("--local-cos", type=str, default=None,
+                        help="Serve a local directory instead of Tencent COS, every bucket is a sub-directory.")
+    parser.add_argument("--bucket", type=str, default=None,
+                        help="Bucket storage name. (Default: the bucket of `COS`).")
+    parser.add_argument("--port", type=int, default=10086,
+                        help="Port of the server. (Default: 10086).")
+    parser.add_argument("--format", type=str, default=None,
+                        help="Format of the results, e.g. `.png`. (Default: the format of every object).")
+    parser.add_argument("--bit-depth", type=int, default=8, choices=[8, 16],
+                        help="Bits per channel of the results, 16 for PNG and TIFF only. (Default: 8).")
+    parser.add_argument("--compression", type=int, default=3,
+                        help="PNG compression level from 0 (fastest) to 9 (smallest). (Default: 3).")
+    parser.add_argument("--quality", type=int, default=95,
+                        help="JPEG and WebP quality from 0 to 100. (Default: 95).")
+    parser.add_argument("--save-sr", action="store_true",
+                        help="Also save the results to `static/sr`.")
+    parser.add_argument("--skip-background", action="store_true",
+                        help="Upsample the background tiles of the COS objects with bicubic and keep the model for "
+                             "tissue, for slides only.")
+    parser.add_argument("--max-batch-size", type=int, default=16,
+                        help="Tiles of concurrent requests run in one forward pass. (Default: 16).")
+    parser.add_argument("--max-wait", type=float, default=10,
+                        help="Milliseconds a tile waits for others to join its batch, "
+                             "more raises the throughput and the p99 latency. (Default: 10).")
+    parser.add_argument("--model-dir", type=str, default=None,
+                        help="Directory of the `<name>.pth` checkpoints, rewritten files are swapped in. "
+                             "(Default: an untrained model).")
+    parser.add_argument("--model", type=str, default="bionet",
+                        help="Model of the COS jobs and of the requests without `?model=`. (Default: bionet).")
+    parser.add_argument("--model-budget", type=int, default=1024,
+                        help="MB of model weights kept resident, least recently used ones are evicted. "
+                             "(Default: 1024).")
+    parser.add_argument("--schedule", type=str, default="sjf", choices=Scheduler.policies,
+                        help="Order of the files of a priority class, `fifo`, shortest job first `sjf`, "
+                             "or earliest deadline first over all classes `edf`. (Default: sjf).")
+    parser.add_argument("--priority-classes", type=str, default="default=300",
+                        help="Priority classes and the seconds their files may wait, the most urgent first, "
+                             "e.g. `urgent=30,default=300,bulk=3600`. (Default: default=300).")
+    parser.add_argument("--priority-rules", type=str, default="",
+                        help="Priority class of the keys starting with a prefix, e.g. `urgent/=urgent,archive/=bulk`, "
+                             "`/run?priority=` overrides it. (Default: every key in `default`).")
+    parser.add_argument("--roi-tile-size", type=int, default=256,
+                        help="Low resolution tile size of `/sr/roi`, smaller tiles read less around the region. "
+                             "(Default: 256).")
+    parser.add_argument("--deepzoom-tile-size", type=int, default=254,
+                        help="Tile size of the `/deepzoom` pyramids, without the 1 pixel overlap. (Default: 254).")
+    parser.add_argument("--deepzoom-budget", type=int, default=4096,
+                        help="MB of `/deepzoom` tiles every worker keeps on disk, least recently used ones are evicted. "
+                             "(Default: 4096).")
+    parser.add_argument("--route", type=str, default=None,
+                        help="Send the tiles of the COS jobs to a model by their texture score, the cheapest first, "
+                             "e.g. `bicubic:20,dsgan:150,rfb_esrgan`: a tile scoring below 20 is upsampled with "
+                             "bicubic, below 150 goes to `dsgan`. The last model should be `--model`, which batches. "
+                             "(Default: every tile goes to `--model`).")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Fold residual scales, batch norms and adjacent convolutions into the convolutions of "
+                             "the models and fuse the branch entries of the Inception and RFB blocks, checked "
+                             "against the loaded weights.")
+    parser.add_argument("--full-listing-interval", type=float, default=3600,
+                        help="Seconds between two full listings of the bucket by `/run`, the others resume after "
+                             "the last key listed. (Default: 3600).")
+    parser.add_argument("--max-attempts", type=int, default=5,
+                        help="Failures after which an object is given up until it is uploaded again. (Default: 5).")
+    parser.add_argument("--retry-backoff", type=float, default=60,
+                        help="Seconds before the first retry of a failed object, doubled at every failure. "
+                             "(Default: 60).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes sharing the model weights and the port. (Default: 1).")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="`/sr` requests processed at the same time. (Default: 8).")
+    args = parser.parse_args()
+
     # Configure download low-resolution image directory and super-resolution image directory.
     data_path = "static"
     lr_path = os.path.join(data_path, "lr")
     sr_path = os.path.join(data_path, "sr")
+    slides_path = os.path.join(data_path, "slides")
 
     # Step 1: Create all process directory.
     create_folder(data_path)
     create_folder(lr_path)
     create_folder(sr_path)
+    create_folder(slides_path)
 
-    # Step 2: Model of configuration super-resolution algorithm.
+    # Step 2: Model of configuration super-resolution algorithm, checkpoints are loaded on first use.
     device = select_device()
-    model = bionet().to(device)
-    model.eval()
+    # Checkpoints named after another architecture, e.g. `dsgan_he40x.pth`, are loaded into it.
+    factories = {"bionet": bionet, "dsgan": dsgan, "rfb_esrgan": rfb_esrgan}
+    registry = ModelRegistry(args.model_dir, memory_budget=args.model_budget << 20, factories=factories,
+                             optimize=args.optimize)
+    routes = parse_routes(args.route) if args.route else None
+    routed_models = [args.model] + [name for name in (routes[0] if routes else [])
+                                    if name not in ("bicubic", args.model)]
+    for name in routed_models:
+        if args.model_dir is None:
+            # Without checkpoints, untrained models of the architecture their name starts with are served.
+            if not any(name.startswith(prefix) for prefix in factories):
+                parser.error(f"Model `{name}` needs a checkpoint of `--model-dir`, "
+                             f"or a name starting with one of {list(factories)}.")
+            registry.add(name, registry.build(name).eval())
+        else:
+            registry.preload(name)
 
-    # Step 3: Start Tencent COS server.
-    cos = COS()
-    url_lists = cos.get_all_urls()  # Get COS all image file.
+    # Step 3: Fork the workers, they all map the pages of the weights loaded above.
+    worker = 0
+    listener = bind("0.0.0.0", args.port)
+    # Every worker dumps its metrics here, the dumps of an earlier run must not be added up.
+    metrics_path = os.path.join(data_path, "metrics")
+    shutil.rmtree(metrics_path, ignore_errors=True)
+    if args.workers > 1:
+        registry.share_memory()
+        worker = prefork(args.workers)
+        # Every worker runs its share of the cores, instead of all of them fighting for every core.
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.workers))
+    # Models move to the device and get their batcher threads in the worker.
+    registry.device = device
+    registry.batcher_options = {"max_batch_size": args.max_batch_size, "max_wait": args.max_wait / 1000}
+    registry.start()
+    REGISTRY.start(metrics_path, worker)
+    get_hub().threadpool.maxsize = args.threads
+    # Background tiles of the slides are upsampled with bicubic, only with `--skip-background`.
+    tissue_detector = TissueDetector() if args.skip_background else None
+    # Tiles of re-scans and overlapping fields of view are reused, every worker spills to a directory of its own.
+    cache = TileCache(spill_dir=os.path.join(data_path, "cache", str(worker)), spill_budget=(4 << 30) // args.workers)
+    # Rendered tiles of the slide viewers, every worker has its own cache.
+    pyramids = {}
+    pyramid_cache = TileCache(256 << 20, os.path.join(data_path, "deepzoom", str(worker)), args.deepzoom_budget << 20,
+                              "deepzoom")
+
+    # Step 4: Start Tencent COS server, objects are listed incrementally on request of `/run`.
+    cos = COS(LocalCosS3Client(args.local_cos) if args.local_cos else None, args.bucket)
+    index = ObjectIndex(os.path.join(data_path, "index.db"), args.max_attempts, args.retry_backoff)
+    # Large outputs are uploaded in parallel parts, transient errors are retried.
+    transfers = TransferManager(cos)
+    encoders = {}
     base_url = "Your COS url"
+    # Small and urgent files are processed first, the cost of a file is read from the header of the object.
+    scheduler = Scheduler({name: float(deadline) for name, deadline in
+                           (pair.split("=", 1) for pair in args.priority_classes.split(",") if pair)},
+                          dict(pair.split("=", 1) for pair in args.priority_rules.split(",") if pair),
+                          args.schedule)
+
+    # Step 5: Background job queue behind `/run`, every worker queues jobs and listings, the first one runs them.
+    jobs = JobQueue(os.path.join(data_path, "jobs.db"), process, list_objects)
+    if worker == 0:
+        jobs.start()
 
-    # Step 4: Flask server run.
-    server = pywsgi.WSGIServer(("0.0.0.0", 10086), app)
+    # Step 6: Flask server run, on a cooperative socket of the worker.
+    server = pywsgi.WSGIServer(socket.socket(fileno=listener.detach()), app)
     server.serve_forever()
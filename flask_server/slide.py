@@ -0,0 +1,173 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import logging
+import os
+
+import cv2
+import numpy as np
+from PIL import Image
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+__all__ = ["SlideReader", "SlideWriter"]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+
+class SlideReader(object):
+    r""" Read a whole-slide image in row bands without keeping it decoded in memory.
+
+    `.npy` files are memory-mapped. TIFF files are memory-mapped when they are uncompressed, compressed
+    ones are decoded once into a temporary memory-mapped file (requires `tifffile`). Other formats are
+    decoded with PIL and stay in memory, as do images decoded beforehand.
+    """
+
+    def __init__(self, filename) -> None:
+        r"""
+        Args:
+            filename (str or np.ndarray): Low-resolution slide file name, or an image of shape H*W*C (uint8).
+        """
+        extension = os.path.splitext(filename)[1].lower() if isinstance(filename, str) else None
+        if isinstance(filename, np.ndarray):
+            self.image = filename
+        elif extension == ".npy":
+            self.image = np.load(filename, mmap_mode="r")
+        elif extension in (".tif", ".tiff") and tifffile is not None:
+            try:
+                self.image = tifffile.memmap(filename, mode="r")
+            except ValueError:
+                with tifffile.TiffFile(filename) as tif:
+                    self.image = tif.pages[0].asarray(out="memmap")
+        else:
+            logger.warning(f"`{filename}` can not be memory-mapped, the whole image is decoded into memory.")
+            Image.MAX_IMAGE_PIXELS = None
+            self.image = np.asarray(Image.open(filename).convert("RGB"))
+
+        self.height, self.width = self.image.shape[:2]
+
+    @property
+    def size(self) -> tuple:
+        return self.width, self.height
+
+    def read(self, upper: int, lower: int) -> np.ndarray:
+        r""" Read one row band.
+
+        Args:
+            upper (int): First row of the band.
+            lower (int): Row after the last row of the band.
+
+        Returns:
+            RGB image of shape H*W*3 (uint8).
+        """
+        return self.read_region(0, upper, self.width, lower)
+
+    def read_region(self, left: int, upper: int, right: int, lower: int) -> np.ndarray:
+        r""" Read one rectangle, only its pages are touched in a memory-mapped slide.
+
+        Args:
+            left (int): First column of the rectangle.
+            upper (int): First row of the rectangle.
+            right (int): Column after the last column of the rectangle.
+            lower (int): Row after the last row of the rectangle.
+
+        Returns:
+            RGB image of shape H*W*3 (uint8).
+        """
+        band = np.array(self.image[upper:lower, left:right])
+        if band.ndim == 2:
+            band = np.repeat(band[:, :, None], 3, axis=2)
+        return np.ascontiguousarray(band[:, :, :3])
+
+    def thumbnail(self, thumbnail_size: int = 1024, band_height: int = 1024) -> np.ndarray:
+        r""" Downscale the slide band by band so that its longest side is at most `thumbnail_size`.
+
+        Args:
+            thumbnail_size (optional, int): Longest side of the thumbnail. (Default: 1024).
+            band_height (optional, int): Rows read at a time. (Default: 1024).
+
+        Returns:
+            RGB thumbnail of shape H*W*3 (uint8).
+        """
+        scale = min(thumbnail_size / max(self.width, self.height), 1)
+        thumbnail_width = max(int(round(self.width * scale)), 1)
+
+        bands = []
+        for upper in range(0, self.height, band_height):
+            lower = min(upper + band_height, self.height)
+            rows = int(round(lower * scale)) - int(round(upper * scale))
+            if rows > 0:
+                bands.append(cv2.resize(self.read(upper, lower), (thumbnail_width, rows),
+                                        interpolation=cv2.INTER_AREA))
+        return np.concatenate(bands, axis=0)
+
+
+class SlideWriter(object):
+    r""" Write super-resolution rows into a disk-backed `.npy` array.
+
+    Only the rows being written are mapped, so the resident memory does not grow with the slide.
+    A `.tif` file name writes a tiled TIFF from the array when the writer is closed (requires `tifffile`).
+    """
+
+    def __init__(self, filename: str, width: int, height: int, channels: int = 3, tile_size: int = 256) -> None:
+        r"""
+        Args:
+            filename (str): Super-resolution slide file name, `.npy` or `.tif`.
+            width (int): Width of the super-resolution slide.
+            height (int): Height of the super-resolution slide.
+            channels (optional, int): Number of channels. (Default: 3).
+            tile_size (optional, int): Tile size of the TIFF file. (Default: 256).
+        """
+        self.filename = filename
+        self.tiff = os.path.splitext(filename)[1].lower() in (".tif", ".tiff")
+        assert not self.tiff or tifffile is not None, "Writing TIFF slides requires `tifffile`."
+        self.array_filename = filename + ".npy" if self.tiff else filename
+        self.shape = (height, width, channels)
+        self.tile_size = tile_size
+
+        # Create the array file, the header length is the offset of the first row.
+        image = np.lib.format.open_memmap(self.array_filename, mode="w+", dtype=np.uint8, shape=self.shape)
+        self.offset = image.offset
+        del image
+
+    def write(self, top: int, rows: np.ndarray) -> None:
+        r""" Write rows starting at output row `top`.
+
+        Args:
+            top (int): First output row.
+            rows (np.ndarray): RGB image of shape H*W*C (uint8).
+        """
+        row_bytes = self.shape[1] * self.shape[2]
+        window = np.memmap(self.array_filename, dtype=np.uint8, mode="r+",
+                           offset=self.offset + top * row_bytes, shape=rows.shape)
+        window[:] = rows
+        window.flush()
+        del window
+
+    def close(self) -> str:
+        r""" Finish the slide.
+
+        Returns:
+            Super-resolution slide file name.
+        """
+        if self.tiff:
+            image = np.load(self.array_filename, mmap_mode="r")
+            tifffile.imwrite(self.filename, image, tile=(self.tile_size, self.tile_size), photometric="rgb")
+            del image
+            os.remove(self.array_filename)
+        return self.filename
+
@@ -0,0 +1,329 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import logging
+import math
+from collections import namedtuple
+
+import numpy as np
+
+__all__ = ["Tile", "sigmoid_weight", "Canvas", "BandCanvas", "Tiler"]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+# Low-resolution crop box of a tile (left, upper, right, lower) and the edges it shares with its neighbours.
+Tile = namedtuple("Tile", ["row", "column", "box", "left_edge", "top_edge", "right_edge", "bottom_edge"])
+
+
+def sigmoid_weight(over_length: int, ratio: float = 0.05) -> np.ndarray:
+    r""" Calculate the image edge weight when splicing.
+
+    Args:
+        over_length (int): Edge overlap length.
+        ratio (optional, float): Fusion calculation weight parameters. (Default: 0.05).
+
+    Returns:
+        Rising edge weight of shape (over_length,).
+    """
+    weight = 1 / (1 + np.exp(-ratio * np.arange(-over_length / 2, over_length / 2)))
+    return weight.astype(np.float32)
+
+
+class Canvas(object):
+    r""" Preallocated output image that the super-resolution tiles are blended into.
+
+    Every tile is multiplied by its edge weight and accumulated in place, the sum of the weights is kept
+    alongside so that the overlapping areas can be normalized once all tiles have been written.
+
+    Examples:
+        >>> canvas = Canvas(2160, 3840)
+        >>> weight = sigmoid_weight(128)
+        >>> canvas.blend(tile, 0, 0, weight, right=True, bottom=True)
+        >>> image = canvas.normalize()
+    """
+
+    def __init__(self, height: int, width: int, channels: int = 3) -> None:
+        r"""
+        Args:
+            height (int): Height of the output image.
+            width (int): Width of the output image.
+            channels (optional, int): Number of channels of the output image. (Default: 3).
+        """
+        self.image = np.zeros((height, width, channels), dtype=np.float32)
+        self.weight = np.zeros((height, width, 1), dtype=np.float32)
+
+    @staticmethod
+    def edge_weight(length: int, weight: np.ndarray, head: bool, tail: bool) -> np.ndarray:
+        r""" One dimensional weight of a tile, ramps are only applied on the edges shared with a neighbour.
+
+        Args:
+            length (int): Tile length along the axis.
+            weight (np.ndarray): Rising edge weight from `sigmoid_weight`.
+            head (bool): Whether the start of the axis overlaps the previous tile.
+            tail (bool): Whether the end of the axis overlaps the next tile.
+        """
+        out = np.ones(length, dtype=np.float32)
+        over_length = min(len(weight), length)
+        if head:
+            out[:over_length] *= weight[:over_length]
+        if tail:
+            out[length - over_length:] *= weight[::-1][len(weight) - over_length:]
+        return out
+
+    def blend(self, tile: np.ndarray, top: int, left: int, weight: np.ndarray,
+              left_edge: bool = False, top_edge: bool = False,
+              right_edge: bool = False, bottom_edge: bool = False) -> None:
+        r""" Accumulate one tile into the canvas.
+
+        Args:
+            tile (np.ndarray): Float image of shape H*W*C, it is modified in place.
+            top (int): Row of the canvas the tile starts at.
+            left (int): Column of the canvas the tile starts at.
+            weight (np.ndarray): Rising edge weight from `sigmoid_weight`.
+            left_edge (optional, bool): The tile overlaps its left neighbour. (Default: ``False``).
+            top_edge (optional, bool): The tile overlaps its upper neighbour. (Default: ``False``).
+            right_edge (optional, bool): The tile overlaps its right neighbour. (Default: ``False``).
+            bottom_edge (optional, bool): The tile overlaps its lower neighbour. (Default: ``False``).
+        """
+        height, width = tile.shape[:2]
+        weight_x = self.edge_weight(width, weight, left_edge, right_edge)
+        weight_y = self.edge_weight(height, weight, top_edge, bottom_edge)
+        mask = np.outer(weight_y, weight_x)[:, :, None]
+
+        tile *= mask
+        self.image[top:top + height, left:left + width] += tile
+        self.weight[top:top + height, left:left + width] += mask
+
+    def normalize(self) -> np.ndarray:
+        r""" Divide the accumulated image by the accumulated weight in place.
+
+        Returns:
+            Float image of shape H*W*C in range [0, 1].
+        """
+        np.maximum(self.weight, np.finfo(np.float32).eps, out=self.weight)
+        np.divide(self.image, self.weight, out=self.image)
+        return np.clip(self.image, 0, 1, out=self.image)
+
+    def region(self, top: int, left: int, height: int, width: int) -> np.ndarray:
+        r""" Normalized copy of an area, the canvas is left as it is so that more tiles can be blended.
+
+        Pixels no tile has covered yet are zero.
+
+        Returns:
+            Float image of shape height*width*C in range [0, 1].
+        """
+        image = self.image[top:top + height, left:left + width]
+        weight = np.maximum(self.weight[top:top + height, left:left + width], np.finfo(np.float32).eps)
+        return np.clip(image / weight, 0, 1)
+
+
+class BandCanvas(Canvas):
+    r""" Canvas that only holds one row band of a very large output image.
+
+    The tiles of a grid share their rows and columns, so the weight of every pixel is the product of a row
+    weight and a column weight and no weight plane has to be kept. Finished rows are flushed from the top
+    and the overlap with the next band is carried over.
+    """
+
+    def __init__(self, height: int, width: int, weight_x: np.ndarray, channels: int = 3) -> None:
+        r"""
+        Args:
+            height (int): Height of the band.
+            width (int): Width of the output image.
+            weight_x (np.ndarray): Summed column weight of the whole grid, of shape (width,).
+            channels (optional, int): Number of channels of the output image. (Default: 3).
+        """
+        self.image = np.zeros((height, width, channels), dtype=np.float32)
+        self.weight_x = weight_x
+        self.weight_y = np.zeros(height, dtype=np.float32)
+        self.top = 0  # Output row of the first band row.
+
+    def blend(self, tile: np.ndarray, top: int, left: int, weight: np.ndarray,
+              left_edge: bool = False, top_edge: bool = False,
+              right_edge: bool = False, bottom_edge: bool = False) -> None:
+        r""" Accumulate one tile into the band, `top` is an output row of the whole image."""
+        height, width = tile.shape[:2]
+        weight_x = self.edge_weight(width, weight, left_edge, right_edge)
+        weight_y = self.edge_weight(height, weight, top_edge, bottom_edge)
+
+        tile *= np.outer(weight_y, weight_x)[:, :, None]
+        top -= self.top
+        self.image[top:top + height, left:left + width] += tile
+
+    def add_row(self, top: int, height: int, weight: np.ndarray, top_edge: bool, bottom_edge: bool) -> None:
+        r""" Count the row weight of one grid row, once for all of its tiles.
+
+        Args:
+            top (int): Output row the grid row starts at.
+            height (int): Height of the tiles of the grid row.
+            weight (np.ndarray): Rising edge weight from `sigmoid_weight`.
+            top_edge (bool): The grid row overlaps the previous one.
+            bottom_edge (bool): The grid row overlaps the next one.
+        """
+        top -= self.top
+        self.weight_y[top:top + height] += self.edge_weight(height, weight, top_edge, bottom_edge)
+
+    def flush(self, rows: int) -> np.ndarray:
+        r""" Normalize and remove the first rows of the band, no later tile may touch them.
+
+        Args:
+            rows (int): Number of finished rows.
+
+        Returns:
+            Float image of shape rows*W*C in range [0, 1].
+        """
+        eps = np.finfo(np.float32).eps
+        out = self.image[:rows] / np.maximum(np.outer(self.weight_y[:rows], self.weight_x), eps)[:, :, None]
+        np.clip(out, 0, 1, out=out)
+
+        # Carry the overlap over to the top of the band.
+        self.image[:-rows] = self.image[rows:]
+        self.image[-rows:] = 0
+        self.weight_y[:-rows] = self.weight_y[rows:]
+        self.weight_y[-rows:] = 0
+        self.top += rows
+        return out
+
+
+class Tiler(object):
+    r""" Split an image of any size into an N*M grid of overlapping tiles and blend them back in one pass.
+
+    Tiles have the same size wherever the image is large enough, the spare pixels are spread evenly over the
+    overlaps so that no overlap is shorter than `over_length`.
+
+    Examples:
+        >>> tiler = Tiler(tile_size=512, over_length=128)
+        >>> canvas = tiler.canvas(1920, 1080)
+        >>> for tile in tiler.tiles(1920, 1080):
+        ...     tiler.blend(canvas, tile, sr_tile)
+        >>> image = canvas.normalize()
+    """
+
+    def __init__(self, tile_size=512, over_length: int = 128, ratio: float = None, upscale_factor: int = 4) -> None:
+        r"""
+        Args:
+            tile_size (optional, int or tuple): Low-resolution tile size (width, height), grown to twice the
+                low-resolution overlap if it is smaller. (Default: 512).
+            over_length (optional, int): Edge overlap length of the super-resolution tiles. (Default: 128).
+            ratio (optional, float): Fusion calculation weight parameters. Scaled with the overlap so that
+                the weight always ramps from 0.04 to 0.96, i.e. 0.05 for 128 pixels. (Default: ``None``).
+            upscale_factor (optional, int): Low to high resolution scaling factor. (Default: 4).
+        """
+        self.tile_width, self.tile_height = (tile_size, tile_size) if isinstance(tile_size, int) else tile_size
+        self.over_length = over_length
+        self.ratio = ratio if ratio is not None else 0.05 * 128 / max(over_length, 1)
+        self.upscale_factor = upscale_factor
+        # Low-resolution overlap, rounded up so that the super-resolution overlap is never shorter.
+        self.lr_over_length = int(math.ceil(over_length / upscale_factor))
+        self.weight = sigmoid_weight(over_length, self.ratio)
+
+        # The blending ramps of the two edges of a tile must not cross, e.g. the halo of a large model with a small
+        # ROI tile.
+        minimum = 2 * self.lr_over_length
+        if min(self.tile_width, self.tile_height) < minimum:
+            logger.warning(f"Tile size {self.tile_width}x{self.tile_height} is too small for the overlap "
+                           f"{self.lr_over_length}, grown to at least {minimum}.")
+            self.tile_width, self.tile_height = max(self.tile_width, minimum), max(self.tile_height, minimum)
+
+    def positions(self, length: int, tile_length: int) -> list:
+        r""" Start offsets of the tiles along one axis.
+
+        Args:
+            length (int): Image length along the axis.
+            tile_length (int): Tile length along the axis.
+        """
+        if length <= tile_length:
+            return [0]
+        num_tiles = int(math.ceil((length - self.lr_over_length) / (tile_length - self.lr_over_length)))
+        stride = (length - tile_length) / (num_tiles - 1)
+        return [int(round(index * stride)) for index in range(num_tiles)]
+
+    def tiles(self, width: int, height: int) -> list:
+        r""" Row-major tile grid of an image.
+
+        Args:
+            width (int): Width of the low-resolution image.
+            height (int): Height of the low-resolution image.
+
+        Returns:
+            List of `Tile`.
+        """
+        tile_width, tile_height = min(self.tile_width, width), min(self.tile_height, height)
+        xs = self.positions(width, tile_width)
+        ys = self.positions(height, tile_height)
+
+        tiles = []
+        for row, y in enumerate(ys):
+            for column, x in enumerate(xs):
+                tiles.append(Tile(row, column, (x, y, x + tile_width, y + tile_height),
+                                  column > 0, row > 0, column < len(xs) - 1, row < len(ys) - 1))
+        return tiles
+
+    def canvas(self, width: int, height: int, channels: int = 3) -> Canvas:
+        r""" Preallocate the super-resolution canvas of a low-resolution image.
+
+        Args:
+            width (int): Width of the low-resolution image.
+            height (int): Height of the low-resolution image.
+            channels (optional, int): Number of channels of the output image. (Default: 3).
+        """
+        return Canvas(height * self.upscale_factor, width * self.upscale_factor, channels)
+
+    def band_canvas(self, width: int, height: int, channels: int = 3) -> BandCanvas:
+        r""" Preallocate one row band of the super-resolution canvas, tall enough for one grid row.
+
+        Args:
+            width (int): Width of the low-resolution image.
+            height (int): Height of the low-resolution image.
+            channels (optional, int): Number of channels of the output image. (Default: 3).
+        """
+        tile_width = min(self.tile_width, width) * self.upscale_factor
+        xs = self.positions(width, min(self.tile_width, width))
+
+        # Column weight of the whole grid, summed over the tile columns.
+        weight_x = np.zeros(width * self.upscale_factor, dtype=np.float32)
+        for column, x in enumerate(xs):
+            left = x * self.upscale_factor
+            weight_x[left:left + tile_width] += Canvas.edge_weight(tile_width, self.weight,
+                                                                   column > 0, column < len(xs) - 1)
+
+        band_height = min(self.tile_height, height) * self.upscale_factor
+        return BandCanvas(band_height, width * self.upscale_factor, weight_x, channels)
+
+    def blend(self, canvas: Canvas, tile: Tile, sr: np.ndarray) -> None:
+        r""" Accumulate one super-resolution tile at its grid position.
+
+        Args:
+            canvas (Canvas): Canvas returned by `canvas`.
+            tile (Tile): Grid position of the tile.
+            sr (np.ndarray): Float super-resolution tile of shape H*W*C, it is modified in place.
+        """
+        left, upper = tile.box[:2]
+        canvas.blend(sr, upper * self.upscale_factor, left * self.upscale_factor, self.weight,
+                     tile.left_edge, tile.top_edge, tile.right_edge, tile.bottom_edge)
+
+    def sr_box(self, tile: Tile) -> tuple:
+        r""" Super-resolution area of a tile (left, upper, right, lower)."""
+        return tuple(value * self.upscale_factor for value in tile.box)
+
+    def add_row(self, canvas: BandCanvas, tile: Tile) -> None:
+        r""" Count the row weight of the grid row of `tile` in a band canvas.
+
+        Args:
+            canvas (BandCanvas): Canvas returned by `band_canvas`.
+            tile (Tile): Any tile of the grid row.
+        """
+        left, upper, right, lower = tile.box
+        canvas.add_row(upper * self.upscale_factor, (lower - upper) * self.upscale_factor, self.weight,
+                       tile.top_edge, tile.bottom_edge)
@@ -0,0 +1,99 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import cv2
+import numpy as np
+
+__all__ = ["TissueDetector"]
+
+
+class TissueDetector(object):
+    r""" Cheap tissue detector working on a low-resolution thumbnail of the slide.
+
+    Glass is bright and unsaturated while stained tissue is saturated, so the saturation channel of the thumbnail
+    is thresholded with Otsu's method. Tiles with too little tissue are treated as background.
+
+    Examples:
+        >>> detector = TissueDetector()
+        >>> mask = detector.mask(TissueDetector.thumbnail(image))
+        >>> tissue = detector.classify(mask, tiles, width, height)
+    """
+
+    def __init__(self, thumbnail_size: int = 1024, min_saturation: int = 20, min_tissue: float = 0.01,
+                 dilation: int = 3) -> None:
+        r"""
+        Args:
+            thumbnail_size (optional, int): Longest side of the thumbnail. (Default: 1024).
+            min_saturation (optional, int): Saturation below which a pixel is always glass, it keeps Otsu's method
+                from splitting the noise of an empty frame. (Default: 20).
+            min_tissue (optional, float): Share of tissue pixels a tile needs to go through the generator.
+                (Default: 0.01).
+            dilation (optional, int): Thumbnail pixels the mask is grown by, so tissue borders are kept.
+                (Default: 3).
+        """
+        self.thumbnail_size = thumbnail_size
+        self.min_saturation = min_saturation
+        self.min_tissue = min_tissue
+        self.dilation = dilation
+
+    @staticmethod
+    def thumbnail(image: np.ndarray, thumbnail_size: int = 1024) -> np.ndarray:
+        r""" Downscale an RGB image so that its longest side is at most `thumbnail_size`.
+
+        Args:
+            image (np.ndarray): RGB image of shape H*W*3 (uint8).
+            thumbnail_size (optional, int): Longest side of the thumbnail. (Default: 1024).
+        """
+        height, width = image.shape[:2]
+        scale = min(thumbnail_size / max(height, width), 1)
+        return cv2.resize(image, (max(int(round(width * scale)), 1), max(int(round(height * scale)), 1)),
+                          interpolation=cv2.INTER_AREA)
+
+    def mask(self, thumbnail: np.ndarray) -> np.ndarray:
+        r""" Tissue mask of a thumbnail.
+
+        Args:
+            thumbnail (np.ndarray): RGB thumbnail of shape H*W*3 (uint8).
+
+        Returns:
+            Boolean mask of shape H*W, ``True`` on tissue.
+        """
+        saturation = cv2.cvtColor(thumbnail, cv2.COLOR_RGB2HSV)[:, :, 1]
+        threshold, _ = cv2.threshold(saturation, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        mask = (saturation > max(threshold, self.min_saturation)).astype(np.uint8)
+
+        if self.dilation > 0:
+            kernel = np.ones((2 * self.dilation + 1, 2 * self.dilation + 1), dtype=np.uint8)
+            mask = cv2.dilate(mask, kernel)
+        return mask.astype(bool)
+
+    def classify(self, mask: np.ndarray, tiles: list, width: int, height: int) -> list:
+        r""" Decide which tiles contain tissue.
+
+        Args:
+            mask (np.ndarray): Tissue mask returned by `mask`.
+            tiles (list): Tiles returned by `Tiler.tiles`.
+            width (int): Width of the low-resolution image.
+            height (int): Height of the low-resolution image.
+
+        Returns:
+            One boolean per tile, ``True`` on tissue.
+        """
+        scale_x, scale_y = mask.shape[1] / width, mask.shape[0] / height
+        tissue = []
+        for tile in tiles:
+            left, upper, right, lower = tile.box
+            region = mask[int(upper * scale_y):max(int(np.ceil(lower * scale_y)), int(upper * scale_y) + 1),
+                          int(left * scale_x):max(int(np.ceil(right * scale_x)), int(left * scale_x) + 1)]
+            tissue.append(bool(region.mean() >= self.min_tissue))
+        return tissue
@@ -0,0 +1,232 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from qcloud_cos.cos_exception import CosClientError
+from qcloud_cos.cos_exception import CosServiceError
+
+from metrics import BYTES
+from metrics import STAGE_SECONDS
+
+__all__ = ["TransferStats", "TransferManager"]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+
+class TransferStats(object):
+    r""" Bytes and busy time of one transfer direction.
+
+    The time counts while at least one transfer is running, so concurrent transfers are not counted twice and the
+    throughput is the one seen by the caller.
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.files = 0
+        self.bytes = 0
+        self.retries = 0
+        self.active = 0
+        self.started = 0.
+        self.seconds = 0.
+
+    def begin(self) -> None:
+        with self.lock:
+            if self.active == 0:
+                self.started = time.perf_counter()
+            self.active += 1
+
+    def end(self, size: int) -> None:
+        with self.lock:
+            self.active -= 1
+            if self.active == 0:
+                self.seconds += time.perf_counter() - self.started
+            if size is not None:
+                self.files += 1
+                self.bytes += size
+
+    def retry(self) -> None:
+        with self.lock:
+            self.retries += 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            seconds = self.seconds + (time.perf_counter() - self.started if self.active else 0.)
+            return {"files": self.files,
+                    "bytes": self.bytes,
+                    "retries": self.retries,
+                    "seconds": round(seconds, 3),
+                    "MB/s": round(self.bytes / (1 << 20) / seconds, 2) if seconds > 0 else 0.}
+
+
+class TransferManager(object):
+    r""" Concurrent downloads and uploads of a `COS` bucket on a bounded thread pool.
+
+    Objects larger than `multipart_threshold` are uploaded in parts, sent in parallel. Client errors and server
+    errors that may pass (5xx, 429) are retried with an exponential backoff.
+
+    Examples:
+        >>> transfers = TransferManager(COS())
+        >>> transfers.download("static/lr/1.png", "lr/1.png").result()
+        >>> transfers.upload(open("static/sr/1.png", "rb").read(), "lr/1.png").result()["ETag"]
+        >>> transfers.stats()
+    """
+
+    def __init__(self, cos, workers: int = 8, part_workers: int = 8, multipart_threshold: int = 20 << 20,
+                 part_size: int = 8 << 20, retries: int = 3, backoff: float = 0.5) -> None:
+        r"""
+        Args:
+            cos (COS): Bucket of the transfers.
+            workers (optional, int): Objects transferred at the same time. (Default: 8).
+            part_workers (optional, int): Parts uploaded at the same time, over all objects. (Default: 8).
+            multipart_threshold (optional, int): Size in bytes above which an upload is sent in parts. (Default: 20MB).
+            part_size (optional, int): Size in bytes of an upload part, COS needs at least 1MB. (Default: 8MB).
+            retries (optional, int): Retries of a failed request. (Default: 3).
+            backoff (optional, float): Seconds before the first retry, doubled on every retry. (Default: 0.5).
+        """
+        self.cos = cos
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.retries = retries
+        self.backoff = backoff
+
+        # Parts have their own pool, an upload waiting for its parts must not hold the slot of a part.
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="transfer")
+        self.part_pool = ThreadPoolExecutor(max_workers=part_workers, thread_name_prefix="transfer-part")
+
+        self.downloads = TransferStats()
+        self.uploads = TransferStats()
+
+    @staticmethod
+    def transient(error: Exception) -> bool:
+        r""" Whether a failed request may succeed when sent again."""
+        if isinstance(error, CosClientError):
+            return True
+        if isinstance(error, CosServiceError):
+            return error.get_status_code() >= 500 or error.get_status_code() == 429
+        return False
+
+    def retry(self, stats: TransferStats, function, *args, **kwargs):
+        r""" Call `function`, sending it again on transient errors."""
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args, **kwargs)
+            except (CosClientError, CosServiceError) as error:
+                if attempt == self.retries or not self.transient(error):
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"Retry {attempt + 1}/{self.retries} in {delay:.1f}s: {error}")
+                stats.retry()
+                time.sleep(delay)
+
+    def download(self, file_path: str, cos_path: str):
+        r""" Queue the download of an object.
+
+        Args:
+            file_path (str): Download the file to save the address.
+            cos_path (str): COS url address.
+
+        Returns:
+            Future of the downloaded size in bytes.
+        """
+        return self.pool.submit(self.transfer, self.downloads, self.download_object, file_path, cos_path)
+
+    def read_header(self, cos_path: str, size: int = 64 << 10):
+        r""" Queue the read of the first bytes of an object, e.g. to find the dimensions of an image.
+
+        Args:
+            cos_path (str): COS url address.
+            size (optional, int): Bytes to read. (Default: 64KB).
+
+        Returns:
+            Future of the bytes.
+        """
+        return self.pool.submit(self.retry, self.downloads, self.cos.read_header, cos_path, size)
+
+    def upload(self, stream: bytes, cos_path: str):
+        r""" Queue the upload of an object.
+
+        Args:
+            stream (bytes): Content of the object.
+            cos_path (str): COS url address.
+
+        Returns:
+            Future of the response of COS, with the `ETag` of the uploaded object.
+        """
+        return self.pool.submit(self.transfer, self.uploads, self.upload_object, stream, cos_path)
+
+    def transfer(self, stats: TransferStats, function, *args):
+        stats.begin()
+        size = None
+        try:
+            size, response = function(*args)
+            return response
+        finally:
+            stats.end(size)
+
+    def download_object(self, file_path: str, cos_path: str):
+        # A broken stream is downloaded again as well, so the whole request is retried.
+        self.retry(self.downloads, self.cos.download_file, file_path, cos_path)
+        size = os.path.getsize(file_path)
+        BYTES.inc(size, direction="in", source="cos")
+        return size, size
+
+    def upload_object(self, stream: bytes, cos_path: str):
+        if len(stream) <= self.multipart_threshold:
+            response = self.retry(self.uploads, self.cos.upload_file, stream, cos_path)
+        else:
+            with STAGE_SECONDS.time(stage="cos_upload_multipart"):
+                response = self.upload_multipart(stream, cos_path)
+        BYTES.inc(len(stream), direction="out", source="cos")
+        return len(stream), response
+
+    def upload_multipart(self, stream: bytes, cos_path: str) -> dict:
+        client = self.cos.client
+        Bucket = self.cos.Bucket
+        UploadId = self.retry(self.uploads, client.create_multipart_upload, Bucket=Bucket, Key=cos_path)["UploadId"]
+
+        try:
+            futures = []
+            for PartNumber, offset in enumerate(range(0, len(stream), self.part_size), 1):
+                futures.append(self.part_pool.submit(self.retry, self.uploads, client.upload_part,
+                                                     Bucket=Bucket,
+                                                     Key=cos_path,
+                                                     Body=stream[offset:offset + self.part_size],
+                                                     PartNumber=PartNumber,
+                                                     UploadId=UploadId))
+            parts = [{"ETag": future.result()["ETag"], "PartNumber": PartNumber}
+                     for PartNumber, future in enumerate(futures, 1)]
+            return self.retry(self.uploads, client.complete_multipart_upload,
+                              Bucket=Bucket, Key=cos_path, UploadId=UploadId, MultipartUpload={"Part": parts})
+        except Exception:
+            # Parts of an unfinished upload are billed until it is aborted.
+            for future in futures:
+                future.cancel()
+            try:
+                client.abort_multipart_upload(Bucket=Bucket, Key=cos_path, UploadId=UploadId)
+            except (CosClientError, CosServiceError) as error:
+                logger.warning(f"Abort multipart upload `{UploadId}` failed: {error}")
+            raise
+
+    def stats(self) -> dict:
+        r""" Files, bytes, retries and throughput in MB/s of the downloads and of the uploads."""
+        return {"download": self.downloads.summary(), "upload": self.uploads.summary()}
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=True)
+        self.part_pool.shutdown(wait=True)
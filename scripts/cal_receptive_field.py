@@ -0,0 +1,64 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import argparse
+
+import torch
+
+import ssrgan.models as models
+from ssrgan.utils import receptive_field_halo
+from ssrgan.utils import select_device
+
+model_names = sorted(name for name in models.__dict__
+                     if name.islower() and not name.startswith("__")
+                     and callable(models.__dict__[name]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Research and application of GAN based super resolution "
+                                                 "technology for pathological microscopic images.")
+    # model parameters
+    parser.add_argument("-a", "--arch", metavar="ARCH", nargs="+", default=["dsgan", "rfb_esrgan"],
+                        choices=model_names,
+                        help="model architecture: " +
+                             " | ".join(model_names) +
+                             " (Default: ``dsgan rfb_esrgan``)")
+    parser.add_argument("--model-path", type=str, nargs="+", default=[],
+                        help="Weights of every model, in the order of `--arch`. (Default: random weights).")
+    parser.add_argument("--upscale-factor", type=int, default=4, choices=[4],
+                        help="Low to high resolution scaling factor. (Default: 4).")
+    parser.add_argument("--energy", type=float, default=0.999,
+                        help="Share of the gradient the halo must cover. (Default: 0.999).")
+    parser.add_argument("--device", default="cpu",
+                        help="device id i.e. `0` or `0,1` or `cpu`. (Default: ``cpu``).")
+    args = parser.parse_args()
+
+    device = select_device(args.device)
+
+    print(f"|---------------------------------------------------------------------|")
+    print(f"|                               Summary                               |")
+    print(f"|---------------------------------------------------------------------|")
+    print(f"|       Model       |  Halo (LR)  |  Overlap (SR)  |     Weights      |")
+    print(f"|---------------------------------------------------------------------|")
+    for index, arch in enumerate(args.arch):
+        model = models.__dict__[arch]().to(device)
+        weights = "random"
+        if index < len(args.model_path):
+            weights = args.model_path[index]
+            model.load_state_dict(torch.load(weights, map_location=device))
+
+        halo = receptive_field_halo(model, energy=args.energy, device=device)
+        print(f"|{model.__class__.__name__.center(19):19}"
+              f"|{str(halo).center(13):13}"
+              f"|{str(2 * halo * args.upscale_factor).center(16):16}"
+              f"|{weights[-18:].center(18):18}|")
+    print(f"|---------------------------------------------------------------------|")
@@ -13,3 +13,4 @@
 # ==============================================================================
 from .discriminator import *
 from .dsgan import *
+from .rfb_esrgan import *
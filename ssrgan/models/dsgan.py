@@ -179,6 +179,9 @@ class InceptionBlock(nn.Module):
 
         self.conv1x1 = nn.Conv2d(branch_features * 4, branch_features * 4, kernel_size=1, stride=1, padding=0)
         self.Mish = Mish() if non_linearity else None
+        # Fused 1x1 convolution of the shortcut and the branch entries, set by `optimize_for_inference`.
+        self.entry = None
+        self.entry_channels = None
 
         for m in self.modules():
             if isinstance(m, nn.Conv2d):
@@ -188,12 +191,17 @@ class InceptionBlock(nn.Module):
                     m.bias.data.zero_()
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        shortcut = self.shortcut(x)
-
-        branch1 = self.branch1(x)
-        branch2 = self.branch2(x)
-        branch3 = self.branch3(x)
-        branch4 = self.branch4(x)
+        if self.entry is None:
+            shortcut = self.shortcut(x)
+            inputs = (x, x, x, x)
+        else:
+            # The shortcut and the first convolution of every branch, in one pass over the input.
+            shortcut, *inputs = self.entry(x).split(self.entry_channels, dim=1)
+
+        branch1 = self.branch1(inputs[0])
+        branch2 = self.branch2(inputs[1])
+        branch3 = self.branch3(inputs[2])
+        branch4 = self.branch4(inputs[3])
 
         out = torch.cat([branch1, branch2, branch3, branch4], dim=1)
         out = self.conv1x1(out)
@@ -73,7 +73,10 @@ class ResidualDenseBlock(nn.Module):
         conv4 = self.conv4(torch.cat([input, conv1, conv2, conv3], dim=1))
         conv5 = self.conv5(torch.cat([input, conv1, conv2, conv3, conv4], dim=1))
 
-        return conv5.mul(self.scale_ratio) + input
+        # The scale is 1 once `optimize_for_inference` has folded it into the weights.
+        if self.scale_ratio != 1:
+            conv5 = conv5.mul(self.scale_ratio)
+        return conv5 + input
 
 
 class ResidualInResidualDenseBlock(nn.Module):
@@ -74,7 +74,10 @@ class ResidualDenseBlock(nn.Module):
         conv4 = self.conv4(torch.cat([input, conv1, conv2, conv3], dim=1))
         conv5 = self.conv5(torch.cat([input, conv1, conv2, conv3, conv4], dim=1))
 
-        return conv5.mul(self.scale_ratio) + input
+        # The scale is 1 once `optimize_for_inference` has folded it into the weights.
+        if self.scale_ratio != 1:
+            conv5 = conv5.mul(self.scale_ratio)
+        return conv5 + input
 
 
 class ResidualInResidualDenseBlock(nn.Module):
@@ -150,8 +153,11 @@ class ReceptiveFieldBlock(nn.Module):
             nn.Conv2d(channels, channels, kernel_size=3, stride=1, padding=5, dilation=5, groups=1)
         )
 
-        self.conv1x1 = nn.Conv2d(channels * 4, channels * 4, kernel_size=1, stride=1, padding=0)
+        self.conv1x1 = nn.Conv2d(channels * 4, out_channels, kernel_size=1, stride=1, padding=0)
         self.lrelu = nn.LeakyReLU(negative_slope=0.2, inplace=True) if non_linearity else None
+        # Fused 1x1 convolution of the shortcut and the branch entries, set by `optimize_for_inference`.
+        self.entry = None
+        self.entry_channels = None
 
         self.scale_ratio = scale_ratio
 
@@ -163,17 +169,24 @@ class ReceptiveFieldBlock(nn.Module):
                     m.bias.data.zero_()
 
     def forward(self, input: torch.Tensor) -> torch.Tensor:
-        shortcut = self.shortcut(input)
-
-        branch1 = self.branch1(input)
-        branch2 = self.branch2(input)
-        branch3 = self.branch3(input)
-        branch4 = self.branch4(input)
+        if self.entry is None:
+            shortcut = self.shortcut(input)
+            inputs = (input, input, input, input)
+        else:
+            # The shortcut and the first convolution of every branch, in one pass over the input.
+            shortcut, *inputs = self.entry(input).split(self.entry_channels, dim=1)
+
+        branch1 = self.branch1(inputs[0])
+        branch2 = self.branch2(inputs[1])
+        branch3 = self.branch3(inputs[2])
+        branch4 = self.branch4(inputs[3])
 
         out = torch.cat((branch1, branch2, branch3, branch4), 1)
         out = self.conv1x1(out)
 
-        out = out.mul(self.scale_ratio) + shortcut
+        if self.scale_ratio != 1:
+            out = out.mul(self.scale_ratio)
+        out = out + shortcut
         if self.lrelu is not None:
             out = self.lrelu(out)
 
@@ -209,7 +222,10 @@ class ReceptiveFieldDenseBlock(nn.Module):
         rfb4 = self.RFB4(torch.cat((input, rfb1, rfb2, rfb3), 1))
         rfb5 = self.RFB5(torch.cat((input, rfb1, rfb2, rfb3, rfb4), 1))
 
-        return rfb5.mul(self.scale_ratio) + input
+        # The scale is 1 once `optimize_for_inference` has folded it into the weights.
+        if self.scale_ratio != 1:
+            rfb5 = rfb5.mul(self.scale_ratio)
+        return rfb5 + input
 
 
 class ResidualOfReceptiveFieldDenseBlock(nn.Module):
@@ -17,4 +17,6 @@ from .common import *
 from .device import *
 from .estimate import *
 from .kernelgan import *
+from .optimize import *
+from .receptive_field import *
 from .transform import *
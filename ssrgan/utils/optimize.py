@@ -0,0 +1,304 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import copy
+import logging
+
+import torch
+import torch.nn as nn
+
+from ssrgan.models.esrgan import ResidualDenseBlock as ESRGANResidualDenseBlock
+from ssrgan.models.rfb_esrgan import ReceptiveFieldBlock
+from ssrgan.models.rfb_esrgan import ReceptiveFieldDenseBlock
+from ssrgan.models.rfb_esrgan import ResidualDenseBlock
+
+__all__ = [
+    "fold_scale", "fuse_conv_bn", "merge_convs", "fuse_branch_entries", "check_parity", "optimize_for_inference"
+]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+
+def fold_scale(conv: nn.Conv2d, scale: float) -> None:
+    r""" Multiply the output of a convolution by a constant, in its weight and bias.
+
+    Args:
+        conv (nn.Conv2d): Convolution, modified in place.
+        scale (float): Constant factor.
+    """
+    with torch.no_grad():
+        conv.weight.mul_(scale)
+        if conv.bias is not None:
+            conv.bias.mul_(scale)
+
+
+def fuse_conv_bn(conv: nn.Conv2d, bn: nn.BatchNorm2d) -> nn.Conv2d:
+    r""" Convolution computing `bn(conv(x))` with the running statistics of the batch norm.
+
+    Args:
+        conv (nn.Conv2d): Convolution.
+        bn (nn.BatchNorm2d): Batch norm following it.
+
+    Returns:
+        New convolution with a bias.
+    """
+    fused = copy.deepcopy(conv)
+    if fused.bias is None:
+        fused.bias = nn.Parameter(torch.zeros(conv.out_channels, device=conv.weight.device, dtype=conv.weight.dtype))
+
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps) if bn.affine else \
+            1 / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias if bn.affine else torch.zeros_like(scale)
+        fused.weight.mul_(scale.view(-1, 1, 1, 1))
+        fused.bias.copy_((fused.bias - bn.running_mean) * scale + shift)
+    return fused
+
+
+def dense_weight(conv: nn.Conv2d) -> torch.Tensor:
+    r""" Weight of a grouped convolution as the weight of the equivalent convolution with one group."""
+    if conv.groups == 1:
+        return conv.weight
+    out_channels, in_channels = conv.out_channels, conv.in_channels
+    out_per_group, in_per_group = out_channels // conv.groups, in_channels // conv.groups
+    weight = conv.weight.new_zeros(out_channels, in_channels, *conv.kernel_size)
+    for group in range(conv.groups):
+        weight[group * out_per_group:(group + 1) * out_per_group, group * in_per_group:(group + 1) * in_per_group] = \
+            conv.weight[group * out_per_group:(group + 1) * out_per_group]
+    return weight
+
+
+def is_pointwise(conv: nn.Conv2d) -> bool:
+    return conv.kernel_size == (1, 1) and conv.stride == (1, 1) and conv.padding in ((0, 0), 0) and \
+           conv.dilation == (1, 1) and conv.groups == 1 and conv.padding_mode == "zeros"
+
+
+def merge_convs(first: nn.Conv2d, second: nn.Conv2d):
+    r""" Single convolution computing `second(first(x))`, when it is exact and takes fewer multiply-accumulates.
+
+    Two cases are exact at the image border too: a 1x1 convolution after any convolution, and a 1x1 convolution
+    without bias before any convolution, whose zero padding then equals the padding of the merged convolution.
+    Other pairs, e.g. a 3x3 convolution after a 3x3 one, would see the bias of the first convolution in the padding.
+
+    Args:
+        first (nn.Conv2d): First convolution.
+        second (nn.Conv2d): Convolution applied to the output of `first`.
+
+    Returns:
+        The merged convolution, ``None`` if it is not exact or not cheaper.
+    """
+    if second.groups != 1 or first.padding_mode != "zeros" or second.padding_mode != "zeros":
+        return None
+
+    with torch.no_grad():
+        if is_pointwise(second):
+            # Per output pixel: `first` at the same resolution, then a 1x1 projection.
+            kernel = first.kernel_size[0] * first.kernel_size[1]
+            cost = first.out_channels * first.in_channels // first.groups * kernel + \
+                second.out_channels * second.in_channels
+            if second.out_channels * first.in_channels * kernel >= cost:
+                return None
+            merged = nn.Conv2d(first.in_channels, second.out_channels, first.kernel_size, first.stride,
+                               first.padding, first.dilation, bias=first.bias is not None or second.bias is not None)
+            weight = torch.einsum("om,mikl->oikl", second.weight[:, :, 0, 0], dense_weight(first))
+            bias = second.bias.clone() if second.bias is not None else weight.new_zeros(second.out_channels)
+            if first.bias is not None:
+                bias += second.weight[:, :, 0, 0] @ first.bias
+        elif is_pointwise(first) and first.bias is None:
+            # Per output pixel: the 1x1 projection at the input resolution, then `second`.
+            kernel = second.kernel_size[0] * second.kernel_size[1]
+            positions = second.stride[0] * second.stride[1]
+            cost = first.out_channels * first.in_channels * positions + second.out_channels * second.in_channels * kernel
+            if second.out_channels * first.in_channels * kernel >= cost:
+                return None
+            merged = nn.Conv2d(first.in_channels, second.out_channels, second.kernel_size, second.stride,
+                               second.padding, second.dilation, bias=second.bias is not None)
+            weight = torch.einsum("omkl,mi->oikl", second.weight, first.weight[:, :, 0, 0])
+            bias = second.bias
+        else:
+            return None
+
+        merged = merged.to(device=first.weight.device, dtype=first.weight.dtype)
+        merged.weight.copy_(weight)
+        if merged.bias is not None:
+            merged.bias.copy_(bias)
+    return merged
+
+
+def fold_block_scales(model: nn.Module) -> int:
+    r""" Fold the residual `scale_ratio` of the blocks into the convolution producing the scaled branch.
+
+    Only branches that end in a convolution are folded: the inner blocks of ESRGAN and RFB-ESRGAN, not the outer
+    `ResidualInResidualDenseBlock` and `ResidualOfReceptiveFieldDenseBlock`, whose scaled branch holds an identity.
+
+    Returns:
+        Number of scales folded.
+    """
+    folded = 0
+    for module in model.modules():
+        if getattr(module, "scale_ratio", 1) == 1:
+            continue
+        if isinstance(module, (ESRGANResidualDenseBlock, ResidualDenseBlock)):
+            convs = [module.conv5]
+        elif isinstance(module, ReceptiveFieldBlock):
+            convs = [module.conv1x1]
+        elif isinstance(module, ReceptiveFieldDenseBlock) and module.RFB5.lrelu is None:
+            # Without activation, the last block is linear in both of its convolutions.
+            convs = [module.RFB5.conv1x1, module.RFB5.shortcut]
+        else:
+            continue
+        for conv in convs:
+            fold_scale(conv, module.scale_ratio)
+        module.scale_ratio = 1.
+        folded += 1
+    return folded
+
+
+def fold_sequential(model: nn.Module) -> tuple:
+    r""" Fuse batch norms into the convolution before them, then merge adjacent convolutions, in every
+    `nn.Sequential`. Removed layers become `nn.Identity`, so the indices of the others are kept.
+
+    Returns:
+        Number of batch norms fused and of convolutions merged.
+    """
+    fused, merged = 0, 0
+    for sequential in [module for module in model.modules() if isinstance(module, nn.Sequential)]:
+        names = list(sequential._modules)
+        for name, next_name in zip(names, names[1:]):
+            conv, bn = sequential._modules[name], sequential._modules[next_name]
+            if type(conv) is nn.Conv2d and type(bn) is nn.BatchNorm2d and bn.track_running_stats:
+                sequential._modules[name] = fuse_conv_bn(conv, bn)
+                sequential._modules[next_name] = nn.Identity()
+                fused += 1
+
+        layers = [name for name in names if not isinstance(sequential._modules[name], nn.Identity)]
+        for name, next_name in zip(layers, layers[1:]):
+            first, second = sequential._modules[name], sequential._modules[next_name]
+            if type(first) is nn.Conv2d and type(second) is nn.Conv2d:
+                conv = merge_convs(first, second)
+                if conv is not None:
+                    sequential._modules[name] = nn.Identity()
+                    sequential._modules[next_name] = conv
+                    merged += 1
+    return fused, merged
+
+
+def fuse_branch_entries(model: nn.Module) -> int:
+    r""" Concatenate the 1x1 convolutions that read the input of a multi-branch block into one convolution.
+
+    The blocks with an `entry` attribute, `InceptionBlock` and `ReceptiveFieldBlock`, run their shortcut and the first
+    convolution of every branch on the same input. The fused convolution reads the input once and its output is split
+    into the shortcut and the branch inputs, the replaced convolutions become `nn.Identity`. The branch inputs are
+    views of that output, so an in-place activation right after the replaced convolution, as the `LeakyReLU` of
+    `ReceptiveFieldBlock`, is made out-of-place: autograd refuses in-place writes to the views of a split.
+
+    Returns:
+        Number of blocks fused.
+    """
+    fused = 0
+    for module in model.modules():
+        if not hasattr(module, "entry") or module.entry is not None:
+            continue
+        branches = []
+        while hasattr(module, f"branch{len(branches) + 1}"):
+            branches.append(getattr(module, f"branch{len(branches) + 1}"))
+        heads = [module.shortcut] + [branch[0] for branch in branches]
+        if not all(type(head) is nn.Conv2d and is_pointwise(head) for head in heads) or \
+                len({head.in_channels for head in heads}) != 1:
+            continue
+
+        weight = module.shortcut.weight
+        entry = nn.Conv2d(heads[0].in_channels, sum(head.out_channels for head in heads), kernel_size=1)
+        entry = entry.to(device=weight.device, dtype=weight.dtype)
+        with torch.no_grad():
+            entry.weight.copy_(torch.cat([head.weight for head in heads]))
+            entry.bias.copy_(torch.cat([head.bias if head.bias is not None else weight.new_zeros(head.out_channels)
+                                        for head in heads]))
+
+        module.entry = entry
+        module.entry_channels = [head.out_channels for head in heads]
+        module.shortcut = nn.Identity()
+        for branch in branches:
+            branch[0] = nn.Identity()
+            if len(branch) > 1 and getattr(branch[1], "inplace", False):
+                branch[1] = copy.copy(branch[1])
+                branch[1].inplace = False
+        fused += 1
+    return fused
+
+
+def check_parity(model: nn.Module, optimized: nn.Module, input_size: tuple = (1, 3, 32, 32),
+                 atol: float = 1e-4) -> float:
+    r""" Compare the outputs of a model and its optimized copy on a random image.
+
+    The optimized copy also runs a forward and backward pass with autograd enabled, as `receptive_field_halo`
+    does, which catches in-place operations the rewrites made invalid.
+
+    Args:
+        model (nn.Module): Original model.
+        optimized (nn.Module): Model returned by `optimize_for_inference`.
+        input_size (optional, tuple): Shape of the probe input. (Default: (1, 3, 32, 32)).
+        atol (optional, float): Largest absolute difference allowed. (Default: 1e-4).
+
+    Returns:
+        Largest absolute difference, `RuntimeError` if it is above `atol` or the backward pass fails.
+    """
+    device = next(model.parameters()).device
+    input = torch.rand(*input_size, device=device)
+    with torch.no_grad():
+        difference = (model(input) - optimized(input)).abs().max().item()
+    input.requires_grad_(True)
+    torch.autograd.grad(optimized(input).sum(), input)
+    if difference > atol:
+        raise RuntimeError(f"Optimized `{model.__class__.__name__}` differs by {difference:.2e} (> {atol:.0e}).")
+    return difference
+
+
+def optimize_for_inference(model: nn.Module, inplace: bool = False, check: bool = False) -> nn.Module:
+    r""" Fold the linear operations of a model into its convolutions, for inference only.
+
+    - The residual `scale_ratio` of the ESRGAN and RFB-ESRGAN blocks goes into the weights of their last convolution.
+    - A batch norm after a convolution, e.g. in `FReLU`, goes into the convolution, with its running statistics.
+    - Adjacent convolutions are merged where the result is exact and cheaper, see `merge_convs`. A 3x3 stride-2
+      convolution followed by a depthwise one, as in `SymmetricBlock`, would become a 7x7 dense convolution with
+      several times the multiply-accumulates, so it is left alone.
+    - The shortcut and branch entry 1x1 convolutions of `InceptionBlock` and `ReceptiveFieldBlock` become one
+      convolution, see `fuse_branch_entries`, so the input of the block is read once instead of five times.
+
+    Args:
+        model (nn.Module): Model, it is put in eval mode.
+        inplace (optional, bool): Modify `model` instead of a copy. (Default: ``False``).
+        check (optional, bool): Compare the outputs with the original model, see `check_parity`.
+            (Default: ``False``).
+
+    Returns:
+        Optimized model in eval mode, it must not be trained.
+
+    Examples:
+        >>> model = optimize_for_inference(rfb_esrgan().eval(), check=True)
+    """
+    model.eval()
+    reference = copy.deepcopy(model) if inplace and check else model
+    optimized = model if inplace else copy.deepcopy(model)
+
+    folded = fold_block_scales(optimized)
+    fused, merged = fold_sequential(optimized)
+    entries = fuse_branch_entries(optimized)
+    logger.info(f"Optimized `{model.__class__.__name__}`: folded {folded} scales, fused {fused} batch norms, "
+                f"merged {merged} convolution pairs, fused the branch entries of {entries} blocks.")
+
+    if check:
+        difference = check_parity(reference, optimized)
+        logger.info(f"Largest output difference is {difference:.2e}.")
+    return optimized
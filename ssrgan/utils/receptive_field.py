@@ -0,0 +1,87 @@
+# Copyright 2021 Dakewe Biotech Corporation. All Rights Reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+import logging
+
+import torch
+import torch.nn as nn
+
+__all__ = [
+    "effective_receptive_field", "receptive_field_halo"
+]
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+
+
+def effective_receptive_field(model: nn.Module, image_size: int = 64, device: torch.device = "cpu") -> torch.Tensor:
+    r""" Trace the gradient of the centre output pixel back to the low-resolution input.
+
+    Args:
+        model (nn.Module): Super-resolution model.
+        image_size (optional, int): Size of the low-resolution probe image. (Default: 64).
+        device (optional, torch.device): CPU or GPU. (Default: ``cpu``).
+
+    Returns:
+        Gradient magnitude of every input pixel (H*W), normalized to sum to 1.
+    """
+    model.eval()
+    lr = torch.rand(1, 3, image_size, image_size, device=device, requires_grad=True)
+    sr = model(lr)
+
+    # The centre output pixel is produced from the centre input pixel.
+    _, _, height, width = sr.shape
+    grad, = torch.autograd.grad(sr[0, :, height // 2, width // 2].sum(), lr)
+
+    erf = grad.abs().sum(dim=(0, 1))
+    return erf / erf.sum().clamp(min=torch.finfo(erf.dtype).tiny)
+
+
+def receptive_field_halo(model: nn.Module, energy: float = 0.999, image_size: int = 64, max_image_size: int = 512,
+                         device: torch.device = "cpu") -> int:
+    r""" Radius of the effective receptive field in low-resolution pixels.
+
+    The radius is the smallest square around the centre pixel that holds `energy` of the gradient.
+    The probe image is doubled while the radius touches its border.
+
+    Args:
+        model (nn.Module): Super-resolution model.
+        energy (optional, float): Share of the gradient the halo must cover. (Default: 0.999).
+        image_size (optional, int): Size of the first low-resolution probe image. (Default: 64).
+        max_image_size (optional, int): Largest probe image. (Default: 512).
+        device (optional, torch.device): CPU or GPU. (Default: ``cpu``).
+
+    Returns:
+        Halo in low-resolution pixels, a tile border this wide differs from the whole image result.
+
+    Examples:
+        >>> from ssrgan.models import dsgan
+        >>> halo = receptive_field_halo(dsgan())
+    """
+    while True:
+        erf = effective_receptive_field(model, image_size, device)
+        centre = image_size // 2
+
+        halo = 0
+        while halo < centre:
+            if erf[centre - halo:centre + halo + 1, centre - halo:centre + halo + 1].sum() >= energy:
+                break
+            halo += 1
+
+        if halo < centre - 1 or image_size * 2 > max_image_size:
+            break
+        image_size *= 2
+
+    logger.info(f"Receptive field halo of `{model.__class__.__name__}` is {halo} pixels "
+                f"(probe {image_size}x{image_size}).")
+    return halo